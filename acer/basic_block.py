@@ -154,8 +154,14 @@ class DQN(nn.Module):
                                        nn.LeakyReLU(),
                                        nn.Linear(args.hidden_size, self.atoms))
 
+    def features(self, x):
+        # conv trunk shared by both heads, run it once when several heads see the same states
+        return self.convs(x.float()).view(x.size(0), -1)
+
     def forward(self, x, actor_or_critic=True, log=False):
-        x = self.convs(x.float()).view(x.size(0), -1)
+        return self.head(self.features(x), actor_or_critic, log)
+
+    def head(self, x, actor_or_critic=True, log=False):
         if actor_or_critic:  # actor run if ture
             p = self.actor_end(x)
             if log:  # Use log softmax for numerical stability
@@ -4,9 +4,9 @@ import os
 import numpy as np
 import torch
 from torch import optim
-from scipy.special import softmax as softmax_sci
 from torch.nn.utils import clip_grad_norm_
 import GLOBAL_PRARM as gp
+import action_sampler
 from torch import functional as F
 
 from acer_fedstep.basic_block import DQN
@@ -33,6 +33,7 @@ class Agent:
         self.reward_update_rate = args.reward_update_rate
         self.average_reward = 0
         self.neighbor_indice = np.zeros([])
+        self.stacked = False  # set by FusedLearner, the nets are then views into stacks of all agents
 
         self.online_net = DQN(args, self.action_space).to(device=args.device)
         if args.model:  # Load pretrained model if provided
@@ -105,15 +106,22 @@ class Agent:
             self.online_net.load_state_dict(self.online_dict)
             self.target_net.load_state_dict(self.target_dict)
 
+    # Tensors of a stacked net are cloned, pickling the views would save the stacks of every agent
+    def _handed_out(self, state_dict):
+        if self.stacked:
+            for name, tensor in state_dict.items():
+                state_dict[name] = tensor.clone()
+        return state_dict
+
     def get_state_dict(self):
-        return self.online_net.state_dict()
+        return self._handed_out(self.online_net.state_dict())
 
     def set_state_dict(self, new_state_dict):
         self.shared_net.load_state_dict(new_state_dict)
         return
 
     def get_target_dict(self):
-        return self.target_net.state_dict()
+        return self._handed_out(self.target_net.state_dict())
 
     def set_target_dict(self, new_state_dict):
         self.target_net.load_state_dict(new_state_dict)
@@ -124,80 +132,35 @@ class Agent:
         self.online_net.reset_noise()
 
     # Acts based on single state (no batch)
-    def act(self, state, avail=None):
+    def act(self, state, avail=None, epsilon=0.):
         with torch.no_grad():
-            if avail is None:
-                return (self.online_net(state.unsqueeze(0)) * self.support).sum(2).argmax(1).item()
-            temp = (self.online_net(state.unsqueeze(0)) * self.support).sum(2) * torch.tensor(avail)
-            temp[:, avail == 0] = (torch.min(temp) - 100)
-            return temp.argmax(1).item()
+            q = (self.online_net(state.unsqueeze(0)) * self.support).sum(2)
+            return action_sampler.epsilon_greedy(q, None if avail is None else [avail], epsilon).item()
 
     # Acts with an ε-greedy policy (used for evaluation only)
     def act_e_greedy(self, state, available=None, epsilon=0.3, action_type='greedy'):  # High ε can reduce evaluation scores drastically
         if action_type == 'greedy':
-            return np.random.randint(0, self.action_space) if np.random.random() < epsilon else self.act(state, available)
+            return self.act(state, available, epsilon)
         elif action_type == 'boltzmann':
             return self.act_boltzmann(state, available)
         elif action_type == 'no_limit':
-            return np.random.randint(0, self.action_space) if np.random.random() < epsilon else self.act(state)
+            return self.act(state, epsilon=epsilon)
 
     # Acts with an ε-greedy policy (used for evaluation only)
     def act_boltzmann(self, state, avail):  # High ε can reduce evaluation scores drastically
+        return self.act_boltzmann_batch(state.unsqueeze(0), [avail])[0]
+
+    # act_boltzmann for a batch of states, one result per state (batched inference server)
+    def act_boltzmann_batch(self, states, avails):
         with torch.no_grad():
-            res_policy = self.online_net(state.unsqueeze(0)).detach()
-            return self.boltzmann(res_policy, [avail])
+            res_policy = self.online_net(states)
+            return action_sampler.categorical(res_policy, avails).tolist()
 
     def boltzmann(self, res_policy, mask):
-        sizeofres = res_policy.shape
-        res = []
-        res_policy = res_policy.numpy()
-        for i in range(sizeofres[0]):
-            action_probs = [res_policy[i][ind] * mask[i][ind] for ind in range(res_policy[i].shape[0])]
-            count = np.sum(action_probs)
-            if count == 0:
-                action_probs = np.array([1.0 / np.sum(mask[i]) if _ != 0 else 0 for _ in mask[i]])
-                print('Zero probs, random action')
-            else:
-                action_probs = np.array([x / count for x in action_probs])
-            res.append(np.random.choice(self.action_space, p=action_probs))
-        if sizeofres[0] == 1:
-            return res[0]
-        return np.array(res)
-
-    def lookup_server(self, list_of_pipe):
-        num_pro = len(list_of_pipe)
-        list_pro = np.ones(num_pro, dtype=bool)
-        with torch.no_grad():
-            while list_pro.any():
-                for key, pipes in enumerate(list_of_pipe):
-                    if not pipes.closed and pipes.readable:
-                        obs, avial = pipes.recv()
-                        if len(obs) == 1:
-                            if not obs[0]:
-                                pipes.close()
-                                list_pro[key] = False
-                                continue
-                        pipes.send(self.act_boltzmann(obs, avial).numpy())
-                        # convert back to numpy or cpu-tensor, or it will cause error since cuda try to run in
-                        # another thread. Keep the gpu resource inside main thread
-
-    def lookup_server_loop(self, list_of_pipe):
-        num_pro = len(list_of_pipe)
-        list_pro = np.ones(num_pro, dtype=bool)
-        for key, pipes in enumerate(list_of_pipe):
-            if not pipes.closed and pipes.readable:
-                if pipes.poll():
-                    obs, avial = pipes.recv()
-                    if type(obs) is np.ndarray:
-                        pipes.close()
-                        list_pro[key] = False
-                        continue
-                    pipes.send(self.act_boltzmann(obs, avial))
-            else:
-                list_pro[key] = False
-            # convert back to numpy or cpu-tensor, or it will cause error since cuda try to run in
-            # another thread. Keep the gpu resource inside main thread
-        return list_pro.any()
+        actions = action_sampler.categorical(res_policy, mask)
+        if len(actions) == 1:
+            return actions[0].item()
+        return actions.numpy()
 
     @staticmethod
     def _to_one_hot(y, num_classes):
@@ -220,7 +183,8 @@ class Agent:
         self.optimiser.zero_grad()
 
         # Calculate current state probabilities (online network noise already sampled)
-        log_ps_a = self.online_net(states, False, log=True)
+        feats = self.online_net.features(states)  # conv trunk once, every loss below reuses it
+        log_ps_a = self.online_net.head(feats, False, log=True)
         # Log probabilities log p(s_t, ·; θonline)
 
         with torch.no_grad():
@@ -250,26 +214,27 @@ class Agent:
             # m_u = m_u + p(s_t+n, a*)(b - l)
 
             # update the average reward
-            ps_a = self.online_net(states, False)
+            ps_a = self.online_net.head(feats, False)
+            shared_feats = self.shared_net.features(states)  # the shared net only gives CORAL targets
             self.average_reward = self.average_reward + \
                                   self.reward_update_rate * torch.mean(returns.unsqueeze(1) +
                                                                        torch.sum(pns_a * self.support, dim=1) -
                                                                        torch.sum(ps_a * self.support, dim=1))
 
         value_loss = -torch.sum(m * log_ps_a, 1)  # Cross-entropy loss (minimises DKL(m||p(s_t, a_t)))
-        value_coral_loss = self.coral_func(self.online_net(states, actor_or_critic=False, original=True),
-                                           self.shared_net(states, actor_or_critic=False, original=True))
+        value_coral_loss = self.coral_func(self.online_net.head(feats, actor_or_critic=False, original=True),
+                                           self.shared_net.head(shared_feats, actor_or_critic=False, original=True))
 
         # Actor update
-        curr_pol_out_log = self.online_net(states, log=True)
+        curr_pol_out_log = self.online_net.head(feats, log=True)
         policy_loss = - curr_pol_out_log.gather(-1, actions.unsqueeze(1)) * \
-                      (returns.unsqueeze(1) - self.online_net(states, False) * self.support)
+                      (returns.unsqueeze(1) - self.online_net.head(feats, False) * self.support)
         # log probs * advantage
         policy_loss = policy_loss.mean()
-        curr_pol_out = self.online_net(states, log=False)
+        curr_pol_out = self.online_net.head(feats, log=False)
         policy_loss += -(curr_pol_out ** 2).mean() * 1e-3
-        policy_coral_loss = self.coral_func(self.online_net(states, original=True),
-                                            self.shared_net(states, original=True))
+        policy_coral_loss = self.coral_func(self.online_net.head(feats, original=True),
+                                            self.shared_net.head(shared_feats, original=True))
 
         entropy_loss = -(curr_pol_out_log * curr_pol_out).mean()
 
@@ -281,6 +246,7 @@ class Agent:
         self.optimiser.step()
 
         mem.update_priorities(idxs[0], value_loss.detach().cpu().numpy())  # Update priorities of sampled transitions
+        return loss.detach()
 
     def update_target_net(self):
         self.target_net.load_state_dict(self.online_net.state_dict())
@@ -294,15 +260,19 @@ class Agent:
     # Save model parameters on current device (don't move model between devices)
     def save(self, path, index=-1, name='model.pth'):
         if index == -1:
-            torch.save(self.online_net.state_dict(), os.path.join(path, name))
+            torch.save(self.get_state_dict(), os.path.join(path, name))
         else:
-            torch.save(self.online_net.state_dict(), os.path.join(path, name[0:-4] + str(index) + name[-4:]))
+            torch.save(self.get_state_dict(), os.path.join(path, name[0:-4] + str(index) + name[-4:]))
 
     # Evaluates Q-value based on single state (no batch)
     def evaluate_q(self, state):
         with torch.no_grad():
             return (self.online_net(state.unsqueeze(0), False) * self.support).sum(-1).item()
 
+    def evaluate_q_batch(self, states):
+        with torch.no_grad():
+            return (self.online_net(states, False) * self.support).sum(-1).view(-1)
+
     def train(self):
         self.online_net.train()
 
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import copy
+import torch
+from torch import nn, optim
+from torch.func import functional_call, vmap
+import GLOBAL_PRARM as gp
+
+"""
+    One learn step for all acer_fedstep agents at once. The online, target and shared nets of the agents are stacked
+    on a leading agent dimension, every agent's module keeps views into the stacks so acting, saving, target updates
+    and federated averaging still go through the agents. Forward and backward of all agents run in one vmap call over
+    a stateless copy of the net, one Adam over the stacked parameters is the same as one Adam per agent.
+    1) learner = FusedLearner(args, agents)
+    2) learner.learn(mems): one batch sampled from each agent's memory, same losses as Agent.learn
+        return (agent) losses
+    Under the learner the agents hand out cloned state dicts, their own tensors would pickle every agent's stack.
+"""
+
+
+def _stack(modules, requires_grad):
+    # stacked copies of the parameters and buffers, each module's tensors become views of its slice
+    params = {name: torch.stack([dict(module.named_parameters())[name].detach() for module in modules])
+              .requires_grad_(requires_grad) for name, _ in modules[0].named_parameters()}
+    buffers = {name: torch.stack([dict(module.named_buffers())[name] for module in modules])
+               for name, _ in modules[0].named_buffers()}
+    for index, module in enumerate(modules):
+        for name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+            tensor.data = (params[name] if name in params else buffers[name]).data[index]
+    return params, buffers
+
+
+class _Method(nn.Module):
+    # functional_call only runs forward, this runs another method of the wrapped net (tensors prefixed 'net.')
+    def __init__(self, net, method):
+        super(_Method, self).__init__()
+        self.net, self.method = net, method
+
+    def forward(self, *args, **kwargs):
+        return getattr(self.net, self.method)(*args, **kwargs)
+
+
+def _prefixed(tensors):
+    return {'net.' + name: tensor for name, tensor in tensors.items()}
+
+
+def _coral(src, tar):
+    # Agent.coral_func without .data, which vmap does not support
+    ns, nt, dim = src.shape[0], tar.shape[0], src.shape[1]
+    sum_s, sum_t = src.sum(0, keepdim=True), tar.sum(0, keepdim=True)
+    cov_s = (torch.matmul(src.T, src) - torch.matmul(sum_s.T, sum_s) / ns) / (ns - 1)
+    cov_t = (torch.matmul(tar.T, tar) - torch.matmul(sum_t.T, sum_t) / nt) / (nt - 1)
+    return torch.mean((cov_s - cov_t) ** 2) / (4 * dim * dim)
+
+
+class FusedLearner:
+    def __init__(self, args, agents):
+        self.agents = agents
+        self.batch_size = args.batch_size
+        self.atoms = args.atoms
+        self.Vmin, self.Vmax = args.V_min, args.V_max
+        self.delta_z = (args.V_max - args.V_min) / (self.atoms - 1)
+        self.support = agents[0].support
+        self.discount, self.n = args.discount, args.multi_step
+        self.reward_update_rate = args.reward_update_rate
+        # stateless copies of the net, the stacked tensors are passed in on every call
+        self.online_base = copy.deepcopy(agents[0].online_net).to('meta')
+        self.target_base = copy.deepcopy(agents[0].target_net).to('meta')
+        self.shared_base = copy.deepcopy(agents[0].shared_net).to('meta')
+        # the conv trunk runs once per batch, the heads reuse its features
+        self.online_features = _Method(self.online_base, 'features')
+        self.online_head = _Method(self.online_base, 'head')
+        self.shared_features = _Method(self.shared_base, 'features')
+        self.shared_head = _Method(self.shared_base, 'head')
+        self.params, self.buffers = _stack([agent.online_net for agent in agents], True)
+        self.target_params, self.target_buffers = _stack([agent.target_net for agent in agents], False)
+        self.shared_params, self.shared_buffers = _stack([agent.shared_net for agent in agents], False)
+        for agent in agents:
+            agent.stacked = True
+            agent.reload_step_state_dict()  # saved dicts point at the stacked storage from now on
+        self.optimiser = optim.Adam(self.params.values(), lr=args.learning_rate, eps=args.adam_eps, foreach=True)
+
+    def _forward(self, base, params, buffers, states, *args, **kwargs):
+        # one forward of every agent's net on its own batch, (agent x batch x ...)
+        return vmap(lambda p, b, x: functional_call(base, (p, b), (x,) + args, kwargs), randomness='different')(
+            params, buffers, states)
+
+    def _project(self, returns, nonterminals, pns_a):
+        # L2 projection of Tz = R^n + (γ^n)z onto the fixed support, all agents folded into the batch
+        batch = returns.shape[0] * returns.shape[1]
+        returns, nonterminals, pns_a = returns.reshape(batch), nonterminals.reshape(batch, 1), \
+                                       pns_a.reshape(batch, self.atoms)
+        Tz = returns.unsqueeze(1) + nonterminals * (self.discount ** self.n) * self.support.unsqueeze(0)
+        Tz = Tz.clamp(min=self.Vmin, max=self.Vmax)  # Clamp between supported values
+        b = (Tz - self.Vmin) / self.delta_z  # b = (Tz - Vmin) / Δz
+        l, u = b.floor().long(), b.ceil().long()
+        # Fix disappearing probability mass when l = b = u (b is int)
+        l[(u > 0) * (l == u)] -= 1
+        u[(l < (self.atoms - 1)) * (l == u)] += 1
+        m = pns_a.new_zeros(batch, self.atoms)
+        offset = torch.arange(batch, device=l.device).unsqueeze(1) * self.atoms
+        m.view(-1).index_add_(0, (l + offset).view(-1), (pns_a * (u.float() - b)).view(-1))
+        m.view(-1).index_add_(0, (u + offset).view(-1), (pns_a * (b - l.float())).view(-1))
+        return m.view(len(self.agents), -1, self.atoms)
+
+    def _loss(self, params, buffers, states, actions, returns, m, weights, shared_value, shared_policy):
+        # Agent.learn for one agent, vmapped over the agents
+        tensors = (_prefixed(params), _prefixed(buffers))
+        feats = functional_call(self.online_features, tensors, (states,))
+
+        def head(*args, **kwargs):
+            return functional_call(self.online_head, tensors, (feats,) + args, kwargs)
+
+        log_ps_a = head(False, log=True)
+        value_loss = -torch.sum(m * log_ps_a, 1)  # Cross-entropy loss (minimises DKL(m||p(s_t, a_t)))
+        value_coral_loss = _coral(head(False, original=True), shared_value)
+        curr_pol_out_log = head(log=True)
+        ps_a = head(False)
+        policy_loss = - curr_pol_out_log.gather(-1, actions.unsqueeze(1)) * \
+                      (returns.unsqueeze(1) - ps_a * self.support)
+        policy_loss = policy_loss.mean()
+        curr_pol_out = head(log=False)
+        policy_loss = policy_loss - (curr_pol_out ** 2).mean() * 1e-3
+        policy_coral_loss = _coral(head(original=True), shared_policy)
+        entropy_loss = -(curr_pol_out_log * curr_pol_out).mean()
+        loss = (weights * value_loss).mean() + policy_loss - 1e-2 * entropy_loss + \
+               1e-2 * (value_coral_loss + policy_coral_loss)
+        # the expected values also update the average reward, the trunk (and its batch norm) ran only once
+        return loss, value_loss.detach(), torch.sum(ps_a.detach() * self.support, dim=1)
+
+    def _clip_grad_norm(self, max_norm):
+        # clip_grad_norm_ of every agent separately
+        grads = [param.grad for param in self.params.values() if param.grad is not None]
+        norms = torch.stack([grad.reshape(len(self.agents), -1).pow(2).sum(1) for grad in grads]).sum(0).sqrt()
+        scale = (max_norm / (norms + 1e-6)).clamp(max=1)
+        for grad in grads:
+            grad.mul_(scale.view(-1, *[1] * (grad.dim() - 1)))
+
+    def learn(self, mems):
+        if gp.ONE_EPISODE_RUN > 0:
+            for agent in self.agents:
+                agent.average_reward = 0
+        samples = [mem.sample(self.batch_size, agent.average_reward) for mem, agent in zip(mems, self.agents)]
+        idxs = [sample[0] for sample in samples]
+        states, actions, returns, next_states, nonterminals, weights = \
+            [torch.stack([sample[field] for sample in samples]) for field in (1, 2, 7, 8, 9, 10)]
+        self.online_base.train(self.agents[0].online_net.training)
+        self.target_base.train(self.agents[0].target_net.training)
+        self.shared_base.train(self.agents[0].shared_net.training)
+
+        with torch.no_grad():
+            pns_a = self._forward(self.target_base, self.target_params, self.target_buffers, next_states, False)
+            m = self._project(returns, nonterminals, pns_a)
+            shared_params, shared_buffers = _prefixed(self.shared_params), _prefixed(self.shared_buffers)
+            shared_feats = self._forward(self.shared_features, shared_params, shared_buffers, states)
+            shared_value = self._forward(self.shared_head, shared_params, shared_buffers, shared_feats,
+                                         actor_or_critic=False, original=True)
+            shared_policy = self._forward(self.shared_head, shared_params, shared_buffers, shared_feats,
+                                          original=True)
+
+        self.optimiser.zero_grad()
+        loss, value_loss, values = vmap(self._loss, randomness='different')(
+            self.params, self.buffers, states, actions, returns, m, weights, shared_value, shared_policy)
+        with torch.no_grad():
+            # update the average rewards
+            average_reward = self.reward_update_rate * torch.mean(
+                returns.unsqueeze(2) + torch.sum(pns_a * self.support, dim=2, keepdim=True) -
+                values.unsqueeze(2), dim=(1, 2))
+            for agent, increase in zip(self.agents, average_reward):
+                agent.average_reward = agent.average_reward + increase
+        loss.sum().backward()  # the agents' losses share no parameters, each gets its own gradient
+        self._clip_grad_norm(0.5)
+        self.optimiser.step()
+
+        for mem, idx, priorities in zip(mems, idxs, value_loss.cpu().numpy()):
+            mem.update_priorities(idx[0], priorities)  # Update priorities of sampled transitions
+        return loss.detach()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import math
+
+import numpy as np
+import torch
+
+"""
+    Masked action selection for a whole (batch x action) tensor in one call, shared by the agents and the env.
+    mask: (batch x action) bool or 0/1 tensor, array or list of rows, None allows every action.
+          A row without any valid action falls back to all actions.
+    1) categorical(weights, mask, logits=False):
+        sample from the valid weights renormalised per row (softmax over the valid logits if logits),
+        rows whose valid weights sum to zero sample uniformly from their valid actions
+        return (batch) int64 tensor
+    2) greedy(values, mask):
+        return (batch) argmax over the valid actions
+    3) epsilon_greedy(values, mask, epsilon):
+        return (batch) greedy actions, each row replaced by a uniform valid action with probability epsilon
+    4) uniform(mask):
+        return (batch) uniformly sampled valid actions
+"""
+
+
+def as_mask(mask, like):
+    """:return bool tensor shaped and placed like the given tensor"""
+    if mask is None:
+        return torch.ones(like.shape, dtype=torch.bool, device=like.device)
+    if not torch.is_tensor(mask):
+        mask = torch.from_numpy(np.asarray(mask))
+    mask = mask.to(device=like.device, dtype=torch.bool).reshape(like.shape)
+    return mask | ~mask.any(-1, keepdim=True)
+
+
+def uniform(mask):
+    if not torch.is_tensor(mask):
+        mask = torch.from_numpy(np.asarray(mask))
+    mask = as_mask(mask, mask)
+    return torch.multinomial(mask.reshape(-1, mask.shape[-1]).float(), 1).view(mask.shape[:-1])
+
+
+def categorical(weights, mask=None, logits=False):
+    weights = weights.detach().float()
+    mask = as_mask(mask, weights)
+    if logits:
+        weights = torch.softmax(weights.masked_fill(~mask, -math.inf), dim=-1)
+    else:
+        weights = weights.clamp(min=0) * mask  # negative weights have no probability
+    empty = ~(weights.sum(-1, keepdim=True) > 0)
+    weights = torch.where(empty, mask.float(), weights)
+    return torch.multinomial(weights.reshape(-1, weights.shape[-1]), 1).view(weights.shape[:-1])
+
+
+def greedy(values, mask=None):
+    mask = as_mask(mask, values)
+    return values.detach().masked_fill(~mask, -math.inf).argmax(-1)
+
+
+def epsilon_greedy(values, mask=None, epsilon=0.):
+    mask = as_mask(mask, values)
+    actions = greedy(values, mask)
+    if epsilon > 0:
+        explore = torch.rand(actions.shape, device=actions.device) < epsilon
+        if explore.any():
+            actions = torch.where(explore, uniform(mask), actions)
+    return actions
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import GLOBAL_PRARM as gp
+import memory
+from game import Decentralized_Game as Env
+from vec_game import VecDecentralizedGame
+
+
+def game_args(history_length=2, multi_step=1):
+    # the subset of train.py options read by the game
+    return argparse.Namespace(history_length=history_length, multi_step=multi_step, previous_action_observable=True,
+                              current_action_observable=False, action_selection='boltzmann',
+                              device=torch.device('cpu'))
+
+
+def replay_args(capacity, sparse_nnz=0):
+    # the subset of train.py options read by the replay memory
+    args = game_args()
+    args.memory_capacity, args.discount, args.priority_weight, args.priority_exponent = capacity, 0.99, 0.4, 0.5
+    args.sparse_observation, args.sparse_nnz, args.data_reinforce = sparse_nnz > 0, sparse_nnz, False
+    args.global_frame, args.compact_transition = False, False
+    return args
+
+
+def random_steps(steps, ap_number):
+    # random (steps x ap x ...) transitions with the value ranges of real observations
+    state = torch.zeros(steps, ap_number, *memory.state_shape)
+    state[:, :, 0] = torch.randint(-1, 2, (steps, ap_number, *memory.state_shape[1:])).float()
+    state[:, :, 1] = torch.rand(steps, ap_number, *memory.state_shape[1:])
+    action = np.random.randint(0, gp.ACTION_NUM, (steps, ap_number))
+    action_logp = np.log(np.full((steps, ap_number, gp.ACTION_NUM), 1 / gp.ACTION_NUM))
+    nei_action = np.random.randint(-1, 13, (steps, ap_number, 7))
+    glob_action = np.random.randint(0, 13, (steps, ap_number))
+    avail = np.ones((steps, ap_number, gp.ACTION_NUM), dtype=np.bool_)
+    reward = torch.rand(steps, ap_number)
+    terminal = np.random.rand(steps) < 0.01
+    return state, action, action_logp, nei_action, glob_action, avail, reward, terminal
+
+
+def timeit(func, repeat):
+    costs = np.zeros(repeat)
+    for ind in range(repeat):
+        start = time.perf_counter()
+        func()
+        costs[ind] = time.perf_counter() - start
+    return costs
+
+
+def report(name, costs):
+    print('{:<32s} mean {:9.3f} ms | p50 {:9.3f} ms | p95 {:9.3f} ms | n {:d}'.format(
+        name, np.mean(costs) * 1e3, np.percentile(costs, 50) * 1e3, np.percentile(costs, 95) * 1e3, len(costs)))
+
+
+def bench_reset(repeat):
+    args = game_args()
+    game = Env(args)
+    game.step()
+    report('game construct', timeit(lambda: Env(args), repeat))
+    report('game reset (in place)', timeit(game.reset, repeat))
+
+    def reset_step():
+        game.reset()
+        game.step()
+    report('game reset + first step', timeit(reset_step, repeat))
+    report('game step', timeit(game.step, repeat))
+
+
+def bench_vec(repeat, num_envs):
+    args = game_args()
+    for mode in ['sync', 'subprocess']:
+        vec_game = VecDecentralizedGame(args, num_envs, mode)
+        vec_game.reset()
+
+        def vec_step():
+            _, avails = vec_game.observe()
+            vec_game.step(vec_game.random_action(avails))
+        costs = timeit(vec_step, repeat)
+        report('vec step ' + mode + ' x' + str(num_envs), costs)
+        print('{:<32s} {:9.1f} game steps/s'.format('', num_envs / np.mean(costs)))
+        vec_game.close()
+
+
+def step_bytes(dtype, ap_number):
+    # replay bytes of one step of every ap, shared fields are stored once per step
+    return sum(dtype.fields[name][0].itemsize * (1 if name in memory.shared_fields else ap_number)
+               for name in dtype.names)
+
+
+def bench_layout(sparse_nnz):
+    ap_number = gp.NUM_OF_ACCESSPOINT
+    field_shape = Env(game_args()).get_crop_geometry()[0]
+    dense_bytes = step_bytes(memory.Transition_dtype, ap_number)
+    layouts = [('sparse transition k=' + str(sparse_nnz), memory.sparse_transition_layout(sparse_nnz)[0]),
+               ('compact transition', memory.compact_transition_layout()[0]),
+               ('global frame ' + str(field_shape), memory.global_frame_transition_layout(field_shape, ap_number)[0])]
+    print('{:<32s} {:9d} bytes per step'.format('dense transition', dense_bytes))
+    for name, dtype in layouts:
+        print('{:<32s} {:9d} bytes per step | {:5.1f}x smaller'.format(name, step_bytes(dtype, ap_number),
+                                                                       dense_bytes / step_bytes(dtype, ap_number)))
+
+
+def bench_append(repeat, batch):
+    ap_number = gp.NUM_OF_ACCESSPOINT
+    replay = memory.MultiAgentReplayMemory(replay_args(repeat * batch), repeat * batch, ap_number)
+    steps = random_steps(batch, ap_number)
+
+    def append_steps():
+        for step in range(batch):
+            replay.append(*[field[step] for field in steps])
+    report('append x' + str(batch) + ' steps', timeit(append_steps, repeat))
+    report('append_batch x' + str(batch) + ' steps', timeit(lambda: replay.append_batch(*steps), repeat))
+
+
+def bench_tree(repeat, batch, capacities):
+    for capacity in capacities:
+        tree = memory.SegmentTree(capacity)
+        for start in range(0, capacity, 2 ** 16):
+            chunk = np.arange(start, min(start + 2 ** 16, capacity))
+            tree.update(chunk + tree.tree_start, np.random.rand(len(chunk)))
+        name = ' cap ' + '{:.0e}'.format(capacity) + ' x' + str(batch)
+        report('tree update' + name, timeit(
+            lambda: tree.update(np.random.randint(0, capacity, batch) + tree.tree_start, np.random.rand(batch)), repeat))
+        report('tree find' + name, timeit(lambda: tree.find(np.random.uniform(0, tree.total(), batch)), repeat))
+        report('tree append' + name, timeit(lambda: tree.append(np.random.randint(0, capacity)), repeat))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Micro benchmarks')
+    parser.add_argument('--repeat', type=int, default=100, help='Repetitions per measurement')
+    parser.add_argument('--bench', type=str, default='all', choices=['all', 'reset', 'vec', 'layout', 'append', 'tree'],
+                        help='Benchmark to run')
+    parser.add_argument('--num-envs', type=int, default=4, help='Games of the vectorized benchmark')
+    parser.add_argument('--sparse-nnz', type=int, default=128, help='Width of the sparse transition layout')
+    parser.add_argument('--append-batch', type=int, default=64, help='Steps per batched append')
+    parser.add_argument('--tree-batch', type=int, default=32, help='Indices per sum tree update / search')
+    parser.add_argument('--tree-capacities', type=int, nargs='+', default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7],
+                        help='Sum tree capacities to benchmark')
+    bench_args = parser.parse_args()
+    if bench_args.bench in ['all', 'reset']:
+        bench_reset(bench_args.repeat)
+    if bench_args.bench in ['all', 'vec']:
+        bench_vec(bench_args.repeat, bench_args.num_envs)
+    if bench_args.bench in ['all', 'layout']:
+        bench_layout(bench_args.sparse_nnz)
+    if bench_args.bench in ['all', 'append']:
+        bench_append(bench_args.repeat, bench_args.append_batch)
+    if bench_args.bench in ['all', 'tree']:
+        bench_tree(bench_args.repeat, bench_args.tree_batch, bench_args.tree_capacities)
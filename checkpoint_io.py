@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import bz2
+import json
+import lzma
+import os
+import pickle
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from memory import shared_fields
+
+"""
+    Checkpoint directory of independently compressed pickles plus a manifest.json, written and read by a thread pool
+    (the codecs and file io release the GIL) so the time scales with cores instead of with the number of aps.
+    1) save_checkpoint(path, items, codec):
+        items: dict name -> picklable object (state dicts, replay shards, ...)
+        every save writes files of a new version next to the previous checkpoint, switches the manifest to them and
+        only then deletes the files of the previous one, a crash mid-save leaves the previous checkpoint loadable
+    2) load_checkpoint(path, names=None):
+        return dict name -> object, crc checked
+    3) replay_items(replay) / restore_replay(replay, items):
+        one shard per replay field and ap, and one per ap for the priorities
+"""
+
+CODECS = {'none': (lambda data: data, lambda data: data),
+          'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+          'bz2': (lambda data: bz2.compress(data, 9), bz2.decompress),
+          'lzma': (lambda data: lzma.compress(data, preset=0), lzma.decompress)}
+
+
+def _write_item(path, name, item, codec, version):
+    data = CODECS[codec][0](pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL))
+    file = '{}.v{:06d}.pkl.{}'.format(name, version, codec)
+    with open(os.path.join(path, file + '.tmp'), 'wb') as item_file:
+        item_file.write(data)
+    os.replace(os.path.join(path, file + '.tmp'), os.path.join(path, file))
+    return name, {'file': file, 'bytes': len(data), 'crc32': zlib.crc32(data)}
+
+
+def _read_item(path, name, entry, codec):
+    with open(os.path.join(path, entry['file']), 'rb') as item_file:
+        data = item_file.read()
+    if zlib.crc32(data) != entry['crc32']:
+        raise ValueError("Checkpoint file " + entry['file'] + " is corrupted")
+    return name, pickle.loads(CODECS[codec][1](data))
+
+
+def save_checkpoint(path, items, codec='zlib', workers=None):
+    if codec not in CODECS:
+        raise ValueError("Unknown checkpoint codec " + codec)
+    os.makedirs(path, exist_ok=True)
+    version = 0
+    if os.path.exists(os.path.join(path, 'manifest.json')):
+        with open(os.path.join(path, 'manifest.json'), 'r') as manifest_file:
+            version = json.load(manifest_file).get('version', 0) + 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        entries = dict(pool.map(lambda item: _write_item(path, item[0], item[1], codec, version), items.items()))
+    temp_path = os.path.join(path, 'manifest.json.tmp')
+    with open(temp_path, 'w') as manifest_file:
+        json.dump({'codec': codec, 'version': version, 'items': entries}, manifest_file)
+    os.replace(temp_path, os.path.join(path, 'manifest.json'))  # all files of this version are complete by now
+    # the previous version and files left by an interrupted save are no longer listed
+    live = {entry['file'] for entry in entries.values()}
+    for file in os.listdir(path):
+        if file not in live and any('.pkl.' + name in file for name in CODECS):
+            os.remove(os.path.join(path, file))
+
+
+def load_checkpoint(path, names=None, workers=None):
+    with open(os.path.join(path, 'manifest.json'), 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    entries = manifest['items'] if names is None else {name: manifest['items'][name] for name in names}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(pool.map(lambda entry: _read_item(path, entry[0], entry[1], manifest['codec']), entries.items()))
+
+
+def replay_items(replay):
+    store = replay.store
+    with store.lock:
+        items = {'replay_meta': {'capacity': store.capacity, 'agent_number': store.agent_number,
+                                 'index': store.index, 'full': store.full, 't': store.t, 'steps': store.steps,
+                                 'fields': sorted(store.columns)}}
+        for name, column in store.columns.items():
+            if name not in shared_fields:
+                for agent in range(store.agent_number):
+                    items['replay_' + name + '_ap' + str(agent)] = np.array(column[:, agent])
+            else:
+                items['replay_' + name] = np.array(column)
+        for agent, memory in enumerate(replay.agents):
+            items['priorities_ap' + str(agent)] = (np.array(memory.transitions.sum_tree), memory.transitions.max)
+    return items
+
+
+def restore_replay(replay, items):
+    store, meta = replay.store, items['replay_meta']
+    if meta['capacity'] != store.capacity or meta['agent_number'] != store.agent_number or \
+            meta['fields'] != sorted(store.columns):
+        raise ValueError("Checkpoint replay was saved with another capacity or layout")
+    with store.lock:
+        for name, column in store.columns.items():
+            if 'replay_' + name in items:
+                column[...] = items['replay_' + name]
+            else:
+                for agent in range(store.agent_number):
+                    column[:, agent] = items['replay_' + name + '_ap' + str(agent)]
+        store.index, store.full, store.t, store.steps = meta['index'], meta['full'], meta['t'], meta['steps']
+        stored = np.arange(store.capacity if store.full else store.index)
+        for agent, memory in enumerate(replay.agents):
+            sum_tree, max_priority = items['priorities_ap' + str(agent)]
+            memory.transitions.update(stored + memory.transitions.tree_start,
+                                      sum_tree[stored + memory.transitions.tree_start])
+            memory.transitions.max = max_priority
+    return replay
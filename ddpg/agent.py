@@ -4,9 +4,9 @@ import os
 import numpy as np
 import torch
 from torch import optim
-from scipy.special import softmax as softmax_sci
 from torch.nn.utils import clip_grad_norm_
 import GLOBAL_PRARM as gp
+import action_sampler
 
 from ddpg.basic_block import Actor_Critic
 # https://github.com/megvii-research/pytorch-gym/blob/master/base/ddpg.py
@@ -92,80 +92,35 @@ class Agent:
         self.online_net.reset_noise()
 
     # Acts based on single state (no batch)
-    def act(self, state, avail=None):
+    def act(self, state, avail=None, epsilon=0.):
         with torch.no_grad():
-            if avail is None:
-                return self.online_net(state.unsqueeze(0)).argmax(1).item()
-            temp = self.online_net(state.unsqueeze(0)) * torch.tensor(avail)
-            temp[:, avail == 0] = (torch.min(temp) - 100)
-            return temp.argmax(1).item()
+            q = self.online_net(state.unsqueeze(0))
+            return action_sampler.epsilon_greedy(q, None if avail is None else [avail], epsilon).item()
 
     # Acts with an ε-greedy policy (used for evaluation only)
     def act_e_greedy(self, state, available=None, epsilon=0.3, action_type='greedy'):  # High ε can reduce evaluation scores drastically
         if action_type == 'greedy':
-            return np.random.randint(0, self.action_space) if np.random.random() < epsilon else self.act(state, available)
+            return self.act(state, available, epsilon)
         elif action_type == 'boltzmann':
             return self.act_boltzmann(state, available)
         elif action_type == 'no_limit':
-            return np.random.randint(0, self.action_space) if np.random.random() < epsilon else self.act(state)
+            return self.act(state, epsilon=epsilon)
 
     # Acts with an ε-greedy policy (used for evaluation only)
     def act_boltzmann(self, state, avail):  # High ε can reduce evaluation scores drastically
+        return self.act_boltzmann_batch(state.unsqueeze(0), [avail])[0]
+
+    # act_boltzmann for a batch of states, one result per state (batched inference server)
+    def act_boltzmann_batch(self, states, avails):
         with torch.no_grad():
-            res_policy = self.online_net(state.unsqueeze(0)).detach()
-            return self.boltzmann(res_policy, [avail])
+            res_policy = self.online_net(states)
+            return action_sampler.categorical(res_policy, avails, logits=True).tolist()
 
     def boltzmann(self, res_policy, mask):
-        sizeofres = res_policy.shape
-        res = []
-        res_policy = softmax_sci(res_policy.numpy(), axis=1)
-        for i in range(sizeofres[0]):
-            action_probs = [res_policy[i][ind] * mask[i][ind] for ind in range(res_policy[i].shape[0])]
-            count = np.sum(action_probs)
-            if count == 0:
-                action_probs = np.array([1.0 / np.sum(mask[i]) if _ != 0 else 0 for _ in mask[i]])
-                print('Zero probs, random action')
-            else:
-                action_probs = np.array([x / count for x in action_probs])
-            res.append(np.random.choice(self.action_space, p=action_probs))
-        if sizeofres[0] == 1:
-            return res[0]
-        return np.array(res)
-
-    def lookup_server(self, list_of_pipe):
-        num_pro = len(list_of_pipe)
-        list_pro = np.ones(num_pro, dtype=bool)
-        with torch.no_grad():
-            while list_pro.any():
-                for key, pipes in enumerate(list_of_pipe):
-                    if not pipes.closed and pipes.readable:
-                        obs, avial = pipes.recv()
-                        if len(obs) == 1:
-                            if not obs[0]:
-                                pipes.close()
-                                list_pro[key] = False
-                                continue
-                        pipes.send(self.act_boltzmann(obs, avial).numpy())
-                        # convert back to numpy or cpu-tensor, or it will cause error since cuda try to run in
-                        # another thread. Keep the gpu resource inside main thread
-
-    def lookup_server_loop(self, list_of_pipe):
-        num_pro = len(list_of_pipe)
-        list_pro = np.ones(num_pro, dtype=bool)
-        for key, pipes in enumerate(list_of_pipe):
-            if not pipes.closed and pipes.readable:
-                if pipes.poll():
-                    obs, avial = pipes.recv()
-                    if type(obs) is np.ndarray:
-                        pipes.close()
-                        list_pro[key] = False
-                        continue
-                    pipes.send(self.act_boltzmann(obs, avial))
-            else:
-                list_pro[key] = False
-            # convert back to numpy or cpu-tensor, or it will cause error since cuda try to run in
-            # another thread. Keep the gpu resource inside main thread
-        return list_pro.any()
+        actions = action_sampler.categorical(res_policy, mask, logits=True)
+        if len(actions) == 1:
+            return actions[0].item()
+        return actions.numpy()
 
     @staticmethod
     def _to_one_hot(y, num_classes):
@@ -195,11 +150,7 @@ class Agent:
             # Calculate nth next state probabilities
             dns = self.online_net(next_states)  # Probabilities p(s_t+n, ·; θonline)
             if self.action_type == 'greedy':
-                dns = dns * avails
-                for ind, avail in enumerate(avails):
-                    if not (avail == 0).all():
-                        dns[ind, avail == 0] = (torch.min(dns[ind]) - 10)
-                argmax_indices_ns = dns.argmax(1)
+                argmax_indices_ns = action_sampler.greedy(dns, avails)
                 # Perform argmax action selection using online network: argmax_a[(z, p(s_t+n, a; θonline))]
             elif self.action_type == 'boltzmann':
                 argmax_indices_ns = self.boltzmann(dns, avails.numpy())
@@ -282,6 +233,10 @@ class Agent:
         with torch.no_grad():
             return (self.online_net(state.unsqueeze(0))).max(1)[0].item()
 
+    def evaluate_q_batch(self, states):
+        with torch.no_grad():
+            return (self.online_net(states)).max(1)[0]
+
     def train(self):
         self.online_net.train()
 
@@ -7,6 +7,7 @@ import copy as cp
 from collections import defaultdict, deque
 import GLOBAL_PRARM as gp
 import mymatplotlib as myplt
+import action_sampler
 
 # from pympler.tracker import SummaryTracker
 # tracker = SummaryTracker()
@@ -209,6 +210,14 @@ class Channel:
         # precoders
         self.zf_precoder_v = np.vectorize(self.zf_precoder)
 
+    def reset(self):
+        # start a new episode in place, the cached ap topology is reused
+        self.time = 0
+        self.user_number = 0
+        self.user_qos = np.zeros([0, 2])
+        self.user_position = np.zeros([0, 2])
+        self.coop_decision = np.zeros([self.ap_number, self.ap_number], dtype=int)
+
     def number_init(self):
         if self.user_distri_type == "PPP":
             if self.user_position.shape[0] == 0 or self.time % gp.USER_ADDING == 0:
@@ -269,15 +278,16 @@ class Channel:
                 self.user_position = np.concatenate((new_user_position, self.user_position))
         else:
             raise ValueError("Unknown User Distribution Type")
-        self.ap_position = \
-            np.asarray([[x * 3 + 1, np.sqrt(3) * (y * 2 + 0.1 + x % 2)]
-                        for x in range(int((gp.LENGTH_OF_FIELD - gp.ACCESSPOINT_SPACE) // (3 * gp.ACCESSPOINT_SPACE)) + 1)
-                        for y in range(int(gp.WIDTH_OF_FIELD // (2 * np.sqrt(3) * gp.ACCESSPOINT_SPACE)) + 1)]) \
-            * self.ap_distri_space
+        if self.coop_graph is None:
+            # ap topology is fixed, build it once and keep it across steps and resets
+            self.ap_position = \
+                np.asarray([[x * 3 + 1, np.sqrt(3) * (y * 2 + 0.1 + x % 2)]
+                            for x in range(int((gp.LENGTH_OF_FIELD - gp.ACCESSPOINT_SPACE) // (3 * gp.ACCESSPOINT_SPACE)) + 1)
+                            for y in range(int(gp.WIDTH_OF_FIELD // (2 * np.sqrt(3) * gp.ACCESSPOINT_SPACE)) + 1)]) \
+                * self.ap_distri_space
+            self.coop_graph = Connection_Graph(self.ap_position, self.connect_threshold)
         self.dist_matrix = ssd.cdist(self.ap_position, self.user_position)
         self.dist_matrix[np.where(self.dist_matrix < 1)] += 1
-        del self.coop_graph
-        self.coop_graph = Connection_Graph(self.ap_position, self.connect_threshold)
 
     def calculate_power_allocation(self):
         self.power_gain = np.ones(self.dist_matrix.shape) * (self.ap_trans_gain + self.ap_trans_power)
@@ -346,33 +356,37 @@ class Channel:
         return np.linalg.inv(np.transpose(a.conj()) * a) * np.transpose(a.conj())
 
     def random_action(self, action_type, avail):
+        """
+            :parameter avail: (... x ap x action) action masks, the leading dims are batched (e.g. over games)
+            :return (... x ap) actions of the pattern, invalid ones redrawn uniformly from the valid actions 0-11
+        """
         if not gp.DEBUG:
             raise TypeError("Function only called in Debug Mode")
+        avail = np.asarray(avail, dtype=bool)
+        size = avail.shape[:-1]
         if action_type == 'random':
-            action = np.random.randint(12, size=self.ap_number, dtype=int)
+            action = np.random.randint(12, size=size, dtype=int)
         elif action_type == 'randomnon12':
-            action = np.random.randint(11, size=self.ap_number, dtype=int)
+            action = np.random.randint(11, size=size, dtype=int)
         elif action_type == 'isolate':
-            action = np.ones(self.ap_number, dtype=int) * 12
+            action = np.ones(size, dtype=int) * 12
         elif action_type == 'updown':
-            action = -np.power(-1, np.arange(self.ap_number, dtype=int)) * 3 + 3
+            action = np.broadcast_to(-np.power(-1, np.arange(self.ap_number, dtype=int)) * 3 + 3, size).copy()
         elif action_type == 'double':
-            action = np.random.randint(6, size=self.ap_number, dtype=int) * 2 + 1
+            action = np.random.randint(6, size=size, dtype=int) * 2 + 1
         elif action_type == 'ones':
-            action = np.ones(self.ap_number, dtype=int) * 9
+            action = np.ones(size, dtype=int) * 9
         elif action_type == 'fixed':
-            action = np.array([1, 5, 3, 3, 9, 11, 10, 7, 11, 5, 11, 5, 3, 3, 2, 5, 11, 7, 7, 9], dtype=int)
+            action = np.broadcast_to(np.array([1, 5, 3, 3, 9, 11, 10, 7, 11, 5, 11, 5, 3, 3, 2, 5, 11, 7, 7, 9],
+                                              dtype=int), size).copy()
         else:
             raise TypeError("No such action type")
-        for ap, ap_action in enumerate(avail):
-            if gp.ACTION_NUM == 6:
-                while not ap_action[int((action[ap]-1)/2)]:
-                    new_action = np.random.randint(0, 12)
-                    action[ap] = new_action
-            else:
-                while not ap_action[action[ap]]:
-                    new_action = np.random.randint(0, 12)
-                    action[ap] = new_action
+        # mask entry checked for each action, with 6 actions the pair 2k+1, 2k+2 shares entry k
+        entry = np.maximum(np.arange(13) - 1, 0) // 2 if gp.ACTION_NUM == 6 else np.arange(13)
+        valid = np.take_along_axis(avail, entry[action][..., None], -1)[..., 0]
+        if not valid.all():
+            redraw = action_sampler.uniform(avail[..., entry[:12]]).numpy()
+            action = np.where(valid, action, redraw)
         return action
 
     def set_action(self, ap_action):
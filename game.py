@@ -8,7 +8,7 @@ import torch
 import time
 import copy as cp
 import mymatplotlib as myplt
-from collections import defaultdict, deque
+from collections import defaultdict, deque, namedtuple
 import typing
 
 """
@@ -48,6 +48,10 @@ import typing
         int
 """
 
+# one step of all aps, every field is batched over aps on the first dimension
+StepResult = namedtuple('StepResult', ('state', 'action', 'action_logp', 'avail', 'neighbor_action', 'reward', 'done',
+                                       'overall_reward'))
+
 
 class Decentralized_Game:
     def __init__(self, args):
@@ -64,22 +68,24 @@ class Decentralized_Game:
                                         'zero_forcing'],
                                        "Stronger First", gp.ACCESSPOINT_SPACE * 2 * np.sqrt(3) + 5)
 
-        self.state_buffer = []
         self.history_buffer_length = args.history_length
         if args.history_length <= 1 and args.previous_action_observable:
             raise ValueError("Illegal setting avaliable previous action with less or equal than 1 history length")
         self.history_step = args.multi_step
         self.aps_observation = []
+        self.observation_side = int(self.one_side_length * 2 + 1)
+        # channels of the state handed back by a step, previous action observable only returns the latest frame
+        self.state_channels = gp.OBSERVATION_DIMS if args.previous_action_observable \
+            else gp.OBSERVATION_DIMS * args.history_length
+        self.ap_state = []
+        self.neighbor_indices = None
+        self.crop_geometry = None
+        self.global_observation = None
 
         # ---------reset replay buffer---------#
-        self.state_buffer = []
-        for _ in range(self.environment.ap_number):
-            self.state_buffer.append(deque([], maxlen=self.args.history_length))
-
-        for index in range(self.environment.ap_number):
-            for _ in range(self.history_buffer_length):
-                self.state_buffer[index].append(torch.zeros(gp.OBSERVATION_DIMS, int(self.one_side_length * 2 + 1),
-                                                            int(self.one_side_length * 2 + 1), device=self.args.device))
+        # history frames of all aps in one preallocated tensor, oldest frame first
+        self.state_buffer = torch.zeros(self.environment.ap_number, self.history_buffer_length, gp.OBSERVATION_DIMS,
+                                        self.observation_side, self.observation_side, device=self.args.device)
 
     @staticmethod
     def get_action_size():
@@ -87,25 +93,9 @@ class Decentralized_Game:
 
     def reset(self):
         np.random.seed(int(time.time() % 1 * 10e8))
-        del self.environment
-        self.environment = env.Channel(["square", gp.LENGTH_OF_FIELD, gp.WIDTH_OF_FIELD],
-                                       ["PPP", gp.DENSE_OF_USERS],
-                                       ["Hex", gp.NUM_OF_ACCESSPOINT, gp.ACCESSPOINT_SPACE],
-                                       [gp.ACCESS_POINT_TRANSMISSION_EIRP, 0, gp.AP_TRANSMISSION_CENTER_FREUENCY],
-                                       [gp.ACCESS_POINT_TRANSMISSION_EIRP, 0, gp.AP_TRANSMISSION_CENTER_FREUENCY],
-                                       ["3GPP-InH-LOS", "rayleigh_indirect", False, gp.AP_UE_ALPHA, gp.NAKAGAMI_M,
-                                        'zero_forcing'],
-                                       "Stronger First", gp.ACCESSPOINT_SPACE * 2 * np.sqrt(3) + 5)
-        self.state_buffer = []
+        self.environment.reset()
         self.aps_observation = []
-        self.state_buffer = []
-        for _ in range(self.environment.ap_number):
-            self.state_buffer.append(deque([], maxlen=self.args.history_length))
-
-        for index in range(self.environment.ap_number):
-            for _ in range(self.history_buffer_length):
-                self.state_buffer[index].append(torch.zeros(gp.OBSERVATION_DIMS, int(self.one_side_length * 2 + 1),
-                                                            int(self.one_side_length * 2 + 1), device=self.args.device))
+        self.state_buffer.zero_()
         return False
 
     def plot_grid_map(self, position_list):
@@ -121,6 +111,54 @@ class Decentralized_Game:
         return [torch.tensor(aps_obv, dtype=torch.float32, device=self.args.device) for aps_obv in
                 self.get_observation()]
 
+    def get_neighbor_indices(self):
+        """:return (ap x 7) indices of the neighbors of each ap with itself in the middle, -1 if missing"""
+        if self.neighbor_indices is None:
+            self.neighbor_indices = np.stack([self.environment.coop_graph.neighbor_indices(ap_index, True)
+                                              for ap_index in range(self.environment.ap_number)])
+        return self.neighbor_indices
+
+    def get_replay_geometry(self):
+        """:return shape of one stored frame (c x h x w), neighbors per ap (itself included) and number of aps"""
+        return (gp.OBSERVATION_DIMS, self.observation_side, self.observation_side), \
+               self.get_neighbor_indices().shape[1], self.environment.ap_number
+
+    def get_crop_geometry(self):
+        """:return global field shape (h, w), padding, (ap x 2) padded top left corner of each ap crop and (ap x 2)
+                   padded pixel of each ap"""
+        if self.crop_geometry is None:
+            pad_width = int(math.floor(1 + ((gp.ACCESS_POINTS_FIELD - 1) / 2) / gp.SQUARE_STEP))
+            field_shape = (int(np.floor(self.board_length_l / gp.SQUARE_STEP)),
+                           int(np.floor(self.board_length_w / gp.SQUARE_STEP)))
+            ap_pixels = np.floor(self.environment.ap_position / gp.SQUARE_STEP).astype(int) + pad_width
+            self.crop_geometry = (field_shape, pad_width, ap_pixels - self.one_side_length, ap_pixels)
+        return self.crop_geometry
+
+    def global_state(self, ap_state):
+        """
+            Replay form of a step for --global-frame: the global field of channel 1 is shared by all crops and channel 0
+            of a crop is only non-zero on the ap pixels inside it
+            :return (h x w) unpadded global field of the last observation, (ap x ap) value of every ap pixel in the
+                    channel 0 of each ap state (0 outside its crop)
+        """
+        _, pad_width, offsets, ap_pixels = self.get_crop_geometry()
+        relative = ap_pixels[np.newaxis, :, :] - offsets[:, np.newaxis, :]
+        inside = np.all(np.logical_and(relative >= 0, relative < self.observation_side), axis=2)
+        relative = np.clip(relative, 0, self.observation_side - 1)
+        overlay = ap_state[np.arange(len(offsets))[:, np.newaxis], 0, relative[..., 0], relative[..., 1]]
+        overlay = overlay * torch.as_tensor(inside, dtype=overlay.dtype, device=overlay.device)
+        field = self.global_observation[1, pad_width:-pad_width, pad_width:-pad_width]
+        return torch.tensor(field, dtype=torch.float32), overlay
+
+    def push_observation(self):
+        """:return (ap x history*dims x h x w) tensor, history stacked state of each ap"""
+        for t in range(self.history_buffer_length - 1):
+            self.state_buffer[:, t].copy_(self.state_buffer[:, t + 1])
+        self.state_buffer[:, -1].copy_(torch.from_numpy(np.stack(self.get_observation(), axis=0)))
+        # hand out a copy, the buffer is overwritten in place by later steps and resets
+        return self.state_buffer.reshape(self.environment.ap_number, -1, self.observation_side,
+                                         self.observation_side).clone()
+
     @staticmethod
     def pad_with_zeros(vector, pad_width, iaxis, kwargs):
         pad_value = kwargs.get('padder', 0)
@@ -143,6 +181,7 @@ class Decentralized_Game:
         for index_obs in range(gp.OBSERVATION_DIMS):
             obs_decentral.append(np.pad(obs[index_obs], int(pad_width), self.pad_with_zeros, padder=0))
         obs_decentral = np.stack(obs_decentral, axis=0)
+        self.global_observation = obs_decentral
 
         aps_observation = []
         for ap_index, aps in enumerate(self.environment.ap_position):
@@ -272,7 +311,18 @@ class Decentralized_Game:
                 #     self.state_buffer[ap_index][-1][0][neighbor_ind[0][ind], neighbor_ind[1][ind]] = \
                 #         ap_actual_action[neighbor_enable_non[ind]].item(0) + 1
                 # self.state_buffer[ap_index][-1][0] /= 12
-        return [self.state_buffer[ind][-1] for ind in range(self.environment.ap_number)]
+        return self.state_buffer[:, -1].clone()
+
+    def _step_result(self, ap_state, action, action_logp, avil_action, reward, done, overall_rew):
+        return StepResult(ap_state, action, np.stack(action_logp), avil_action,
+                          np.append(action, [-1])[self.get_neighbor_indices()],
+                          torch.tensor(reward, dtype=torch.float32, device=self.args.device), done, overall_rew)
+
+    def replay_state(self, ap_state):
+        """:return ap states in the form the replay takes them (--global-frame), the replay sparsifies dense states"""
+        if self.args.global_frame:
+            return self.global_state(ap_state)
+        return ap_state
 
     @staticmethod
     def remove_previous_action(state):
@@ -286,19 +336,45 @@ class Decentralized_Game:
             return True
         return False
 
+    def observe(self):
+        """
+            move the channel to the next slot and observe it
+            :return (ap x history*dims x h x w) history stacked state, (ap x action) available actions
+        """
+        avil_action = np.stack(self.environment.established())
+        self.ap_state = self.push_observation()
+        #  TODO: if state dims is two, change this to stack
+        return self.ap_state, avil_action
+
+    def execute(self, action):
+        """
+            :parameter action: actions of all aps for the last observed slot
+            :return state, executed action, hand-shaked action, decentralized reward, done, centralized reward
+        """
+        action = np.array(action)
+        if gp.ACTION_NUM == 6:
+            action_re = action * 2 + 1
+        else:
+            action_re = action
+
+        actual_action = self.environment.set_action(action_re)
+        sinr = self.environment.sinr_calculation()
+        overall_rew = self.environment.centralized_reward(sinr)
+        reward = self.environment.decentralized_reward_exclude_central(sinr, actual_action)
+
+        ap_state = self.ap_state
+        if self.args.previous_action_observable:
+            ap_state = self.add_previous_action(ap_state, actual_action)
+        return ap_state, action_re, actual_action, reward, self.end_game(), overall_rew
+
     def step(self, accesspoint=None, epsilon=0):
         """
             :parameter accesspoint: the models of access points
             :parameter accesspoint: the models of scheduler
             :parameter result_prob: output of network, with estimate weight of tiles for transmission
+            :return StepResult batched over aps
         """
-
-        avil_action = self.environment.established()
-
-        for index, tensor_obs in enumerate(self.get_observation_tensor()):
-            self.state_buffer[index].append(tensor_obs)
-        ap_state = [torch.cat(list(aps_obv), dim=0) for aps_obv in self.state_buffer]
-        #  TODO: if state dims is two, change this to stack
+        ap_state, avil_action = self.observe()
 
         action = []
         action_logp = []
@@ -317,19 +393,8 @@ class Decentralized_Game:
                     action.append(action_ret[0])
                     action_logp.append(action_ret[1])
                 # Choose an action greedily (with noisy weights)
-        action = np.array(action)
-        if gp.ACTION_NUM == 6:
-            action_re = action * 2 + 1
-        else:
-            action_re = action
 
-        actual_action = self.environment.set_action(action_re)
-        sinr = self.environment.sinr_calculation()
-        overall_rew = self.environment.centralized_reward(sinr)
-        reward = self.environment.decentralized_reward_exclude_central(sinr, actual_action)
-
-        if self.args.previous_action_observable:
-            ap_state = self.add_previous_action(ap_state, actual_action)
+        ap_state, action_re, actual_action, reward, done, overall_rew = self.execute(action)
 
         if np.random.rand() < 0.05:
             print(reward, action_re, actual_action)
@@ -337,22 +402,16 @@ class Decentralized_Game:
             #                           self.environment.coop_graph.hand_shake_result,
             #                           self.environment.user_position)
 
-        return ap_state, action_re, action_logp, avil_action, \
-               [torch.tensor(dec_rew).to(device=self.args.device) for dec_rew in reward], self.end_game(), overall_rew
+        return self._step_result(ap_state, action_re, action_logp, avil_action, reward, done, overall_rew)
 
     def step_p(self, accesspoint=None):
         """
             :parameter accesspoint: the models of access points
             :parameter accesspoint: the models of scheduler
             :parameter result_prob: output of network, with estimate weight of tiles for transmission
+            :return StepResult batched over aps
         """
-        avil_action = self.environment.established()
-
-        for index, tensor_obs in enumerate(self.get_observation_tensor()):
-            self.state_buffer[index].append(tensor_obs)
-
-        ap_state = [torch.cat(list(aps_obv), dim=0) for aps_obv in self.state_buffer]
-        #  TODO: if state dims is two, change this to stack
+        ap_state, avil_action = self.observe()
 
         action = []
         action_logp = []
@@ -361,8 +420,10 @@ class Decentralized_Game:
             action_logp = [np.zeros(gp.ACTION_NUM) for _ in range(self.environment.ap_number)]
         else:
             # avil_action = [avil_action[ind][1::2] for ind in range(len(avil_action))]
+            # all aps' requests go out before the first answer is read, so the server can batch them
             for index, pipe in enumerate(accesspoint):
                 pipe.send((ap_state[index], avil_action[index]))
+            for pipe in accesspoint:
                 action_ret = pipe.recv()
                 if type(action_ret) is int:
                     action.append(action_ret)
@@ -371,22 +432,10 @@ class Decentralized_Game:
                     action.append(action_ret[0])
                     action_logp.append(action_ret[1])
                 # Choose an action greedily (with noisy weights)
-        action = np.array(action)
-        if gp.ACTION_NUM == 6:
-            action_re = action * 2 + 1
-        else:
-            action_re = action
-
-        actual_action = self.environment.set_action(action_re)
-        sinr = self.environment.sinr_calculation()
-        overall_rew = self.environment.centralized_reward(sinr)
-        reward = self.environment.decentralized_reward_exclude_central(sinr, actual_action)
 
-        if self.args.previous_action_observable:
-            ap_state = self.add_previous_action(ap_state, actual_action)
+        ap_state, action_re, _, reward, done, overall_rew = self.execute(action)
 
-        return ap_state, action_re, action_logp, avil_action, \
-               [torch.tensor(dec_rew).to(device=self.args.device) for dec_rew in reward], self.end_game(), overall_rew
+        return self._step_result(ap_state, action_re, action_logp, avil_action, reward, done, overall_rew)
 
     def close(self):
         del self.environment.coop_graph
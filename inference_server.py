@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import time
+from multiprocessing.connection import wait
+
+import numpy as np
+import torch
+
+from stats import Stats
+
+"""
+    Answers the action requests of evaluation workers in batches. Every worker holds one pipe per ap and sends
+    (state, avail) on it, the server collects requests from all workers and aps until max_batch of them are pending
+    or max_wait seconds passed since the first one, runs one act_boltzmann_batch per ap and sends every worker its
+    result. A worker closes its pipe of an ap by sending (np.array([False]), np.array([False])).
+    1) server = InferenceServer(agents, pipes, max_batch=0, max_wait=0.002):
+        pipes: (worker x ap) parent ends of the pipes, max_batch 0 waits for one request per pipe
+    2) server.serve():
+        answer requests until every pipe is closed
+    3) server.summary():
+        return dict of the stats (requests, batches, forward seconds, batch size and latency histograms)
+        and the requests per second
+"""
+
+
+class InferenceServer:
+    def __init__(self, agents, pipes, max_batch=0, max_wait=0.002):
+        self.agents = agents
+        self.ap = {pipe: ap for row in pipes for ap, pipe in enumerate(row)}  # ap of every pipe
+        self.open = set(self.ap)
+        self.max_batch = max_batch if max_batch > 0 else len(self.ap)
+        self.max_wait = max_wait
+        self.stats = Stats()
+
+    def _receive(self, ready, pending):
+        for pipe in ready:
+            if len(pending) >= self.max_batch:
+                break  # the rest stay ready for the next batch
+            try:
+                obs, avail = pipe.recv()
+            except EOFError:
+                obs = None
+            if obs is None or type(obs) is np.ndarray:  # worker is done with this ap
+                pipe.close()
+                self.open.discard(pipe)
+                continue
+            pending[pipe] = (obs, avail, time.perf_counter())
+
+    def _answer(self, pending):
+        by_ap = {}
+        for pipe, request in pending.items():
+            by_ap.setdefault(self.ap[pipe], []).append((pipe, request))
+        started = time.perf_counter()
+        for ap, requests in by_ap.items():
+            states = torch.stack([obs for _, (obs, _, _) in requests])
+            avails = np.stack([np.asarray(avail) for _, (_, avail, _) in requests])
+            results = self.agents[ap].act_boltzmann_batch(states, avails)
+            self.stats.observe('batch_size', len(requests))
+            for (pipe, _), result in zip(requests, results):
+                pipe.send(result)
+        answered = time.perf_counter()
+        self.stats.count('forward_seconds', answered - started)
+        self.stats.count('batches', len(by_ap))
+        self.stats.count('requests', len(pending))
+        self.stats.observe('latency_ms', [(answered - received) * 1e3 for _, _, received in pending.values()])
+
+    def serve(self):
+        with torch.no_grad():
+            while self.open:
+                pending = {}
+                self._receive(wait(list(self.open)), pending)  # block for the first request
+                deadline = time.perf_counter() + self.max_wait
+                while len(pending) < self.max_batch:
+                    # a worker sends its next request only after the answer, so answered pipes are not waited on
+                    idle = [pipe for pipe in self.open if pipe not in pending]
+                    remaining = deadline - time.perf_counter()
+                    if not idle or remaining <= 0:
+                        break
+                    ready = wait(idle, remaining)
+                    if not ready:
+                        break
+                    self._receive(ready, pending)
+                if pending:
+                    self._answer(pending)
+
+    def summary(self):
+        summary = self.stats.summary()
+        summary['requests_per_second'] = summary['counters'].get('requests', 0) / max(summary['seconds'], 1e-9)
+        return summary
@@ -2,108 +2,581 @@
 from __future__ import division
 
 import copy
+import json
+import os
+import queue
+import threading
+import time
 from collections import namedtuple
+from multiprocessing import shared_memory
 import numpy as np
 import torch
 import GLOBAL_PRARM as gp
+import sparse_obs
+from stats import Histogram, Stats, dump_jsonl
 
 scale_factor = 255
-Transition_dtype = np.dtype([('timestep', np.int32), ('state', np.uint8, (2, 47, 47)),
-                             ('action', np.int8), ('action_logp', np.float, (gp.ACTION_NUM)),
-                             ('neighbor_action', np.int8, (6 + 1)),
-                             ('global_action', np.int8, (gp.NUM_OF_ACCESSPOINT)),
-                             ('avail', np.bool, (gp.ACTION_NUM)),
-                             ('reward', np.float32), ('nonterminal', np.bool_)])
-blank_trans_aps = (0, np.zeros((2, 47, 47), dtype=np.uint8), 0, np.zeros(gp.ACTION_NUM),
-                   np.ones(7, dtype=np.int8),
-                   np.ones(gp.NUM_OF_ACCESSPOINT, dtype=np.int8), np.ones(gp.ACTION_NUM, dtype=np.bool), 0.0, False)
-
-
-# Segment tree data structure where parent node values are sum/max of children node values
+# What a game stores per step: the shape of one frame (c x h x w), the neighbors of an ap (itself included) and the
+# aps of the topology, see Decentralized_Game.get_replay_geometry
+ReplayGeometry = namedtuple('ReplayGeometry', ('state_shape', 'neighbor_number', 'ap_number'))
+default_geometry = ReplayGeometry((2, 47, 47), 6 + 1, gp.NUM_OF_ACCESSPOINT)  # The stock GLOBAL_PRARM configuration
+state_shape = default_geometry.state_shape
+
+
+def dense_transition_layout(geometry=default_geometry):
+    """:return transition dtype and blank transition storing the quantised dense state of the given geometry"""
+    state_shape, neighbor_number, ap_number = geometry
+    dtype = np.dtype([('timestep', np.int32), ('state', np.uint8, tuple(state_shape)),
+                      ('action', np.int8), ('action_logp', np.float, (gp.ACTION_NUM)),
+                      ('neighbor_action', np.int8, (neighbor_number)),
+                      ('global_action', np.int8, (ap_number)),
+                      ('avail', np.bool, (gp.ACTION_NUM)),
+                      ('reward', np.float32), ('nonterminal', np.bool_)])
+    blank = (0, np.zeros(state_shape, dtype=np.uint8), 0, np.zeros(gp.ACTION_NUM),
+             np.ones(neighbor_number, dtype=np.int8),
+             np.ones(ap_number, dtype=np.int8), np.ones(gp.ACTION_NUM, dtype=np.bool), 0.0, False)
+    return dtype, blank
+
+
+Transition_dtype, blank_trans_aps = dense_transition_layout()
+# Stored once per step for all agents
+shared_fields = ('timestep', 'frame', 'global_action', 'nonterminal', 'episode_end', 'bootstrap')
+# Maintained by the store at append time: steps to the next episode start (n + 1 if none within n), n-step return
+# and mask of a non-terminal bootstrap state n steps ahead
+return_fields = (('episode_end', np.int16), ('nstep_return', np.float32), ('bootstrap', np.bool_))
+
+
+# A drawn batch before the average reward offset and the importance weights are applied
+SampleBatch = namedtuple('SampleBatch', ('probs', 'p_total', 'p_min', 'capacity', 'idxs', 'tree_idxs', 'state',
+                                         'action', 'action_logp', 'neighbor_action', 'global_action', 'avail',
+                                         'returns', 'next_state', 'nonterminal'))
+
+
+def _to_numpy(value):
+    return value.detach().cpu().numpy() if torch.is_tensor(value) else np.asarray(value)
+
+
+def sparse_transition_layout(nnz, geometry=default_geometry):
+    """:return transition dtype and blank transition storing the state as nnz padded (index, value) pairs"""
+    size = int(np.prod(geometry.state_shape))
+    base_dtype, base_blank = dense_transition_layout(geometry)
+    fields = []
+    for field in base_dtype.descr:
+        if field[0] == 'state':
+            fields.extend([('state_index', sparse_obs.index_dtype(size), (nnz,)), ('state_value', np.float16, (nnz,))])
+        else:
+            fields.append(field)
+    blank_index, blank_value = sparse_obs.blank_sparse(nnz, size)
+    blank = base_blank[0:1] + (blank_index, blank_value) + base_blank[2:]
+    return np.dtype(fields), blank
+
+
+def global_frame_transition_layout(field_shape, agent_number, geometry=default_geometry):
+    """:return transition dtype and blank transition storing the global field once per step and an ap overlay"""
+    base_dtype, base_blank = dense_transition_layout(geometry)
+    fields = []
+    for field in base_dtype.descr:
+        if field[0] == 'state':
+            fields.extend([('frame', np.uint8, tuple(field_shape)), ('overlay', np.int8, (agent_number,))])
+        else:
+            fields.append(field)
+    blank = base_blank[0:1] + (np.zeros(field_shape, dtype=np.uint8), np.zeros(agent_number, dtype=np.int8)) \
+            + base_blank[2:]
+    return np.dtype(fields), blank
+
+
+qos_bits = 4  # Quantisation of the qos channel in the compact layout
+sample_retries = 8  # Redraws of invalid strata before falling back to valid draws of the batch
+
+
+def packed_size(size, bits):
+    return -(-size * bits // 8)
+
+
+def _pack_bits(codes, bits):
+    """Packs (... x n) codes of the given bit width into (... x packed_size(n, bits)) uint8, lowest bits first"""
+    per_byte = 8 // bits
+    codes = np.asarray(codes, dtype=np.uint8)
+    pad = -codes.shape[-1] % per_byte
+    codes = np.concatenate([codes, np.zeros(codes.shape[:-1] + (pad,), dtype=np.uint8)], axis=-1)
+    codes = codes.reshape(codes.shape[:-1] + (-1, per_byte)) << (np.arange(per_byte, dtype=np.uint8) * bits)
+    return np.bitwise_or.reduce(codes, axis=-1)
+
+
+def _unpack_bits(packed, bits, size):
+    """Inverse of _pack_bits for a uint8 tensor, :return (... x size) int64 codes"""
+    shift = torch.arange(0, 8, bits, device=packed.device)
+    codes = (packed.long().unsqueeze(-1) >> shift) & (2 ** bits - 1)
+    return codes.reshape(*packed.shape[:-1], -1)[..., :size]
+
+
+def compact_transition_layout(geometry=default_geometry):
+    """
+        :return transition dtype and blank transition with the action channel packed to 2 bits, the qos channel
+                quantised to qos_bits, float16 log probabilities and the action mask as a bitmask
+    """
+    size = geometry.state_shape[1] * geometry.state_shape[2]
+    base_dtype, base_blank = dense_transition_layout(geometry)
+    fields = []
+    for field in base_dtype.descr:
+        if field[0] == 'state':
+            fields.extend([('state_marks', np.uint8, (packed_size(size, 2),)),
+                           ('state_qos', np.uint8, (packed_size(size, qos_bits),))])
+        elif field[0] == 'action_logp':
+            fields.append(('action_logp', np.float16, (gp.ACTION_NUM,)))
+        elif field[0] == 'avail':
+            fields.append(('avail', np.uint16))
+        else:
+            fields.append(field)
+    blank = base_blank[0:1] + (np.zeros(packed_size(size, 2), dtype=np.uint8),
+                               np.zeros(packed_size(size, qos_bits), dtype=np.uint8)) + base_blank[2:]
+    blank = blank[:7] + (2 ** gp.ACTION_NUM - 1,) + blank[8:]  # blank mask has every action available
+    return np.dtype(fields), blank
+
+
+def symmetry_tables():
+    """
+        Symmetries of the hex field used for data reinforcement: identity, 180 degree rotation, rotation + flip, flip.
+        All of them are involutions, so each table is its own inverse.
+        :return (4 x action) table for stored actions / action masks, (4 x 14) table for raw actions shifted by one
+                (column 0 is the -1 padding)
+    """
+    raw = np.arange(12)
+    rot = (raw + 6) % 12
+    flip = (6 - raw) % 12
+    raw_perm = np.stack([raw, rot, flip[rot], flip])
+    raw_perm = np.concatenate([raw_perm, np.full((4, 1), 12)], axis=1)  # isolated action stays isolated
+    raw_table = np.concatenate([np.full((4, 1), -1), raw_perm], axis=1)
+    if gp.ACTION_NUM == 6:
+        action_table = (raw_perm[:, 1:12:2] - 1) // 2
+    else:
+        action_table = raw_perm
+    return action_table, raw_table
+
+
+_augment_tables = {}  # (device, state shape) -> tables of symmetry_tables and the pixel permutations, built once
+
+
+def augment_tables(device, state_shape):
+    """:return action, raw action and (4 x h*w) pixel permutation tensors on device, shared by all memories"""
+    key = (str(device), tuple(state_shape))
+    if key not in _augment_tables:
+        action_table, raw_table = symmetry_tables()
+        pixels = torch.arange(state_shape[1] * state_shape[2], device=device).view(state_shape[1:])
+        pixel_table = torch.stack([pixels, pixels.flip([0, 1]), pixels.flip([1]), pixels.flip([0])]).view(4, -1)
+        _augment_tables[key] = (torch.tensor(action_table, dtype=torch.int64, device=device),
+                                torch.tensor(raw_table, dtype=torch.int64, device=device), pixel_table)
+    return _augment_tables[key]
+
+
+# Columnar cyclic storage of transitions: one (capacity x agent) array per field, written for all agents at once
+# With a path the columns are np.memmap .npy files in that directory, reopened (with their write head) if they exist
+# Shared columns live in multiprocessing.shared_memory segments, other processes write reserved rows in place
+class TransitionStore():
+    def __init__(self, capacity, agent_number, dtype=Transition_dtype, blank_trans=blank_trans_aps, path=None,
+                 crop_geometry=None, multi_step=1, discount=1.0, shared=False, geometry=default_geometry):
+        if shared and path is not None:
+            raise ValueError("A replay is either memory-mapped or in shared memory")
+        self.index = 0
+        self.capacity = capacity
+        self.agent_number = agent_number
+        self.full = False  # Used to track actual capacity
+        self.t = 0  # Internal episode timestep counter, shared by all agents
+        self.n = multi_step
+        self.discount = discount
+        self.steps = 0  # Steps ever appended, used by incremental snapshots
+        self.lock = threading.RLock()  # Serialises writes with draws of background samplers
+        self.stats = Stats()  # Appends and snapshots, shared by all agents
+        self.crop_geometry = crop_geometry  # Where the ap crops sit in a stored global field (--global-frame)
+        self.state_shape = tuple(geometry.state_shape)  # One decoded frame, whatever the layout stores
+        self.path = path
+        self.segments = {} if shared else None  # Shared memory segment of each column
+        self.owner = shared  # Only the creating process unlinks the segments
+        self.reopened = path is not None and os.path.exists(os.path.join(path, 'replay.json'))
+        self.columns, self.blank, self.field_shape = {}, {}, {}
+        for name, value in zip(dtype.names, blank_trans):
+            field = dtype.fields[name][0]
+            self.field_shape[name] = field.shape
+            self.blank[name] = np.asarray(value, dtype=field.base)
+        self.state_fields = [name for name in dtype.names if name == 'state' or name not in Transition_dtype.names]
+        for name, field_dtype in return_fields:
+            self.field_shape[name] = ()
+            self.blank[name] = np.zeros((), dtype=field_dtype)
+        if self.reopened:
+            self._reopen()
+        else:
+            for name in self.field_shape:
+                self.columns[name] = self._new_column(name, self.blank[name].dtype)
+                self.columns[name][...] = self.blank[name]
+            self.flush()
+        self._bind_tensors()
+
+    def nbytes(self):
+        """:return bytes held by each column"""
+        return {name: int(column.nbytes) for name, column in self.columns.items()}
+
+    def _column_shape(self, name):
+        leading = (self.capacity,) if name in shared_fields else (self.capacity, self.agent_number)
+        return leading + self.field_shape[name]
+
+    def _new_column(self, name, dtype):
+        if self.segments is not None:
+            shape = self._column_shape(name)
+            self.segments[name] = shared_memory.SharedMemory(create=True, size=max(
+                int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+            return np.ndarray(shape, dtype=dtype, buffer=self.segments[name].buf)
+        if self.path is None:
+            return np.empty(self._column_shape(name), dtype=dtype)
+        os.makedirs(self.path, exist_ok=True)
+        return np.lib.format.open_memmap(os.path.join(self.path, name + '.npy'), mode='w+', dtype=dtype,
+                                         shape=self._column_shape(name))
+
+    # Torch views sharing memory with the columns, uint16 bitmasks are viewed as int16 (torch has no uint16)
+    def _bind_tensors(self):
+        def as_tensor(value):
+            return torch.from_numpy(value.view(np.int16) if value.dtype == np.uint16 else value)
+        self.tensors = {name: as_tensor(column) for name, column in self.columns.items()}
+        self.blank_tensors = {name: as_tensor(value) for name, value in self.blank.items()}
+
+    def _reopen(self):
+        with open(os.path.join(self.path, 'replay.json'), 'r') as meta_file:
+            meta = json.load(meta_file)
+        # directories written before the dtypes were recorded are checked against the .npy headers only
+        dtypes = self._dtypes()
+        if meta['capacity'] != self.capacity or meta['agent_number'] != self.agent_number or \
+                sorted(meta['fields']) != sorted(self.field_shape) or meta.get('dtypes', dtypes) != dtypes:
+            raise ValueError("Replay at " + self.path + " was created with another capacity or layout")
+        for name in self.field_shape:
+            self.columns[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r+')
+            if self.columns[name].shape != self._column_shape(name) or \
+                    self.columns[name].dtype != self.blank[name].dtype:
+                raise ValueError("Replay at " + self.path + " was created with another capacity or layout")
+        self.index, self.full, self.t, self.steps = meta['index'], meta['full'], meta['t'], meta['steps']
+
+    # Dtype descr of every column, recorded with a memory-mapped store so another layout is not reinterpreted
+    def _dtypes(self):
+        return {name: np.lib.format.dtype_to_descr(self.blank[name].dtype) for name in self.field_shape}
+
+    # Writes memory-mapped columns and the write head to disk, nothing to do for an in-RAM store
+    def flush(self):
+        if self.path is None:
+            return
+        for column in self.columns.values():
+            column.flush()
+        meta = {'capacity': self.capacity, 'agent_number': self.agent_number, 'index': self.index,
+                'full': self.full, 't': self.t, 'steps': self.steps, 'fields': list(self.field_shape),
+                'dtypes': self._dtypes()}
+        with open(os.path.join(self.path, 'replay.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+    # A memory-mapped store pickles as its directory and reopens its files on load, a shared one as its segment names
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock'], state['tensors'], state['blank_tensors']
+        if self.path is not None:
+            self.flush()
+            state['columns'] = None
+        if self.segments is not None:
+            state['columns'] = None
+            state['segments'] = {name: segment.name for name, segment in self.segments.items()}
+            state['owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        if self.path is not None:
+            self.columns = {name: np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r+')
+                            for name in self.field_shape}
+        if self.segments is not None:
+            self.segments = {name: shared_memory.SharedMemory(name=segment) for name, segment in self.segments.items()}
+            self.columns = {name: np.ndarray(self._column_shape(name), dtype=self.blank[name].dtype,
+                                             buffer=self.segments[name].buf) for name in self.field_shape}
+        self._bind_tensors()
+
+    # Detaches from the shared memory segments, the creating store also frees them
+    def close(self):
+        if self.segments is None:
+            return
+        self.columns, self.tensors = {}, {}  # the segments cannot close while arrays still point into them
+        for segment in self.segments.values():
+            segment.close()
+            if self.owner:
+                segment.unlink()
+        self.segments = {}
+
+    # Episode timestep of each of a run of steps, restarting after every terminal step
+    def _timesteps(self, terminal, t):
+        steps = np.arange(len(terminal))
+        restart = np.zeros(len(terminal), dtype=np.bool_)
+        restart[1:] = terminal[:-1]
+        start = np.maximum.accumulate(np.where(restart, steps, 0))
+        return np.where(start == 0, t + steps, steps - start)
+
+    # Pads sparse rows, state is a (nested) sequence of (index, value) pairs or dense tensors
+    def _sparse_rows(self, state):
+        width, size = self.field_shape['state_index'][0], int(np.prod(self.state_shape))
+        if type(state) is tuple:
+            return sparse_obs.pad_sparse(*state, width, size)
+        if torch.is_tensor(state) and state.dim() == len(self.state_shape):
+            return sparse_obs.pad_sparse(*sparse_obs.to_sparse(state), width, size)
+        rows = [self._sparse_rows(row) for row in state]
+        return np.stack([row[0] for row in rows]), np.stack([row[1] for row in rows])
+
+    # Turns steps x agents into column values, states quantised (or sparsified) in one op, t is the episode timestep
+    # of the first step
+    def _encode(self, state, action, action_logp, nei_action, glob_action, avail, reward, terminal, t):
+        terminal = _to_numpy(terminal).astype(np.bool_)
+        data = {'timestep': self._timesteps(terminal, t), 'nonterminal': np.logical_not(terminal),
+                'action': _to_numpy(action), 'action_logp': _to_numpy(action_logp),
+                'neighbor_action': _to_numpy(nei_action), 'global_action': _to_numpy(glob_action),
+                'avail': _to_numpy(avail), 'reward': _to_numpy(reward)}
+        if gp.ACTION_NUM == 6:
+            data['action'] = ((data['action'] - 1) / 2).astype(int)
+        if self.columns['avail'].dtype == np.uint16:
+            data['avail'] = np.sum(data['avail'].astype(np.uint16) << np.arange(gp.ACTION_NUM, dtype=np.uint16),
+                                   axis=-1, dtype=np.uint16)
+        if 'frame' in self.columns:
+            frame, overlay = state
+            frame = torch.as_tensor(frame).detach().to(dtype=torch.float32, device=torch.device('cpu'))
+            data['frame'] = frame.mul(scale_factor).to(dtype=torch.uint8).numpy()
+            data['overlay'] = _to_numpy(overlay).astype(np.int8)
+        elif 'state_index' in self.columns:
+            data['state_index'], data['state_value'] = self._sparse_rows(state)
+        elif 'state_marks' in self.columns:
+            state = torch.as_tensor(state).detach().to(dtype=torch.float32, device=torch.device('cpu'))
+            marks = torch.round(state[..., 0, :, :] + 1).to(torch.uint8)  # -1/0/1 -> 0/1/2
+            qos = torch.round(state[..., 1, :, :].clamp(0, 1) * (2 ** qos_bits - 1)).to(torch.uint8)
+            data['state_marks'] = _pack_bits(marks.reshape(*marks.shape[:-2], -1).numpy(), 2)
+            data['state_qos'] = _pack_bits(qos.reshape(*qos.shape[:-2], -1).numpy(), qos_bits)
+        else:
+            state_clip = torch.as_tensor(state).detach().to(dtype=torch.float32, device=torch.device('cpu')).clone()
+            state_clip[..., 0, :, :] = (state_clip[..., 0, :, :] + 1) / 2
+            data['state'] = state_clip.mul_(scale_factor).to(dtype=torch.uint8).numpy()
+        return data
+
+    # Stores a run of steps of every agent (steps x agents x ...), returns the data indices written
+    def append_batch(self, state, action, action_logp, nei_action, glob_action, avail, reward, terminal):
+        start = time.perf_counter()
+        data = self._encode(state, action, action_logp, nei_action, glob_action, avail, reward, terminal, self.t)
+        steps = len(data['timestep'])
+        if steps > self.capacity:
+            raise ValueError("Cannot append more steps than the memory capacity at once")
+        indices = (self.index + np.arange(steps)) % self.capacity
+        for name, value in data.items():
+            self.columns[name][indices] = value
+        self._advance(indices)
+        self.stats.observe('append_seconds', time.perf_counter() - start)
+        return indices
+
+    # Moves the write head over rows just written at the head
+    def _advance(self, indices):
+        self._update_returns(indices)
+        last = indices[-1]
+        self.t = int(self.columns['timestep'][last]) + 1 if self.columns['nonterminal'][last] else 0  # New episode: 0
+        self.index = (self.index + len(indices)) % self.capacity  # Update index
+        self.full = self.full or self.index < len(indices)  # Save when capacity reached
+        self.steps += len(indices)
+        self.stats.count('append_steps', len(indices))
+
+    def reserve(self, counts):
+        """:return consecutive data indices after the write head for runs of counts steps, one per writer process"""
+        if sum(counts) > self.capacity:
+            raise ValueError("Cannot reserve more steps than the memory capacity at once")
+        starts = self.index + np.cumsum([0] + list(counts[:-1]))
+        return [(start + np.arange(count)) % self.capacity for start, count in zip(starts, counts)]
+
+    def write(self, indices, state, action, action_logp, nei_action, glob_action, avail, reward, terminal):
+        """Writes a run of steps into reserved rows, from any process sharing the store, the run starts an episode"""
+        data = self._encode(state, action, action_logp, nei_action, glob_action, avail, reward, terminal, 0)
+        if len(data['timestep']) != len(indices):
+            raise ValueError("Run does not match the reserved rows")
+        for name, value in data.items():
+            self.columns[name][indices] = value
+
+    def commit(self, runs):
+        """Moves the write head over reserved runs written by other processes, in reservation order"""
+        for indices in runs:
+            self._advance(indices)
+
+    # Initialises the return fields of new rows and adds their rewards to the n rows before them
+    def _update_returns(self, indices):
+        run = max(self.capacity - self.n, 1)
+        if len(indices) > run:  # a longer run would add rewards to its own last rows around the ring
+            for start in range(0, len(indices), run):
+                self._update_returns(indices[start:start + run])
+            return
+        episode_end, nstep_return = self.columns['episode_end'], self.columns['nstep_return']
+        reward = self.columns['reward'][indices]
+        episode_end[indices] = self.n + 1
+        nstep_return[indices] = 0
+        self.columns['bootstrap'][indices] = False
+        starts = indices[self.columns['timestep'][indices] == 0]
+        for k in range(1, self.n + 1):
+            rows = (starts - k) % self.capacity
+            episode_end[rows] = np.minimum(episode_end[rows], k)
+        for k in range(self.n):
+            # the reward k steps after a row only counts if no episode started in between
+            rows = (indices - k) % self.capacity
+            open_rows = episode_end[rows] > k
+            nstep_return[rows[open_rows]] += self.discount ** k * reward[open_rows]
+        rows = (indices - self.n) % self.capacity
+        self.columns['bootstrap'][rows] = np.logical_and(self.columns['nonterminal'][indices],
+                                                         episode_end[rows] > self.n)
+
+    def rebuild_returns(self, multi_step, discount):
+        """Recomputes the return fields of all stored rows for another n-step length or discount"""
+        with self.lock:
+            self.n, self.discount = multi_step, discount
+            for name, _ in return_fields:
+                self.columns[name][...] = self.blank[name]
+            count = self.capacity if self.full else self.index
+            # oldest first as they were appended, the rows before the oldest are the newest and reset later
+            self._update_returns((self.index - count + np.arange(count)) % self.capacity)
+
+    # Stores one step of every agent, returns the data index written
+    def append(self, state, action, action_logp, nei_action, glob_action, avail, reward, terminal):
+        if type(state) is tuple:
+            state = tuple(torch.as_tensor(field).unsqueeze(0) for field in state)
+        else:
+            state = [state] if type(state) is list else torch.as_tensor(state).unsqueeze(0)
+        return self.append_batch(state, *[np.expand_dims(_to_numpy(value), 0) for value in
+                                          (action, action_logp, nei_action, glob_action, avail, reward, terminal)])[0]
+
+    # Gathers the fields (all by default) at the given data indices with one index_select per field, agent is an int
+    # or an array broadcast against idxs. Tensors of out are reused as outputs when they have the right shape.
+    def gather(self, idxs, agent, fields=None, out=None):
+        out = {} if out is None else out
+        idxs = np.asarray(idxs) % self.capacity
+        shared_index = torch.from_numpy(idxs.reshape(-1))
+        agent_idxs = idxs * self.agent_number + agent  # rows of the (capacity * agents) flattened columns
+        agent_index = torch.from_numpy(agent_idxs.reshape(-1))
+        batch = {}
+        for name in (self.tensors if fields is None else fields):
+            if name in shared_fields:
+                source, index, shape = self.tensors[name], shared_index, idxs.shape + self.field_shape[name]
+            else:
+                source, index = self.tensors[name].flatten(0, 1), agent_index
+                shape = agent_idxs.shape + self.field_shape[name]
+            if name not in out or tuple(out[name].shape) != shape:
+                out[name] = torch.empty(shape, dtype=source.dtype)
+            torch.index_select(source, 0, index, out=out[name].view(-1, *self.field_shape[name]))
+            batch[name] = out[name]
+        return batch
+
+    # Overwrites masked entries with the blank transition, mask covers the trailing index dimensions
+    def blank_out(self, transitions, blank_mask):
+        blank_mask = torch.as_tensor(blank_mask)
+        for name, value in transitions.items():
+            leading = value.ndim - len(self.field_shape[name]) - blank_mask.ndim
+            value[(slice(None),) * leading + (blank_mask,)] = self.blank_tensors[name]
+
+
+# Segment tree data structure where parent node values are sum/min of children node values
+# Flat arrays with all leaves on the last level, updates and searches walk the levels in a loop
 class SegmentTree():
     def __init__(self, size):
-        self.index = 0
         self.size = size
-        self.full = False  # Used to track actual capacity
-        self.tree_start = 2 ** (size - 1).bit_length() - 1  # Put all used node leaves on last tree level
-        self.sum_tree = np.zeros((self.tree_start + self.size,), dtype=np.float32)
-        self.data = np.array([blank_trans_aps] * size, dtype=Transition_dtype)  # Build structured array
+        self.depth = (size - 1).bit_length()
+        self.tree_start = 2 ** self.depth - 1  # Put all used node leaves on last tree level
+        self.sum_tree = np.zeros((2 * self.tree_start + 1,), dtype=np.float32)
+        self.min_tree = np.full((2 * self.tree_start + 1,), np.inf, dtype=np.float32)  # Unused leaves never win
         self.max = 1  # Initial max value to return (1 = 1^ω)
 
-    # Updates nodes values from current tree
-    def _update_nodes(self, indices):
-        children_indices = indices * 2 + np.expand_dims([1, 2], axis=1)
-        self.sum_tree[indices] = np.sum(self.sum_tree[children_indices], axis=0)
-
-    # Propagates changes up tree given tree indices
+    # Recomputes the parents of the given tree indices level by level up to the root
     def _propagate(self, indices):
-        parents = (indices - 1) // 2
-        unique_parents = np.unique(parents)
-        self._update_nodes(unique_parents)
-        if parents[0] != 0:
-            self._propagate(parents)
-
-    # Propagates single value up tree given a tree index for efficiency
-    def _propagate_index(self, index):
-        parent = (index - 1) // 2
-        left, right = 2 * parent + 1, 2 * parent + 2
-        self.sum_tree[parent] = self.sum_tree[left] + self.sum_tree[right]
-        if parent != 0:
-          self._propagate_index(parent)
-
-    # Updates values given tree indices
+        for _ in range(self.depth):
+            indices = (indices - 1) // 2
+            left = 2 * indices + 1
+            # duplicated parents are recomputed from the same children, so they get the same value
+            self.sum_tree[indices] = self.sum_tree[left] + self.sum_tree[left + 1]
+            self.min_tree[indices] = np.minimum(self.min_tree[left], self.min_tree[left + 1])
+
+    # Updates values given tree indices, the last value wins for duplicated indices
     def update(self, indices, values):
+        indices = np.asarray(indices, dtype=np.int64)
+        values = np.broadcast_to(np.asarray(values, dtype=np.float32), indices.shape)
+        if indices.size == 0:
+            return
+        indices, last = np.unique(indices[::-1], return_index=True)
+        values = values[::-1][last]
         self.sum_tree[indices] = values  # Set new values
+        self.min_tree[indices] = values
         self._propagate(indices)  # Propagate values
-        current_max_value = np.max(values)
-        self.max = max(current_max_value, self.max)
+        self.max = max(float(np.max(values)), self.max)
 
-    # Updates single value given a tree index for efficiency
+    # Updates single value given a tree index
     def _update_index(self, index, value):
-        self.sum_tree[index] = value  # Set new value
-        self._propagate_index(index)  # Propagate value
-        self.max = max(value, self.max)
-
-    def append(self, data, value):
-        self.data[self.index] = data  # Store data in underlying data structure
-        self._update_index(self.index + self.tree_start, value)  # Update tree
-        self.index = (self.index + 1) % self.size  # Update index
-        self.full = self.full or self.index == 0  # Save when capacity reached
-        self.max = max(value, self.max)
-
-    # Searches for the location of a value in sum tree
-    def _retrieve(self, indices, values):
-        children_indices = (indices * 2 + np.expand_dims([1, 2], axis=1))  # Make matrix of children indices
-        # If indices correspond to leaf nodes, return them
-        if children_indices[0, 0] >= self.sum_tree.shape[0]:
-            return indices
-        # If children indices correspond to leaf nodes, bound rare outliers in case total slightly overshoots
-        elif children_indices[0, 0] >= self.tree_start:
-            children_indices = np.minimum(children_indices, self.sum_tree.shape[0] - 1)
-        left_children_values = self.sum_tree[children_indices[0]]
-        successor_choices = np.greater(values, left_children_values).astype(
-            np.int32)  # Classify which values are in left or right branches
-        successor_indices = children_indices[
-            successor_choices, np.arange(indices.size)]  # Use classification to index into the indices matrix
-        successor_values = values - successor_choices * left_children_values  # Subtract the left branch values when searching in the right branch
-        return self._retrieve(successor_indices, successor_values)
+        self.update(np.array([index]), value)
+
+    # Gives a newly stored data index the maximum priority
+    def append(self, data_index):
+        self._update_index(data_index + self.tree_start, self.max)
+
+    # Gives newly stored data indices the maximum priority with a single tree update
+    def append_batch(self, data_indices):
+        self.update(np.asarray(data_indices) + self.tree_start, self.max)
 
     # Searches for values in sum tree and returns values, data indices and tree indices
     def find(self, values):
-        indices = self._retrieve(np.zeros(values.shape, dtype=np.int32), values)
+        values = np.array(values, dtype=np.float32)
+        indices = np.zeros(values.shape, dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * indices + 1
+            left_values = self.sum_tree[left]
+            go_right = values > left_values  # Classify which values are in left or right branches
+            values = np.where(go_right, values - left_values, values)  # Search the right branch without the left sum
+            indices = left + go_right
+        # Bound rare outliers past the stored leaves in case total slightly overshoots
+        indices = np.minimum(indices, self.tree_start + self.size - 1)
         data_index = indices - self.tree_start
         return (self.sum_tree[indices], data_index, indices)  # Return values, data indices, tree indices
 
-    # Returns data given a data index
-    def get(self, data_index):
-        return self.data[data_index % self.size]
+    # Takes leaves out of sampling by zeroing their sum (min and max untouched), :return their values for restore
+    def exclude(self, indices):
+        values = self.sum_tree[indices].copy()
+        self.sum_tree[indices] = 0
+        self._propagate(indices)
+        return values
+
+    def restore(self, indices, values):
+        self.sum_tree[indices] = values
+        self._propagate(indices)
 
     def total(self):
         return self.sum_tree[0]
 
+    # Priorities of the first count data indices
+    def priorities(self, count):
+        return self.sum_tree[self.tree_start:self.tree_start + count]
+
+    def min(self):
+        return self.min_tree[0]
+
+
+def transition_layout(args, agent_number=1, crop_geometry=None, geometry=default_geometry):
+    """:return transition dtype and blank transition used by the replay for these arguments and game geometry"""
+    if (args.compact_transition or args.global_frame) and geometry.state_shape[0] != 2:
+        raise ValueError("Compact and global frame replays store exactly an action and a qos channel")
+    if args.compact_transition:
+        if args.sparse_observation or args.global_frame:
+            raise ValueError("Compact transitions cannot be combined with sparse observation or global frame")
+        return compact_transition_layout(geometry)
+    if args.global_frame:
+        if args.sparse_observation or crop_geometry is None:
+            raise ValueError("Global frame replay needs the crop geometry of the game and no sparse observation")
+        if not args.previous_action_observable:
+            # the action channel of a crop is rebuilt from the previous action overlay only
+            raise ValueError("Global frame replay needs the previous action observable "
+                             "(drop --previous-action-observable)")
+        return global_frame_transition_layout(crop_geometry[0], agent_number, geometry)
+    if args.sparse_observation:
+        return sparse_transition_layout(args.sparse_nnz, geometry)
+    return dense_transition_layout(geometry)
+
 
 class ReplayMemory:
-    def __init__(self, args, capacity, remove_function=None):
+    def __init__(self, args, capacity, remove_function=None, store=None, agent=0, geometry=default_geometry):
         self.device = args.device
         self.current_action_obs = args.current_action_observable
         self.previous_action_obs_ap = args.previous_action_observable
@@ -116,123 +589,287 @@ class ReplayMemory:
         self.priority_weight = args.priority_weight
         # Initial importance sampling weight β, annealed to 1 over course of training
         self.priority_exponent = args.priority_exponent
-        self.t = 0  # Internal episode timestep counter
-        self.transitions = SegmentTree(capacity)
+        self.sparse = args.sparse_observation
+        if store is None:
+            store = TransitionStore(capacity, 1, *transition_layout(args, geometry=geometry),
+                                    multi_step=args.multi_step, discount=args.discount, geometry=geometry)
+        # Transitions live in a (possibly shared) columnar store, this memory reads the column of its agent
+        self.store = store
+        self.state_shape = store.state_shape
+        self.state_size = int(np.prod(self.state_shape))
+        self.agent = agent
+        self.transitions = SegmentTree(capacity)  # Priorities of this agent over the store indices
+        self.augment = args.data_reinforce
+        if self.augment:
+            # symmetries are drawn per sample at sample time, only original transitions are stored
+            self.action_table, self.raw_action_table, self.pixel_table = augment_tables(self.device, self.state_shape)
+        self.avail_shift = torch.arange(gp.ACTION_NUM, device=self.device)
+        self.buffers = {}  # Reusable gather outputs, two per thread and call site used in turn
+        self.stats = Stats()  # Sampling of this agent
         self.n_step_scaling = torch.tensor([self.discount ** i for i in range(self.n)], dtype=torch.float32,
                                            device=self.device)  # Discount-scaling vector for n-step returns
-        # Store transitions in a wrap-around cyclic buffer within a sum tree for querying priorities
 
     # Adds state and action at time t, reward and terminal at time t + 1
     def append(self, state, action, action_logp, nei_action, glob_action, avail, reward, terminal):
-        if gp.ACTION_NUM == 6:
-            action = int((action - 1) / 2)
-        state_clip = torch.clone(state)
-        state_clip[0] = (state_clip[0] + 1) / 2
-        state_clip = state_clip.mul(scale_factor).to(dtype=torch.uint8, device=torch.device('cpu'))
-        # Only store last frame and discretise to save memory
-        self.transitions.append((self.t, state_clip, action, action_logp, nei_action, glob_action,
-                                 avail, reward, not terminal),
-                                self.transitions.max)  # Store new transition with maximum priority
-        self.t = 0 if terminal else self.t + 1  # Start new episodes with t = 0
-        # Returns the transitions with blank states where appropriate
-
-    def _get_transitions(self, idxs):
-        transition_idxs = np.arange(-self.history + 1, self.n + 1) + np.expand_dims(idxs, axis=1)
-        transitions = self.transitions.get(transition_idxs)
-        transitions_firsts = transitions['timestep'] == 0
-        blank_mask = np.zeros_like(transitions_firsts, dtype=np.bool_)
-        for t in range(self.history - 2, -1, -1):  # e.g. 2 1 0
-            blank_mask[:, t] = np.logical_or(blank_mask[:, t + 1],
-                                             transitions_firsts[:, t + 1])  # True if future frame has timestep 0
-        for t in range(self.history, self.history + self.n):  # e.g. 4 5 6
-            blank_mask[:, t] = np.logical_or(blank_mask[:, t - 1],
-                                             transitions_firsts[:, t])  # True if current or past frame has timestep 0
-        transitions[blank_mask] = blank_trans_aps
-        return transitions
-
-    # Returns a valid sample from a segment
-    def _get_sample_from_segment(self, batch_size, p_total, avg=0):
+        if self.store.agent_number != 1:
+            raise ValueError("Memory shares its store with other agents, append through MultiAgentReplayMemory")
+        state = [state] if type(state) is tuple else torch.as_tensor(state).unsqueeze(0)
+        action, action_logp, nei_action, avail, reward = \
+            [np.expand_dims(_to_numpy(value), 0) for value in (action, action_logp, nei_action, avail, reward)]
+        # Only store last frame and discretise (or sparsify) to save memory
+        with self.store.lock:
+            index = self.store.append(state, action, action_logp, nei_action, glob_action, avail, reward, terminal)
+            self.transitions.append(index)  # Store new transition with maximum priority
+
+    # Adds a run of transitions stacked on the first dimension, glob_action (n x ap) and terminal (n) included
+    def append_batch(self, state, action, action_logp, nei_action, glob_action, avail, reward, terminal):
+        if self.store.agent_number != 1:
+            raise ValueError("Memory shares its store with other agents, append through MultiAgentReplayMemory")
+        state = [[row] for row in state] if type(state) is list else torch.as_tensor(state).unsqueeze(1)
+        action, action_logp, nei_action, avail, reward = \
+            [np.expand_dims(_to_numpy(value), 1) for value in (action, action_logp, nei_action, avail, reward)]
+        with self.store.lock:
+            indices = self.store.append_batch(state, action, action_logp, nei_action, glob_action, avail, reward,
+                                              terminal)
+            self.transitions.append_batch(indices)  # All new transitions get the maximum priority at once
+
+    # Gather outputs of the next draw at a call site, a batch handed out still holds after the following draw
+    def _buffers(self, site):
+        pair = self.buffers.setdefault((threading.get_ident(), site), [{}, {}])
+        pair.reverse()
+        return pair[0]
+
+    # Returns the sampled rows and the frames from t - h + 1 to t + n, frames of other episodes blanked
+    def _get_transitions(self, idxs, agent=None, site='sample'):
+        offsets = np.arange(-self.history + 1, self.n + 1)
+        row_agent = self.agent if agent is None else np.reshape(agent, (-1, 1))
+        frame_agent = self.agent if agent is None else np.reshape(agent, (-1, 1, 1))
+        with self.store.lock:
+            rows = self.store.gather(idxs, row_agent, out=self._buffers(site + '_rows'))
+            frames = self.store.gather(offsets + np.expand_dims(idxs, axis=1), frame_agent, self.store.state_fields,
+                                       self._buffers(site + '_frames'))
+        # Past frames before the episode start and future frames from the next episode start on are blank
+        offsets = torch.from_numpy(offsets)
+        blank_mask = (-offsets > rows['timestep'].unsqueeze(1)) | (offsets >= rows['episode_end'].unsqueeze(1))
+        self.store.blank_out(frames, blank_mask)
+        return rows, frames
+
+    # Gathered field on the sample device, the gather output itself when it has the dtype already
+    def _tensor(self, value, dtype):
+        return value.to(device=self.device, dtype=dtype)
+
+    # Turns stored frames back into float states, action channel back to -1/0/1
+    def _decode_frames(self, transitions, time, agent=None):
+        frames = {name: value[(Ellipsis, time) + (slice(None),) * len(self.store.field_shape[name])]
+                  for name, value in transitions.items()}
+        if 'frame' in frames:
+            return self._crop_frames(frames, self.agent if agent is None else agent)
+        if 'state_marks' in frames:
+            size = self.state_shape[1] * self.state_shape[2]
+            marks = _unpack_bits(frames['state_marks'].to(self.device), 2, size).float() - 1
+            qos = _unpack_bits(frames['state_qos'].to(self.device), qos_bits, size).float()
+            state = torch.stack([marks, qos.div_(2 ** qos_bits - 1)], dim=-2)
+            return state.reshape(*state.shape[:-1], *self.state_shape[1:])
+        if self.sparse:
+            return sparse_obs.densify(frames['state_index'], frames['state_value'], self.state_shape, self.device)
+        state = frames['state'].to(device=self.device, dtype=torch.float32)
+        state[..., 0, :, :].mul_(2 / scale_factor).sub_(1).round_()  # 0/127/255 -> -1/0/1 in place
+        state[..., 1:, :, :].div_(scale_factor)
+        return state
+
+    # Action masks of the sampled rows, unpacked from their bitmask in the compact layout
+    def _get_avail(self, rows):
+        avail = rows['avail']
+        if avail.dtype == torch.int16:
+            bits = avail.to(device=self.device, dtype=torch.int64)
+            return ((bits.unsqueeze(-1) >> self.avail_shift) & 1).bool()
+        return self._tensor(avail, torch.bool)
+
+    # Rebuilds ap crops from the stored global field and the action overlay of each agent
+    def _crop_frames(self, frames, agent):
+        _, pad_width, offsets, ap_pixels = self.store.crop_geometry
+        side = self.state_shape[-1]
+        field = frames['frame'].to(device=self.device, dtype=torch.float32).div_(scale_factor)
+        field = torch.nn.functional.pad(field, (pad_width, pad_width, pad_width, pad_width))
+        overlay = frames['overlay'].to(device=self.device, dtype=torch.float32)
+        states = []
+        for index, crop_agent in enumerate(np.reshape(agent, -1)):
+            row, col = offsets[crop_agent]
+            qos = field[..., row:row + side, col:col + side]
+            marks = torch.zeros_like(qos)
+            relative = ap_pixels - offsets[crop_agent]
+            inside = np.all(np.logical_and(relative >= 0, relative < side), axis=1)
+            marks[..., relative[inside, 0], relative[inside, 1]] = \
+                (overlay if np.ndim(agent) == 0 else overlay[index])[..., inside]
+            states.append(torch.stack([marks, qos], dim=-3))
+        return states[0] if np.ndim(agent) == 0 else torch.stack(states)
+
+    # Decodes the state and nth next state of a batch, with the history folded into the channels
+    def _get_states(self, frames, remove_current=True, agent=None):
+        state = self._decode_frames(frames, slice(0, self.history), agent)
+        state = state.reshape(*state.shape[:-4], -1, state.shape[-2], state.shape[-1])
+        next_state = self._decode_frames(frames, slice(self.n, self.n + self.history), agent)
+        next_state = next_state.reshape(*next_state.shape[:-4], -1, next_state.shape[-2], next_state.shape[-1])
+        if not self.current_action_obs:
+            if remove_current:
+                state[..., gp.OBSERVATION_DIMS * (self.history - 1), :, :] = \
+                    self.remove_function(state[..., gp.OBSERVATION_DIMS * (self.history - 1), :, :])
+            next_state[..., gp.OBSERVATION_DIMS * (self.history - 1), :, :] = \
+                self.remove_function(next_state[..., gp.OBSERVATION_DIMS * (self.history - 1), :, :])
+        return state, next_state
+
+    # Applies one random symmetry per sample to the states, actions and masks of a batch
+    def _augment(self, rows, state, next_state, action, action_logp, nei_action, glob_action, avail):
+        eligible = (rows['action'] != 12) & (rows['reward'] != 0)
+        symmetry = torch.randint(0, 4, (action.shape[0],), device=self.device) * \
+                   eligible.to(device=self.device, dtype=torch.int64)
+        pixel = self.pixel_table[symmetry].unsqueeze(1)
+        state = torch.gather(state.reshape(state.shape[0], state.shape[1], -1), 2,
+                             pixel.expand(-1, state.shape[1], -1)).view_as(state)
+        next_state = torch.gather(next_state.reshape(next_state.shape[0], next_state.shape[1], -1), 2,
+                                  pixel.expand(-1, next_state.shape[1], -1)).view_as(next_state)
+        action_perm = self.action_table[symmetry]
+        action = action_perm.gather(1, action.unsqueeze(1)).squeeze(1)
+        action_logp = action_logp.gather(1, action_perm)
+        avail = avail.gather(1, action_perm)
+        nei_action = self.raw_action_table[symmetry.unsqueeze(1), nei_action + 1]
+        glob_action = self.raw_action_table[symmetry.unsqueeze(1), glob_action + 1]
+        return state, next_state, action, action_logp, nei_action, glob_action, avail
+
+    def _valid(self, idxs, probs):
+        return np.logical_and.reduce([(self.store.index - idxs) % self.capacity > self.n,
+                                      (idxs - self.store.index) % self.capacity >= self.history, probs != 0])
+
+    # Stratified sample of valid data indices, the region around the write head is excluded from the tree while
+    # sampling and only invalid strata are drawn again, a bounded number of times
+    def _sample_idxs(self, batch_size):
+        forbidden = self.transitions.tree_start + \
+                    (self.store.index + np.arange(-self.n, self.history)) % self.capacity
+        saved = self.transitions.exclude(forbidden)
+        p_total = self.transitions.total()
         segment_length = p_total / batch_size  # Batch size number of segments, based on sum over all probabilities
         segment_starts = np.arange(batch_size) * segment_length
-        valid = False
-        while not valid:
-            samples = np.random.uniform(0.0, segment_length,
-                                        [batch_size]) + segment_starts  # Uniformly sample from within all segments
-            probs, idxs, tree_idxs = self.transitions.find(samples)
-            # Retrieve samples from tree with un-normalised probability
-            if np.all((self.transitions.index - idxs) % self.capacity > self.n) and np.all(
-                    (idxs - self.transitions.index) % self.capacity >= self.history) and np.all(probs != 0):
-                valid = True  # Note that conditions are valid but extra conservative around buffer index 0
-
-        # Retrieve all required transition data (from t - h to t + n)
-        transitions = self._get_transitions(idxs)
-        all_state = transitions['state']
+        probs = np.zeros(batch_size, dtype=np.float32)
+        idxs = np.zeros(batch_size, dtype=np.int64)
+        tree_idxs = np.zeros(batch_size, dtype=np.int64)
+        pending = np.arange(batch_size)
+        try:
+            for rounds in range(1, sample_retries + 1):
+                # Uniformly sample within segments
+                samples = np.random.uniform(0.0, segment_length, [len(pending)]) + segment_starts[pending]
+                probs[pending], idxs[pending], tree_idxs[pending] = self.transitions.find(samples)
+                pending = pending[np.logical_not(self._valid(idxs[pending], probs[pending]))]
+                self.stats.count('sample_rejections', len(pending))
+                if len(pending) == 0:
+                    break
+        finally:
+            self.transitions.restore(forbidden, saved)  # the tree is whole again whatever happened while sampling
+        self.stats.observe('sample_rounds', rounds)
+        if len(pending) > 0:
+            self.stats.count('sample_fallbacks', len(pending))
+            # only float overshoot onto empty leaves gets here, reuse valid draws of other strata
+            valid = np.setdiff1d(np.arange(batch_size), pending)
+            if len(valid) == 0:
+                raise ValueError("No valid transition to sample, fill the memory before sampling")
+            fill = np.random.choice(valid, len(pending))
+            probs[pending], idxs[pending], tree_idxs[pending] = probs[fill], idxs[fill], tree_idxs[fill]
+        return probs, idxs, tree_idxs, p_total
+
+    # Returns a valid sample from a segment, without average reward offset and importance weights
+    def _get_sample_from_segment(self, batch_size):
+        start = time.perf_counter()
+        with self.store.lock:
+            probs, idxs, tree_idxs, p_total = self._sample_idxs(batch_size)
+            p_min, capacity = self.transitions.min(), self.capacity if self.store.full else self.store.index
+            # Retrieve the sampled rows and the frames from t - h + 1 to t + n
+            rows, frames = self._get_transitions(idxs)
+            age = (self.store.index - 1 - idxs) % self.capacity  # Steps appended since each sampled one
         # Create un-discretised state and nth next state, if number-step is 1, don't need to add another dims
-        state = torch.tensor(all_state[:, :self.history], device=self.device, dtype=torch.float32).div_(scale_factor)
-        state = torch.reshape(state, (batch_size, -1, state.shape[-2], state.shape[-1]))
-        state[:, 0::gp.OBSERVATION_DIMS] = torch.round((state[:, 0::gp.OBSERVATION_DIMS] - 0.5) * 2)
-        #TODO: change to torch.stack if state is two dim
-        next_state = torch.tensor(all_state[:, self.n : self.n + self.history],
-                                  device=self.device, dtype=torch.float32).div_(scale_factor)
-        next_state = torch.reshape(next_state, (batch_size, -1, next_state.shape[-2], next_state.shape[-1]))
-        next_state[:, 0::gp.OBSERVATION_DIMS] = torch.round((next_state[:, 0::gp.OBSERVATION_DIMS] - 0.5) * 2)
-        if not self.current_action_obs:
-            state[:, gp.OBSERVATION_DIMS * (self.history - 1), :, :] = \
-                self.remove_function(state[:, gp.OBSERVATION_DIMS * (self.history - 1), :, :])
-            next_state[:, gp.OBSERVATION_DIMS * (self.history - 1), :, :] = \
-                self.remove_function(next_state[:, gp.OBSERVATION_DIMS * (self.history - 1), :, :])
+        state, next_state = self._get_states(frames)
         # Discrete action to be used as index
-        action = torch.tensor(np.copy(transitions['action'][:, self.history - 1]), dtype=torch.int64, device=self.device)
-        action_logp = torch.tensor(np.copy(transitions['action_logp'][:, self.history - 1]), dtype=torch.float32,
-                                   device=self.device)
-        nei_action = torch.tensor(np.copy(transitions['neighbor_action'][:, self.history - 1]),
-                                  dtype=torch.int64, device=self.device)
-        glob_action = torch.tensor(np.copy(transitions['global_action'][:, self.history - 1]),
-                                   dtype=torch.int64, device=self.device)
-        avail = torch.tensor(np.copy(transitions['avail'][:, self.history - 1]), dtype=torch.bool, device=self.device)
-        # Calculate truncated n-step discounted return R^n = Σ_k=0->n-1 (γ^k)R_t+k+1 (note that invalid nth next states have reward 0)
-        R = torch.tensor(np.copy(transitions['reward'][:, self.history - 1:-1]), device=self.device, dtype=torch.float32)
-        R = torch.matmul(R - avg, self.n_step_scaling)
-        # Mask for non-terminal nth next states
-        nonterminal = torch.tensor(
-            np.expand_dims(transitions['nonterminal'][:, self.history + self.n - 1], axis=1),
-            dtype=torch.float32, device=self.device)
-
-        return probs, idxs, tree_idxs, state, action, action_logp, nei_action, \
-               glob_action, avail, R, next_state, nonterminal
+        action = self._tensor(rows['action'], torch.int64)
+        action_logp = self._tensor(rows['action_logp'], torch.float32)
+        nei_action = self._tensor(rows['neighbor_action'], torch.int64)
+        glob_action = self._tensor(rows['global_action'], torch.int64)
+        avail = self._get_avail(rows)
+        if self.augment:
+            state, next_state, action, action_logp, nei_action, glob_action, avail = \
+                self._augment(rows, state, next_state, action, action_logp, nei_action, glob_action, avail)
+        # Truncated n-step discounted return R^n = Σ_k=0->n-1 (γ^k)R_t+k+1, kept up to date by the store on append
+        R = self._tensor(rows['nstep_return'], torch.float32)
+        # Mask for non-terminal nth next states of the same episode
+        nonterminal = self._tensor(rows['bootstrap'], torch.float32).unsqueeze(1)
+        self.stats.observe('sample_seconds', time.perf_counter() - start)
+        self.stats.observe('sample_age', age)
+        self.stats.count('samples', batch_size)
+
+        return SampleBatch(probs, p_total, p_min, capacity, idxs, tree_idxs, state, action, action_logp, nei_action,
+                           glob_action, avail, R, next_state, nonterminal)
 
     def get_relate_sample(self, batch_size, idxs):
-        transitions = self._get_transitions(idxs)
-        all_state = transitions['state']
-        state = torch.tensor(all_state[:, :self.history], device=self.device, dtype=torch.float32).div_(scale_factor)
-        state = torch.reshape(state, (batch_size, -1, state.shape[-2], state.shape[-1]))
-        state[:, 0::gp.OBSERVATION_DIMS] = torch.round((state[:, 0::gp.OBSERVATION_DIMS] - 0.5) * 2)
-        next_state = torch.tensor(all_state[:, self.n : self.n + self.history],
-                                  device=self.device, dtype=torch.float32).div_(scale_factor)
-        next_state = torch.reshape(next_state, (batch_size, -1, next_state.shape[-2], next_state.shape[-1]))
-        next_state[:, 0::gp.OBSERVATION_DIMS] = torch.round((next_state[:, 0::gp.OBSERVATION_DIMS] - 0.5) * 2)
-        if not self.current_action_obs:
-            next_state[:, gp.OBSERVATION_DIMS * (self.history - 1), :, :] = \
-                self.remove_function(next_state[:, gp.OBSERVATION_DIMS * (self.history - 1), :, :])
-        avail = torch.tensor(np.copy(transitions['avail'][:, self.history - 1]), dtype=torch.bool, device=self.device)
-        return state, next_state, avail
+        rows, frames = self._get_transitions(idxs, site='relate')
+        state, next_state = self._get_states(frames, remove_current=False)
+        return state, next_state, self._get_avail(rows)
+
+    def get_joint_sample(self, batch_size, idxs, agents):
+        """
+            Same as get_relate_sample for several agents of the shared store with a single gather
+            :return (agent x batch x ...) states, next states and action masks
+        """
+        rows, frames = self._get_transitions(idxs, agents, 'relate')
+        state, next_state = self._get_states(frames, remove_current=False, agent=np.asarray(agents))
+        return state, next_state, self._get_avail(rows)
+
+    # Applies the average reward offset and the current importance sampling weight β to a drawn batch
+    def _finish_sample(self, batch, avg=0):
+        probs = batch.probs / batch.p_total  # Calculate normalised probabilities
+        weights = (batch.capacity * probs) ** -self.priority_weight  # Compute importance-sampling weights w
+        max_weight = (batch.capacity * batch.p_min / batch.p_total) ** -self.priority_weight if batch.p_min > 0 \
+            else weights.max()
+        weights = torch.tensor(weights / max_weight, dtype=torch.float32,
+                               device=self.device)  # Normalise by max importance-sampling weight of the whole memory
+        # Σ_k (γ^k)(R_t+k+1 - avg) with the offset taken out of the precomputed sum
+        returns = batch.returns - avg * self.n_step_scaling.sum()
+        return (batch.tree_idxs, batch.idxs), batch.state, batch.action, batch.action_logp, batch.neighbor_action, \
+               batch.global_action, batch.avail, returns, batch.next_state, batch.nonterminal, weights
 
     def sample(self, batch_size, avg=0):
-        p_total = self.transitions.total()
-        # Retrieve sum of all priorities (used to create a normalised probability distribution)
-        probs, idxs, tree_idxs, states, actions, action_logp, nei_action, glob_action, \
-        avail, returns, next_states, nonterminals = self._get_sample_from_segment(batch_size, p_total, avg)
-        probs = probs / p_total  # Calculate normalised probabilities
-        capacity = self.capacity if self.transitions.full else self.transitions.index
-        weights = (capacity * probs) ** -self.priority_weight  # Compute importance-sampling weights w
-        weights = torch.tensor(weights / weights.max(), dtype=torch.float32,
-                               device=self.device)  # Normalise by max importance-sampling weight from batch
-        return (tree_idxs, idxs), states, actions, action_logp, \
-               nei_action, glob_action, avail, returns, next_states, nonterminals, weights
+        return self._finish_sample(self._get_sample_from_segment(batch_size), avg)
 
     def update_priorities(self, idxs, priorities):
         priorities = np.power(priorities, self.priority_exponent)
-        self.transitions.update(idxs, priorities)
+        with self.store.lock:
+            self.transitions.update(idxs, priorities)
+
+    def summary(self):
+        """:return json-ready sampling stats of this agent, its priorities and the stats of the shared store"""
+        with self.store.lock:
+            stored = self.capacity if self.store.full else self.store.index
+            priority = Histogram()
+            priority.add(self.transitions.priorities(stored))
+            summary = {'agent': self.agent, 'stored': stored, 'steps': self.store.steps,
+                       'field_bytes': self.store.nbytes(), 'priority': priority.summary()}
+        summary.update(self.stats.summary())
+        summary['store'] = self.store.stats.summary()
+        summary['append_rate'] = summary['store']['counters'].get('append_steps', 0) / summary['store']['seconds']
+        return summary
+
+    def states(self):
+        """:return the states of every index (capacity x c x h x w) in one batch, the same as iterating the memory"""
+        offsets = np.arange(-self.history + 1, 1)
+        idxs = np.arange(self.capacity)
+        with self.store.lock:
+            rows = self.store.gather(idxs, self.agent, ['timestep'], self._buffers('states_rows'))
+            frames = self.store.gather(np.expand_dims(idxs, axis=1) + offsets, self.agent, self.store.state_fields,
+                                       self._buffers('states_frames'))
+        # Frames before the episode start of each state are blank
+        self.store.blank_out(frames, torch.from_numpy(-offsets) > rows['timestep'].unsqueeze(1))
+        state = self._decode_frames(frames, slice(None))
+        state = state.reshape(state.shape[0], -1, state.shape[-2], state.shape[-1])
+        if not self.current_action_obs:
+            state[:, gp.OBSERVATION_DIMS * (self.history - 1), :, :] = \
+                self.remove_function(state[:, gp.OBSERVATION_DIMS * (self.history - 1), :, :])
+        return state
 
     # Set up internal state for iterator
     def __iter__(self):
@@ -244,16 +881,13 @@ class ReplayMemory:
     def __next__(self):
         if self.current_idx == self.capacity:
             raise StopIteration
-        transitions = self.transitions.data[np.arange(self.current_idx - self.history + 1, self.current_idx + 1)]
-        transitions_firsts = transitions['timestep'] == 0
-        blank_mask = np.zeros_like(transitions_firsts, dtype=np.bool_)
-        for t in reversed(range(self.history - 1)):
-            blank_mask[t] = np.logical_or(blank_mask[t + 1],
-                                          transitions_firsts[t + 1])  # If future frame has timestep 0
-        transitions[blank_mask] = blank_trans_aps
-        state = torch.tensor(transitions['state'], dtype=torch.float32, device=self.device).div_(scale_factor)
+        offsets = np.arange(-self.history + 1, 1)
+        frames = self.store.gather(self.current_idx + offsets, self.agent, self.store.state_fields,
+                                   self._buffers('iter'))
+        # Frames before the episode start of the current one are blank
+        self.store.blank_out(frames, torch.from_numpy(-offsets) > self.store.tensors['timestep'][self.current_idx])
+        state = self._decode_frames(frames, slice(None))
         state = torch.reshape(state, (-1, state.shape[-2], state.shape[-1]))
-        state[0::gp.OBSERVATION_DIMS] = torch.round((state[0::gp.OBSERVATION_DIMS] - 0.5) * 2)
         # Agent will turn into batch
         if not self.current_action_obs:
             state[gp.OBSERVATION_DIMS * (self.history - 1), :, :] = \
@@ -262,3 +896,156 @@ class ReplayMemory:
         return state
 
     next = __next__  # Alias __next__ for Python 2 compatibility
+
+
+class MultiAgentReplayMemory:
+    """
+        Replay of all agents in one columnar store, a step of every agent is appended with a single write.
+        Indexing gives the ReplayMemory of an agent, which samples with its own priorities over the shared indices.
+    """
+    def __init__(self, args, capacity, agent_number, remove_function=None, path=None, crop_geometry=None,
+                 shared=False, geometry=default_geometry):
+        self.capacity = capacity
+        geometry = ReplayGeometry(*geometry)
+        self.store = TransitionStore(capacity, agent_number,
+                                     *transition_layout(args, agent_number, crop_geometry, geometry),
+                                     path=path, crop_geometry=crop_geometry, multi_step=args.multi_step,
+                                     discount=args.discount, shared=shared, geometry=geometry)
+        self.agents = [ReplayMemory(args, capacity, remove_function, self.store, agent)
+                       for agent in range(agent_number)]
+        if self.store.reopened and (self.store.full or self.store.index > 0):
+            # priorities are kept in RAM only, transitions found on disk start again from the maximum priority
+            stored = np.arange(self.capacity if self.store.full else self.store.index)
+            for memory in self.agents:
+                memory.transitions.append_batch(stored)
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+    def dump_stats(self, path, T):
+        """Appends one JSONL record per agent to path and starts new counters and histograms"""
+        dump_jsonl(path, [dict(memory.summary(), T=T) for memory in self.agents])
+        for memory in self.agents:
+            memory.stats.reset()
+        self.store.stats.reset()
+
+    def __getitem__(self, agent):
+        return self.agents[agent]
+
+    def __len__(self):
+        return len(self.agents)
+
+    def __iter__(self):
+        return iter(self.agents)
+
+    # Adds a step of every agent, all arguments batched on the agent dimension except glob_action and terminal
+    def append(self, state, action, action_logp, nei_action, glob_action, avail, reward, terminal):
+        with self.store.lock:
+            index = self.store.append(state, action, action_logp, nei_action, glob_action, avail, reward, terminal)
+            for memory in self.agents:
+                memory.transitions.append(index)  # Store new transition with maximum priority
+
+    # Adds a run of steps of every agent, arguments are (steps x agents x ...), glob_action and terminal (steps x ...)
+    def append_batch(self, state, action, action_logp, nei_action, glob_action, avail, reward, terminal):
+        with self.store.lock:
+            indices = self.store.append_batch(state, action, action_logp, nei_action, glob_action, avail, reward,
+                                              terminal)
+            for memory in self.agents:
+                memory.transitions.append_batch(indices)
+
+    def reserve(self, counts):
+        """:return rows for runs of counts steps, written with store.write by processes sharing the store"""
+        with self.store.lock:
+            return self.store.reserve(counts)
+
+    # Takes in runs written by other processes, only the head, returns and priorities are updated here
+    def commit(self, runs):
+        with self.store.lock:
+            self.store.commit(runs)
+            indices = np.concatenate(runs)
+            for memory in self.agents:
+                memory.transitions.append_batch(indices)
+
+
+class PrefetchSampler:
+    """
+        Draws the next batches of one agent's ReplayMemory on a worker thread while the learner trains on the current
+        one. Batches are copied into depth + 1 preallocated slots: depth waiting and one handed to the learner, which
+        is recycled on the next sample call. Priority updates are queued and applied by the worker in order before its
+        next draw, the average reward offset and importance weights are applied when a batch is handed out.
+        Anything else (priority_weight, get_joint_sample, ...) is forwarded to the memory.
+    """
+    def __init__(self, memory, batch_size, depth=2):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.slots = [None] * (depth + 1)
+        self.free = queue.Queue()
+        for slot in range(depth + 1):
+            self.free.put(slot)
+        self.ready = queue.Queue()
+        self.updates = queue.Queue()
+        self.current = None
+        self.error = None
+        self.thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['memory'], name)
+
+    def _apply_updates(self):
+        while not self.updates.empty():
+            self.memory.update_priorities(*self.updates.get())
+
+    def _fill(self, slot, batch):
+        if self.slots[slot] is None:
+            self.slots[slot] = SampleBatch(*[field.clone() if torch.is_tensor(field) else copy.copy(field)
+                                             for field in batch])
+            return
+        fields = []
+        for target, field in zip(self.slots[slot], batch):
+            if torch.is_tensor(field):
+                target.copy_(field)
+            elif isinstance(field, np.ndarray):
+                np.copyto(target, field)
+            else:
+                target = field  # scalars are replaced
+            fields.append(target)
+        self.slots[slot] = SampleBatch(*fields)
+
+    def _run(self):
+        try:
+            while True:
+                slot = self.free.get()
+                if slot is None:
+                    break
+                self._apply_updates()
+                self._fill(slot, self.memory._get_sample_from_segment(self.batch_size))
+                self.ready.put(slot)
+        except Exception as error:
+            self.error = error
+            self.ready.put(None)
+
+    def sample(self, batch_size, avg=0):
+        if batch_size != self.batch_size:
+            return self.memory.sample(batch_size, avg)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        if self.current is not None:
+            self.free.put(self.current)  # the learner is done with the previous batch
+        self.current = self.ready.get()
+        if self.current is None:
+            raise self.error
+        return self.memory._finish_sample(self.slots[self.current], avg)
+
+    def update_priorities(self, idxs, priorities):
+        self.updates.put((np.copy(idxs), np.copy(priorities)))
+
+    def close(self):
+        if self.thread is not None:
+            self.free.put(None)
+            self.thread.join()
+            self.thread = None
+        self._apply_updates()
@@ -4,9 +4,9 @@ import os
 import numpy as np
 import torch
 from torch import optim
-from scipy.special import softmax as softmax_sci
 from torch.nn.utils import clip_grad_norm_
 import GLOBAL_PRARM as gp
+import action_sampler
 
 from ppo.basic_block import DQN
 # https://github.com/nikhilbarhate99/PPO-PyTorch/blob/master/PPO.py
@@ -102,62 +102,20 @@ class Agent:
 
     # Acts with an ε-greedy policy (used for evaluation only)
     def act_boltzmann(self, state, avail):  # High ε can reduce evaluation scores drastically
+        return self.act_boltzmann_batch(state.unsqueeze(0), [avail])[0]
+
+    # act_boltzmann for a batch of states, one result per state (batched inference server)
+    def act_boltzmann_batch(self, states, avails):
         with torch.no_grad():
-            res_policy, res_policy_log = self.online_net(state.unsqueeze(0))
-            res_action = self.boltzmann(res_policy, [avail])
-            return (res_action, (res_policy_log[0]).numpy())
+            res_policy, res_policy_log = self.online_net(states)
+            actions = action_sampler.categorical(res_policy, avails)
+            return list(zip(actions.tolist(), res_policy_log.numpy()))
 
     def boltzmann(self, res_policy, mask):
-        sizeofres = res_policy.shape
-        res = []
-        res_policy = res_policy.numpy()
-        for i in range(sizeofres[0]):
-            action_probs = [res_policy[i][ind] * mask[i][ind] for ind in range(res_policy[i].shape[0])]
-            count = np.sum(action_probs)
-            if count == 0:
-                action_probs = np.array([1.0 / np.sum(mask[i]) if _ != 0 else 0 for _ in mask[i]])
-                print('Zero probs, random action')
-            else:
-                action_probs = np.array([x / count for x in action_probs])
-            res.append(np.random.choice(self.action_space, p=action_probs))
-        if sizeofres[0] == 1:
-            return res[0]
-        return np.array(res)
-
-    def lookup_server(self, list_of_pipe):
-        num_pro = len(list_of_pipe)
-        list_pro = np.ones(num_pro, dtype=bool)
-        with torch.no_grad():
-            while list_pro.any():
-                for key, pipes in enumerate(list_of_pipe):
-                    if not pipes.closed and pipes.readable:
-                        obs, avial = pipes.recv()
-                        if len(obs) == 1:
-                            if not obs[0]:
-                                pipes.close()
-                                list_pro[key] = False
-                                continue
-                        pipes.send(self.act_boltzmann(obs, avial))
-                        # convert back to numpy or cpu-tensor, or it will cause error since cuda try to run in
-                        # another thread. Keep the gpu resource inside main thread
-
-    def lookup_server_loop(self, list_of_pipe):
-        num_pro = len(list_of_pipe)
-        list_pro = np.ones(num_pro, dtype=bool)
-        for key, pipes in enumerate(list_of_pipe):
-            if not pipes.closed and pipes.readable:
-                if pipes.poll():
-                    obs, avial = pipes.recv()
-                    if type(obs) is np.ndarray:
-                        pipes.close()
-                        list_pro[key] = False
-                        continue
-                    pipes.send(self.act_boltzmann(obs, avial))
-            else:
-                list_pro[key] = False
-            # convert back to numpy or cpu-tensor, or it will cause error since cuda try to run in
-            # another thread. Keep the gpu resource inside main thread
-        return list_pro.any()
+        actions = action_sampler.categorical(res_policy, mask)
+        if len(actions) == 1:
+            return actions[0].item()
+        return actions.numpy()
 
     @staticmethod
     def _to_one_hot(y, num_classes):
@@ -180,7 +138,8 @@ class Agent:
         self.optimiser.zero_grad()
 
         # Calculate current state probabilities (online network noise already sampled)
-        ps_a, log_ps_a = self.online_net(states, False, log=True)
+        feats = self.online_net.features(states)  # conv trunk once, the critic and actor heads reuse it
+        ps_a, log_ps_a = self.online_net.head(feats, False, log=True)
         # Log probabilities log p(s_t, ·; θonline)
 
         with torch.no_grad():
@@ -220,7 +179,7 @@ class Agent:
 
         # Actor update
         actions_logp_s = actions_logp.gather(-1, actions.unsqueeze(1))
-        curr_pol_out, curr_pol_out_log = self.online_net(states)
+        curr_pol_out, curr_pol_out_log = self.online_net.head(feats)
         curr_pol_out_log = curr_pol_out_log.gather(-1, actions.unsqueeze(1))
         ratios = torch.exp(curr_pol_out_log.squeeze(1) - actions_logp_s)
 
@@ -265,6 +224,11 @@ class Agent:
             temp, _ = self.online_net(state.unsqueeze(0), False)
             return (temp * self.support).sum(-1).item()
 
+    def evaluate_q_batch(self, states):
+        with torch.no_grad():
+            temp, _ = self.online_net(states, False)
+            return (temp * self.support).sum(-1).view(-1)
+
     def train(self):
         self.online_net.train()
 
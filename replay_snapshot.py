@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+"""
+    Append-only snapshots of a MultiAgentReplayMemory in a directory.
+    1) ReplaySnapshot(replay, path).snapshot():
+        copies the steps appended since the last snapshot into a new chunk file, plus the n rows before them whose
+        n-step returns these steps completed, every priority_interval snapshots also the priorities of all agents,
+        files are written by a background thread
+        chunks fully overwritten by later ones are deleted, manifest.json lists the live files in order
+    2) load_snapshot(replay, path):
+        reads the chunks in parallel and replays them in order into an empty replay with the same layout
+        steps written after the last priority checkpoint get the maximum priority
+"""
+
+
+def _write_manifest(path, manifest):
+    temp_path = os.path.join(path, 'manifest.json.tmp')
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temp_path, os.path.join(path, 'manifest.json'))  # readers never see a half written manifest
+
+
+def _layout(store):
+    return {'capacity': store.capacity, 'agent_number': store.agent_number,
+            'fields': {name: [str(column.dtype), list(column.shape)] for name, column in store.columns.items()}}
+
+
+class ReplaySnapshot:
+    def __init__(self, replay, path, priority_interval=10):
+        self.replay = replay
+        self.path = path
+        self.priority_interval = priority_interval
+        os.makedirs(path, exist_ok=True)
+        manifest_path = os.path.join(path, 'manifest.json')
+        self.manifest = {'layout': _layout(replay.store), 'chunks': [], 'priorities': None}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest['chunks'] and manifest['chunks'][-1]['steps'] == replay.store.steps and \
+                    manifest['layout'] == self.manifest['layout']:
+                self.manifest = manifest  # continue the snapshot the replay was loaded from
+            else:
+                # another run's snapshot, it is replaced
+                _write_manifest(path, self.manifest)
+                for entry in manifest['chunks'] + ([manifest['priorities']] if manifest['priorities'] else []):
+                    if os.path.exists(os.path.join(path, entry['file'])):
+                        os.remove(os.path.join(path, entry['file']))
+        self.saved_steps = self.manifest['chunks'][-1]['steps'] if self.manifest['chunks'] else 0
+        self.snapshots = 0
+        self.jobs = queue.Queue()
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def snapshot(self):
+        """Queues the steps appended since the last snapshot, only the copy of the new rows runs on the caller"""
+        store = self.replay.store
+        start = time.perf_counter()
+        with store.lock:
+            new = min(store.steps - self.saved_steps, store.capacity)
+            if new <= 0:
+                return
+            count = min(new + store.n, store.steps, store.capacity)
+            indices = (store.index - count + np.arange(count)) % store.capacity
+            chunk = {name: column[indices] for name, column in store.columns.items()}
+            chunk['indices'] = indices
+            meta = {'steps': store.steps, 'count': int(count), 'new': int(new), 'index': store.index, 'full': store.full,
+                    't': store.t}
+            priorities = None
+            self.snapshots += 1
+            if self.snapshots % self.priority_interval == 0:
+                leaves = slice(self.replay.agents[0].transitions.tree_start,
+                               self.replay.agents[0].transitions.tree_start + store.capacity)
+                priorities = (np.stack([memory.transitions.sum_tree[leaves] for memory in self.replay.agents]),
+                              np.array([memory.transitions.max for memory in self.replay.agents]))
+            self.saved_steps = store.steps
+        store.stats.observe('snapshot_copy_seconds', time.perf_counter() - start)
+        self.jobs.put((chunk, meta, priorities))
+
+    def _write(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            chunk, meta, priorities = job
+            start = time.perf_counter()
+            meta['file'] = 'chunk_{:012d}.npz'.format(meta['steps'])
+            np.savez(os.path.join(self.path, meta['file']), **chunk)
+            self.manifest['chunks'].append(meta)
+            dead_files = self._compact()
+            if priorities is not None:
+                priority_file = 'priorities_{:012d}.npz'.format(meta['steps'])
+                np.savez(os.path.join(self.path, priority_file), leaves=priorities[0], max=priorities[1])
+                if self.manifest['priorities'] is not None:
+                    dead_files.append(self.manifest['priorities']['file'])
+                self.manifest['priorities'] = {'file': priority_file, 'steps': meta['steps']}
+            _write_manifest(self.path, self.manifest)
+            for file in dead_files:  # only once the manifest no longer lists them
+                os.remove(os.path.join(self.path, file))
+            self.replay.store.stats.observe('snapshot_write_seconds', time.perf_counter() - start)
+            self.replay.store.stats.observe('snapshot_rows', meta['count'])
+            self.jobs.task_done()
+
+    # Drops chunks whose rows were all overwritten by the chunks after them, :return their files
+    def _compact(self):
+        covered, live = 0, len(self.manifest['chunks'])
+        while live > 0 and covered < self.manifest['layout']['capacity']:
+            live -= 1
+            covered += self.manifest['chunks'][live]['new']
+        dead, self.manifest['chunks'] = self.manifest['chunks'][:live], self.manifest['chunks'][live:]
+        return [chunk['file'] for chunk in dead]
+
+    def flush(self):
+        """Waits for the queued snapshots to be on disk"""
+        self.jobs.join()
+
+    def close(self):
+        self.snapshot()
+        self.jobs.put(None)
+        self.writer.join()
+
+
+def _read_chunk(path, file):
+    with np.load(os.path.join(path, file)) as chunk:
+        return {name: chunk[name] for name in chunk.files}
+
+
+def load_snapshot(replay, path, workers=8):
+    """Fills an empty replay from the snapshot directory, :return the replay"""
+    with open(os.path.join(path, 'manifest.json'), 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    store = replay.store
+    if manifest['layout'] != _layout(store):
+        raise ValueError("Replay snapshot at " + path + " was written with another capacity or layout")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        chunks = list(pool.map(lambda chunk: _read_chunk(path, chunk['file']), manifest['chunks']))
+    with store.lock:
+        for chunk in chunks:  # in order, later chunks overwrite earlier rows
+            for name, column in store.columns.items():
+                column[chunk['indices']] = chunk[name]
+        if manifest['chunks']:
+            last = manifest['chunks'][-1]
+            store.index, store.full, store.t, store.steps = last['index'], last['full'], last['t'], last['steps']
+        stored = np.arange(store.capacity if store.full else store.index)
+        if manifest['priorities'] is not None and len(stored) > 0:
+            priorities = _read_chunk(path, manifest['priorities']['file'])
+            for memory, leaves, max_priority in zip(replay.agents, priorities['leaves'], priorities['max']):
+                memory.transitions.update(stored + memory.transitions.tree_start, leaves[stored])
+                memory.transitions.max = float(max_priority)
+        # steps newer than the priority checkpoint start from the maximum priority
+        priority_steps = manifest['priorities']['steps'] if manifest['priorities'] is not None else 0
+        newer = [chunk['indices'][meta['count'] - meta['new']:] for chunk, meta in zip(chunks, manifest['chunks'])
+                 if meta['steps'] > priority_steps]
+        if newer:
+            newer = np.unique(np.concatenate(newer))
+            for memory in replay.agents:
+                memory.transitions.append_batch(newer)
+    return replay
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import torch
+
+"""
+    Sparse observation: flat indices (into c*h*w) of the non-zero pixels of a state and their values. Only the replay
+    stores states this way (--sparse-observation) to shrink its footprint, states are sparsified on append and every
+    sampled batch is densified again before the forward, the game and the nets keep working on dense grids.
+    Rows stored in the replay are padded to a fixed width, padded indices point at c*h*w and are dropped on densify.
+    A blank row (padding frame of the replay) starts with the index c*h*w + 1 and densifies like a blank dense frame:
+    -1 on the action channel, 0 elsewhere.
+    1) to_sparse(state):
+        return (index, value) of the non-zero pixels
+        np.int16 / np.float16 ndarray
+    2) pad_sparse(index, value, width, size):
+        return fixed width (index, value) row
+    3) blank_sparse(width, size):
+        return fixed width (index, value) blank row
+    4) densify(index, value, shape):
+        input (... x k) index and value rows, ndarrays or tensors
+        return (... x shape) float32 tensor
+"""
+
+
+def index_dtype(size):
+    return np.int16 if size + 1 < np.iinfo(np.int16).max else np.int32  # size + 1 marks blank rows
+
+
+def to_sparse(state):
+    flat = state.reshape(-1).cpu().numpy() if torch.is_tensor(state) else np.reshape(state, -1)
+    index = np.flatnonzero(flat)
+    return index.astype(index_dtype(flat.size)), flat[index].astype(np.float16)
+
+
+def pad_sparse(index, value, width, size):
+    if len(index) > width:
+        raise ValueError("Sparse observation has " + str(len(index)) + " non-zero pixels, raise --sparse-nnz")
+    index_pad = np.full(width, size, dtype=index_dtype(size))
+    value_pad = np.zeros(width, dtype=np.float16)
+    index_pad[:len(index)] = index
+    value_pad[:len(value)] = value
+    return index_pad, value_pad
+
+
+def blank_sparse(width, size):
+    index, value = pad_sparse([], [], width, size)
+    index[0] = size + 1
+    return index, value
+
+
+def densify(index, value, shape, device=None):
+    size = int(np.prod(shape))
+    if not torch.is_tensor(index):
+        index, value = torch.as_tensor(np.ascontiguousarray(index)), torch.as_tensor(np.ascontiguousarray(value))
+    index, value = index.to(device=device, dtype=torch.long), value.to(device=device, dtype=torch.float32)
+    dense = torch.zeros(*index.shape[:-1], size + 2, dtype=torch.float32, device=device)
+    dense.scatter_(-1, index, value)  # padded entries and the blank marker land in the two spare last columns
+    blank = index[..., 0] == size + 1
+    dense[..., :size // shape[0]][blank] = -1  # action channel of a blank frame, as the dense layout decodes it
+    return dense[..., :size].reshape(*index.shape[:-1], *shape)
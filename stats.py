@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+"""
+    Counters and log2 histograms of the replay, inference server and other hot paths, cheap enough to stay on in
+    training runs.
+    1) stats.count(name, value=1) / stats.observe(name, values):
+        add to a counter / add one or an array of values to a histogram
+    2) stats.summary():
+        return dict of the seconds since the last reset, counters and histograms (count, sum, mean, min, max,
+        {bucket: count}), bucket b holds values in [2^b, 2^(b+1)), zeros are counted in bucket None
+    3) dump_jsonl(path, records):
+        append one json line per record
+"""
+
+min_bucket, max_bucket = -40, 40
+
+
+def log2_buckets(values):
+    """:return the histogram bucket of each positive value and a mask of the positive values"""
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    positive = values > 0
+    buckets = np.zeros(len(values), dtype=np.int64)
+    buckets[positive] = np.clip(np.floor(np.log2(values[positive])), min_bucket, max_bucket)
+    return buckets, positive
+
+
+class Histogram:
+    def __init__(self):
+        self.count, self.sum, self.min, self.max = 0, 0.0, math.inf, -math.inf
+        self.zeros = 0
+        self.buckets = defaultdict(int)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min, self.max = min(self.min, float(values.min())), max(self.max, float(values.max()))
+        buckets, positive = log2_buckets(values)
+        self.zeros += int(len(values) - positive.sum())
+        for bucket, count in zip(*np.unique(buckets[positive], return_counts=True)):
+            self.buckets[int(bucket)] += int(count)
+
+    def summary(self):
+        buckets = {str(bucket): count for bucket, count in sorted(self.buckets.items())}
+        if self.zeros:
+            buckets['None'] = self.zeros
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else None,
+                'min': self.min if self.count else None, 'max': self.max if self.count else None,
+                'buckets': buckets}
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()  # sampler threads and the learner update the same stats
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = defaultdict(float)
+            self.histograms = defaultdict(Histogram)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, values):
+        with self.lock:
+            self.histograms[name].add(values)
+
+    def summary(self):
+        with self.lock:
+            return {'seconds': time.time() - self.started, 'counters': dict(self.counters),
+                    'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()}}
+
+    # Locks are not picklable, stats travel without theirs
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def dump_jsonl(path, records):
+    with open(path, 'a') as stats_file:
+        for record in records:
+            stats_file.write(json.dumps(record) + '\n')
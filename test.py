@@ -13,6 +13,20 @@ import torch
 import numpy as np
 
 from game import Decentralized_Game as Env
+from inference_server import InferenceServer
+from stats import dump_jsonl
+
+_eval_env = None
+
+
+def _get_eval_env(args):
+    # one evaluation game is kept and reset in place instead of building a new channel per evaluation
+    global _eval_env
+    if _eval_env is None:
+        _eval_env = Env(args)
+    else:
+        _eval_env.reset()
+    return _eval_env
 
 
 def test_parallel(new_game, c_pipe, overall, train_history_aps, eps):
@@ -25,10 +39,11 @@ def test_parallel(new_game, c_pipe, overall, train_history_aps, eps):
     for _ in range(eps):
         if done:
             done = new_game.reset()
-        state, action, _, avail, reward, done, overall_reward = new_game.step_p(c_pipe)  # Step
-        # print(action, reward)
-        reward_sum_aps.append(reward)
-        overall.append(overall_reward)
+        step = new_game.step_p(c_pipe)  # Step
+        done = step.done
+        # print(step.action, step.reward)
+        reward_sum_aps.append(step.reward.cpu().numpy())
+        overall.append(step.overall_reward)
 
     # reward_sum_aps = np.mean(reward_sum_aps, axis=0)
     reward_sum_aps = np.array(reward_sum_aps)
@@ -45,7 +60,7 @@ def test_parallel(new_game, c_pipe, overall, train_history_aps, eps):
 
 # test whole system
 def test(args, T, dqn, val_mem_aps, metrics_all, metrics_aps, results_dir, evaluate=False):
-    env = Env(args)
+    env = _get_eval_env(args)
 
     metrics_all['steps'].append(T)
     T_rewards_aps, T_Qs_aps = [], []
@@ -59,10 +74,11 @@ def test(args, T, dqn, val_mem_aps, metrics_all, metrics_aps, results_dir, evalu
     for _ in range(args.evaluation_episodes):
         if done:
             done = env.reset()
-        state, action, _, avail, reward, done, overall_reward = env.step(dqn)
+        step = env.step(dqn)
+        done = step.done
 
-        reward_sum.append(reward)
-        reward_all.append(overall_reward)
+        reward_sum.append(step.reward.cpu().numpy())
+        reward_all.append(step.overall_reward)
 
     # print(reward_sum)
     reward_sum = np.array(reward_sum)
@@ -71,8 +87,8 @@ def test(args, T, dqn, val_mem_aps, metrics_all, metrics_aps, results_dir, evalu
 
     # Test Q-values over validation memory
     for index, val_mems in enumerate(val_mem_aps):
-        for state in val_mems:  # Iterate over valid states
-            T_Qs_aps[index].append(dqn[index].evaluate_q(state))
+        # all valid states of the ap in one forward
+        T_Qs_aps[index].extend(dqn[index].evaluate_q_batch(val_mems.states()).tolist())
 
     avg_reward_aps, avg_Q_aps = [], []
     for _ in range(env.environment.ap_number):
@@ -116,14 +132,13 @@ def test(args, T, dqn, val_mem_aps, metrics_all, metrics_aps, results_dir, evalu
             _plot_line(metrics_aps[_]['steps'], metrics_aps[_]['rewards'], 'Reward' + str(_), path=results_dir)
             _plot_line(metrics_aps[_]['steps'], metrics_aps[_]['Qs'], 'Q' + str(_), path=results_dir)
 
-    env.close()
     # Return average reward and Q-value
     return (avg_reward_aps, avg_Q_aps, better_aps, np.mean(reward_all))
 
 
 # Test DQN
 def test_p(args, T, dqn, val_mem_aps, metrics_all, metrics_aps, results_dir, evaluate=False):
-    env = Env(args)
+    env = _get_eval_env(args)
 
     metrics_all['steps'].append(T)
     T_rewards_aps, T_Qs_aps, T_rewards = [], [], []
@@ -160,12 +175,11 @@ def test_p(args, T, dqn, val_mem_aps, metrics_all, metrics_aps, results_dir, eva
         for pro in process_list:
             pro.start()
 
-        on_off2 = True
-        while on_off2:
-            temp = np.ones(env.environment.ap_number, dtype=bool)
-            for index in range(env.environment.ap_number):
-                temp[index] = dqn[index].lookup_server_loop(p_pipe_list2[:, index])
-            on_off2 = temp.any()
+        # requests of all workers and aps are answered in batches, one forward per ap
+        server = InferenceServer(dqn, p_pipe_list2, args.inference_batch, args.inference_wait / 1000)
+        server.serve()
+        if args.inference_stats is not None:
+            dump_jsonl(args.inference_stats, [dict(server.summary(), T=T)])
 
         for pro in process_list:
             pro.join()
@@ -180,8 +194,8 @@ def test_p(args, T, dqn, val_mem_aps, metrics_all, metrics_aps, results_dir, eva
 
     # Test Q-values over validation memory
     for index, val_mems in enumerate(val_mem_aps):
-        for state in val_mems:  # Iterate over valid states
-            T_Qs_aps[index].append(dqn[index].evaluate_q(state))
+        # all valid states of the ap in one forward
+        T_Qs_aps[index].extend(dqn[index].evaluate_q_batch(val_mems.states()).tolist())
 
     avg_reward_aps, avg_Q_aps = [], []
     for _ in range(env.environment.ap_number):
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import memory  # noqa: E402
+
+
+def replay_args(**overrides):
+    """:return the replay arguments of train.py at their defaults, with overrides"""
+    args = dict(device='cpu', current_action_observable=True, previous_action_observable=True, memory_capacity=64,
+                history_length=1, multi_step=3, discount=0.9, priority_weight=0.4, priority_exponent=0.5,
+                data_reinforce=False, sparse_observation=False, sparse_nnz=256, compact_transition=False,
+                global_frame=False)
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def random_steps(rng, steps, agents, terminal_probability=0.1):
+    """:return the append_batch arguments of steps random steps of every agent, with random episode ends"""
+    state = np.zeros((steps, agents) + memory.state_shape, dtype=np.float32)
+    state[:, :, 0] = rng.choice([-1, 0, 1], size=state[:, :, 0].shape)
+    state[:, :, 1] = rng.randint(0, 256, size=state[:, :, 1].shape) / 255
+    action_number, ap_number = memory.gp.ACTION_NUM, memory.gp.NUM_OF_ACCESSPOINT
+    return (torch.from_numpy(state), rng.randint(0, action_number, size=(steps, agents)),
+            rng.rand(steps, agents, action_number), rng.randint(0, action_number, size=(steps, agents, 7)),
+            rng.randint(0, action_number, size=(steps, ap_number)), rng.rand(steps, agents, action_number) < 0.8,
+            rng.randn(steps, agents).astype(np.float32), rng.rand(steps) < terminal_probability)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import torch
+
+import action_sampler
+
+ROWS, ACTIONS, DRAWS = 6, 13, 2000
+
+
+def _mask(generator):
+    mask = torch.rand(ROWS, ACTIONS, generator=generator) < 0.4
+    mask[:, 0] = mask[:, ACTIONS - 1] = True  # at least two valid actions
+    mask[0] = False  # no valid action at all
+    mask[1] = False
+    mask[1, 3] = True  # a single valid action
+    return mask
+
+
+def _repeat(tensor):
+    return tensor.unsqueeze(0).expand(DRAWS, *tensor.shape)
+
+
+def test_categorical_never_picks_a_masked_action():
+    generator = torch.Generator().manual_seed(0)
+    torch.manual_seed(0)
+    mask = _mask(generator)
+    weights = torch.rand(ROWS, ACTIONS, generator=generator)
+    weights[2] = 0  # valid weights summing to zero
+    weights[3] = -1
+    for logits in (False, True):
+        actions = action_sampler.categorical(_repeat(weights), _repeat(mask), logits=logits)
+        assert actions.shape == (DRAWS, ROWS)
+        for row in range(2, ROWS):
+            assert mask[row, actions[:, row]].all(), (row, logits)
+        assert (actions[:, 1] == 3).all()
+
+
+def test_categorical_falls_back_to_uniform():
+    torch.manual_seed(1)
+    mask = _mask(torch.Generator().manual_seed(1))
+    weights = torch.zeros(ROWS, ACTIONS)
+    actions = action_sampler.categorical(_repeat(weights), _repeat(mask))
+    # an all-zero mask samples from every action, zero weights from the valid ones, both uniformly
+    counts = np.bincount(actions[:, 0].numpy(), minlength=ACTIONS)
+    assert (counts > 0).all() and counts.max() < 2 * DRAWS / ACTIONS
+    for row in range(2, ROWS):
+        valid = mask[row].nonzero().view(-1).numpy()
+        counts = np.bincount(actions[:, row].numpy(), minlength=ACTIONS)
+        assert set(np.flatnonzero(counts)) == set(valid)
+        assert counts.max() < 2 * DRAWS / len(valid)
+
+
+def test_greedy_picks_the_masked_argmax():
+    generator = torch.Generator().manual_seed(2)
+    mask = _mask(generator)
+    values = torch.randn(ROWS, ACTIONS, generator=generator)
+    actions = action_sampler.greedy(values, mask)
+    assert actions[0] == values[0].argmax() and actions[1] == 3
+    for row in range(2, ROWS):
+        assert actions[row] == values[row].masked_fill(~mask[row], -np.inf).argmax()
+    assert torch.equal(action_sampler.greedy(values), values.argmax(-1))
+
+
+def test_epsilon_greedy_explores_only_valid_actions():
+    torch.manual_seed(3)
+    generator = torch.Generator().manual_seed(3)
+    mask = _mask(generator)
+    values = torch.randn(ROWS, ACTIONS, generator=generator)
+    greedy = action_sampler.greedy(values, mask)
+    assert torch.equal(action_sampler.epsilon_greedy(values, mask, 0.), greedy)
+    actions = action_sampler.epsilon_greedy(_repeat(values), _repeat(mask), 0.5)
+    for row in range(2, ROWS):
+        assert mask[row, actions[:, row]].all(), row
+        assert (actions[:, row] != greedy[row]).any()  # some rows explored
+    assert (actions[:, 1] == 3).all()
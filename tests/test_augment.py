@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import torch
+
+import memory
+from conftest import replay_args
+from game import Decentralized_Game as Game
+
+BATCH = 64
+
+
+def _keep_isolated(transform):
+    # the tables keep the isolated action 12 and the -1 padding in place
+    def apply(act):
+        act = np.asarray(act)
+        return np.where(act == 12, 12, transform(int(act)) if act.ndim == 0 else transform(act.copy()))
+    return apply
+
+
+# Explicit symmetries of one dense (c x h x w) state: grid transform, action map, avail map
+SYMMETRIES = [(lambda obs: obs, lambda act: np.asarray(act), lambda avail: avail),
+              (lambda obs: torch.rot90(obs, 2, [1, 2]), _keep_isolated(Game.rot_action), Game.rot_avail),
+              (lambda obs: torch.flip(torch.rot90(obs, 2, [1, 2]), [1]),
+               _keep_isolated(lambda act: Game.flip_action(Game.rot_action(act))),
+               lambda avail: Game.flip_avail(Game.rot_avail(avail))),
+              (lambda obs: torch.flip(obs, [1]), _keep_isolated(Game.flip_action), Game.flip_avail)]
+
+
+def _batch(rng):
+    state = torch.from_numpy(rng.rand(BATCH, 2, 47, 47).astype(np.float32))  # distinct pixels tell symmetries apart
+    next_state = torch.from_numpy(rng.rand(BATCH, 2, 47, 47).astype(np.float32))
+    action = torch.from_numpy(rng.randint(0, 12, BATCH))
+    action_logp = torch.from_numpy(rng.rand(BATCH, 13).astype(np.float32))
+    nei_action = torch.from_numpy(rng.randint(-1, 13, (BATCH, 7)))
+    glob_action = torch.from_numpy(rng.randint(-1, 13, (BATCH, 20)))
+    avail = torch.from_numpy(rng.rand(BATCH, 13) < 0.5)
+    avail[:, 12] = True  # the isolated action is always available
+    return state, next_state, action, action_logp, nei_action, glob_action, avail
+
+
+def test_augment_matches_explicit_rotations_and_flips():
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    replay = memory.ReplayMemory(replay_args(data_reinforce=True), 16, remove_function=lambda x: x)
+    batch = _batch(rng)
+    reward = torch.from_numpy(rng.rand(BATCH) < 0.8).float()
+    rows = {'action': batch[2], 'reward': reward}
+    out = replay._augment(rows, *batch)
+    seen = set()
+    for i in range(BATCH):
+        # the sample got exactly one symmetry, the one its state was transformed with
+        matches = [k for k, (grid, _, _) in enumerate(SYMMETRIES) if torch.equal(out[0][i], grid(batch[0][i]))]
+        assert len(matches) == 1
+        k = matches[0]
+        grid, act, avail = SYMMETRIES[k]
+        seen.add(k)
+        if reward[i] == 0:
+            assert k == 0  # transitions without reward are not augmented
+        assert torch.equal(out[1][i], grid(batch[1][i]))
+        assert out[2][i].item() == act(batch[2][i].item())
+        assert np.array_equal(out[3][i].numpy()[act(np.arange(13))], batch[3][i].numpy())
+        assert np.array_equal(out[4][i].numpy(), act(batch[4][i].numpy()))
+        assert np.array_equal(out[5][i].numpy(), act(batch[5][i].numpy()))
+        assert np.array_equal(out[6][i].numpy(), avail(batch[6][i].numpy()))
+    assert seen == {0, 1, 2, 3}
+
+
+def test_augment_tables_are_built_once():
+    first = memory.ReplayMemory(replay_args(data_reinforce=True), 16, remove_function=lambda x: x)
+    second = memory.ReplayMemory(replay_args(data_reinforce=True), 16, remove_function=lambda x: x)
+    for name in ('action_table', 'raw_action_table', 'pixel_table'):
+        assert getattr(first, name) is getattr(second, name), name
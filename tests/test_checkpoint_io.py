@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import numpy as np
+import pytest
+
+import checkpoint_io
+
+
+def _listed(path):
+    with open(os.path.join(path, 'manifest.json')) as manifest_file:
+        return sorted(entry['file'] for entry in json.load(manifest_file)['items'].values()) + ['manifest.json']
+
+
+def test_save_replaces_previous_checkpoint(tmp_path):
+    path = str(tmp_path)
+    for step in range(3):
+        checkpoint_io.save_checkpoint(path, {'model0': np.full(4, step), 'model1': step})
+        assert sorted(os.listdir(path)) == _listed(path)
+    items = checkpoint_io.load_checkpoint(path)
+    assert np.array_equal(items['model0'], np.full(4, 2)) and items['model1'] == 2
+
+
+def test_interrupted_save_keeps_previous_checkpoint(tmp_path, monkeypatch):
+    path = str(tmp_path)
+    checkpoint_io.save_checkpoint(path, {'model0': 'old', 'model1': 'old'})
+    write_item = checkpoint_io._write_item
+
+    def crash(path, name, item, codec, version):
+        if name == 'model1':
+            raise OSError("No space left on device")
+        return write_item(path, name, item, codec, version)
+    monkeypatch.setattr(checkpoint_io, '_write_item', crash)
+    with pytest.raises(OSError):
+        checkpoint_io.save_checkpoint(path, {'model0': 'new', 'model1': 'new'})
+    assert checkpoint_io.load_checkpoint(path) == {'model0': 'old', 'model1': 'old'}
+
+    monkeypatch.setattr(checkpoint_io, '_write_item', write_item)
+    checkpoint_io.save_checkpoint(path, {'model0': 'new', 'model1': 'new'})
+    assert checkpoint_io.load_checkpoint(path) == {'model0': 'new', 'model1': 'new'}
+    assert sorted(os.listdir(path)) == _listed(path)  # the files of the interrupted save are gone too
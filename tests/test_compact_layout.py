@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import torch
+
+import memory
+from conftest import random_steps, replay_args
+
+STEPS = 40
+
+
+def test_pack_bits_round_trip_at_the_width_limits():
+    rng = np.random.RandomState(0)
+    size = 47 * 47  # not a multiple of the codes per byte
+    for bits in (2, memory.qos_bits):
+        codes = rng.randint(0, 2 ** bits, size=(3, size))
+        codes[0], codes[1, ::2] = 2 ** bits - 1, 0
+        packed = memory._pack_bits(codes, bits)
+        assert packed.shape == (3, memory.packed_size(size, bits)) and packed.dtype == np.uint8
+        assert np.array_equal(memory._unpack_bits(torch.from_numpy(packed), bits, size).numpy(), codes)
+
+
+def _steps(rng):
+    state, action, action_logp, nei_action, glob_action, avail, reward, terminal = random_steps(rng, STEPS, 1, 0.3)
+    levels = 2 ** memory.qos_bits - 1
+    state[:, :, 1] = torch.from_numpy(rng.randint(0, levels + 1, size=state[:, :, 1].shape) / levels)  # exact in both
+    action[:2], action[2:4] = 0, memory.gp.ACTION_NUM - 1  # action codes at both ends
+    avail[0], avail[1], avail[2] = True, False, np.eye(memory.gp.ACTION_NUM, dtype=bool)[-1]  # all, none, top bit
+    terminal[:3], terminal[-1] = True, True
+    return state[:, 0], action[:, 0], action_logp[:, 0], nei_action[:, 0], glob_action, avail[:, 0], reward[:, 0], \
+        terminal
+
+
+def test_compact_layout_decodes_like_dense():
+    steps = _steps(np.random.RandomState(1))
+    replays = [memory.ReplayMemory(replay_args(compact_transition=compact), 64, remove_function=lambda x: x)
+               for compact in (False, True)]
+    for replay in replays:
+        replay.append_batch(*steps)
+    idxs = np.arange(STEPS)
+    decoded = []
+    for replay in replays:
+        rows = replay.store.gather(idxs, 0)
+        frames = replay.store.gather(idxs[:, None], 0, replay.store.state_fields)
+        decoded.append((rows, replay._get_avail(rows), replay._decode_frames(frames, slice(0, 1))[:, 0]))
+    (dense_rows, dense_avail, dense_state), (compact_rows, compact_avail, compact_state) = decoded
+    assert compact_rows['action_logp'].dtype == torch.float16 and compact_rows['avail'].dtype == torch.int16
+    assert torch.equal(compact_avail, dense_avail)
+    assert torch.equal(dense_avail, torch.as_tensor(steps[5]))
+    for name in ('action', 'timestep', 'nonterminal', 'reward', 'neighbor_action', 'global_action'):
+        assert torch.equal(compact_rows[name], dense_rows[name]), name
+    assert torch.equal(compact_rows['nonterminal'], torch.as_tensor(~steps[7]))
+    assert torch.allclose(compact_rows['action_logp'].double(), dense_rows['action_logp'], atol=1e-3)
+    assert torch.equal(compact_state[:, 0], dense_state[:, 0])
+    assert torch.allclose(compact_state, dense_state, atol=1.01 / 255)  # the dense layout truncates to 8 bits
+    assert torch.allclose(compact_state, steps[0], atol=1e-6)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import argparse
+import copy
+import pickle
+
+import torch
+
+from acer_fedstep.agent import Agent
+from acer_fedstep.fused_learner import FusedLearner
+
+AGENTS, BATCH = 3, 8
+
+
+class _Env:
+    def get_action_size(self):
+        return 13
+
+
+class _FixedMemory:
+    # hands out the same batch to both learners and records the priorities they set
+    def __init__(self, seed):
+        generator = torch.Generator().manual_seed(seed)
+        self.idxs = (torch.arange(BATCH).numpy(), torch.arange(BATCH).numpy())
+        self.states = torch.randint(-1, 2, (BATCH, 2, 47, 47), generator=generator).float()
+        self.next_states = torch.randint(-1, 2, (BATCH, 2, 47, 47), generator=generator).float()
+        self.actions = torch.randint(0, 13, (BATCH,), generator=generator)
+        self.returns = torch.rand(BATCH, generator=generator) * 2 - 1
+        self.nonterminals = (torch.rand(BATCH, 1, generator=generator) < 0.8).float()
+        self.weights = torch.rand(BATCH, generator=generator) + 0.5
+        self.priorities = None
+
+    def sample(self, batch_size, avg=0):
+        assert batch_size == BATCH
+        avail = torch.ones(BATCH, 13, dtype=torch.bool)
+        return self.idxs, self.states, self.actions, None, None, None, avail, self.returns - avg, \
+               self.next_states, self.nonterminals, self.weights
+
+    def update_priorities(self, idxs, priorities):
+        self.priorities = priorities
+
+
+def _args():
+    return argparse.Namespace(atoms=5, action_selection='boltzmann', V_min=-1., V_max=1., batch_size=BATCH,
+                              multi_step=3, discount=0.9, device='cpu', architecture='canonical_pooling_20ap',
+                              reward_update_rate=0.01, model=None, history_length=1, hidden_size=16, noisy_std=0.3,
+                              learning_rate=1e-3, adam_eps=1.5e-4)
+
+
+def test_fused_learn_matches_separate_agents():
+    args = _args()
+    agents = []
+    for index in range(AGENTS):
+        torch.manual_seed(index)
+        agent = Agent(args, _Env(), index)
+        agent.shared_net.load_state_dict(agent.online_net.state_dict())
+        agent.average_reward = 0.1 * index
+        agents.append(agent)
+    separate = copy.deepcopy(agents)
+    fused_mems, separate_mems = [_FixedMemory(index) for index in range(AGENTS)], \
+                                [_FixedMemory(index) for index in range(AGENTS)]
+
+    fused_losses = FusedLearner(args, agents).learn(fused_mems)
+    separate_losses = torch.stack([agent.learn(mem) for agent, mem in zip(separate, separate_mems)])
+
+    assert torch.allclose(fused_losses, separate_losses, atol=1e-5)
+    for fused, agent, fused_mem, mem in zip(agents, separate, fused_mems, separate_mems):
+        assert abs(float(fused.average_reward) - float(agent.average_reward)) < 1e-6
+        assert torch.allclose(torch.as_tensor(fused_mem.priorities), torch.as_tensor(mem.priorities), atol=1e-5)
+        separate_state = agent.online_net.state_dict()
+        for name, tensor in fused.get_state_dict().items():
+            assert torch.allclose(tensor, separate_state[name], atol=1e-6), name
+
+
+def test_fused_state_dicts_hold_one_agent():
+    args = _args()
+    agents = [Agent(args, _Env(), index) for index in range(AGENTS)]
+    single = len(pickle.dumps(agents[0].get_state_dict()))
+    FusedLearner(args, agents)
+    for agent in agents:
+        state_dict, target_dict = agent.get_state_dict(), agent.get_target_dict()
+        for tensor in list(state_dict.values()) + list(target_dict.values()):
+            assert tensor.untyped_storage().nbytes() == tensor.numel() * tensor.element_size()
+        assert len(pickle.dumps(state_dict)) < 1.5 * single
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import threading
+from multiprocessing import Pipe
+
+import numpy as np
+import torch
+
+from inference_server import InferenceServer
+
+CLOSE = (np.array([False]), np.array([False]))
+
+
+class _Agent:
+    # answers every request with (ap, request id), records the size of every batch
+    def __init__(self, ap):
+        self.ap = ap
+        self.batches = []
+
+    def act_boltzmann_batch(self, states, avails):
+        assert len(states) == len(avails)
+        self.batches.append(len(states))
+        return [(self.ap, int(state[0])) for state in states]
+
+
+def _start(workers, aps, max_batch=0, max_wait=0.002):
+    pipes = [[Pipe() for _ in range(aps)] for _ in range(workers)]
+    agents = [_Agent(ap) for ap in range(aps)]
+    server = InferenceServer(agents, [[parent for parent, _ in row] for row in pipes], max_batch, max_wait)
+    thread = threading.Thread(target=server.serve, daemon=True)
+    return server, agents, [[child for _, child in row] for row in pipes], thread
+
+
+def _request(pipe, request_id):
+    pipe.send((torch.tensor([float(request_id)]), np.ones(13, dtype=bool)))
+
+
+def _stop(children, thread):
+    for row in children:
+        for pipe in row:
+            if not pipe.closed:
+                pipe.send(CLOSE)
+    thread.join(5)
+    assert not thread.is_alive()  # every pipe closed ends serve
+
+
+def test_results_go_back_to_the_requesting_pipe():
+    server, agents, children, thread = _start(workers=3, aps=2)
+    thread.start()
+    try:
+        for round_ in range(2):
+            for worker, row in enumerate(children):
+                for ap, pipe in enumerate(row):
+                    _request(pipe, 100 * round_ + 10 * worker + ap)
+            for worker, row in enumerate(children):
+                for ap, pipe in enumerate(row):
+                    assert pipe.poll(5)
+                    assert pipe.recv() == (ap, 100 * round_ + 10 * worker + ap)
+        children[0][0].close()  # a worker that went away closes its pipe like the sentinel
+    finally:
+        _stop(children, thread)
+    assert sum(sum(agent.batches) for agent in agents) == 12
+    assert server.summary()['counters']['requests'] == 12
+
+
+def test_batches_hold_at_most_max_batch_requests():
+    server, agents, children, thread = _start(workers=6, aps=1, max_batch=4, max_wait=0.05)
+    for worker, row in enumerate(children):
+        _request(row[0], worker)  # all pending before the server looks
+    thread.start()
+    try:
+        for worker, row in enumerate(children):
+            assert row[0].poll(5)
+            assert row[0].recv() == (0, worker)
+    finally:
+        _stop(children, thread)
+    assert agents[0].batches == [4, 2]
+
+
+def test_partial_batch_is_flushed_after_max_wait():
+    server, agents, children, thread = _start(workers=3, aps=1, max_wait=0.01)  # waits for one request per pipe
+    thread.start()
+    try:
+        _request(children[0][0], 0)
+        _request(children[1][0], 1)
+        for worker in (0, 1):
+            assert children[worker][0].poll(5)  # answered without the third worker
+            assert children[worker][0].recv() == (0, worker)
+        _request(children[2][0], 2)
+        assert children[2][0].poll(5)
+        assert children[2][0].recv() == (0, 2)
+    finally:
+        _stop(children, thread)
+    assert agents[0].batches[-1] == 1 and sum(agents[0].batches) == 3
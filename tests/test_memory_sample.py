@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import numpy as np
+
+import memory
+from conftest import random_steps, replay_args
+
+
+def test_sample_hands_out_gather_buffers_that_survive_the_next_draw():
+    rng = np.random.RandomState(0)
+    np.random.seed(0)
+    replay = memory.ReplayMemory(replay_args(), 64, remove_function=lambda x: x)
+    state, action, action_logp, nei_action, glob_action, avail, reward, terminal = random_steps(rng, 60, 1)
+    replay.append_batch(state[:, 0], action[:, 0], action_logp[:, 0], nei_action[:, 0], glob_action, avail[:, 0],
+                        reward[:, 0], terminal)
+    first = replay._get_sample_from_segment(8)
+    kept = {field: getattr(first, field).clone() for field in ('returns', 'avail', 'nonterminal', 'state')}
+    rows = replay.buffers[(threading.get_ident(), 'sample_rows')][0]  # what the first draw gathered into
+    assert first.returns.data_ptr() == rows['nstep_return'].data_ptr()  # no copy after the gather
+    second = replay._get_sample_from_segment(8)
+    assert second.returns.data_ptr() != first.returns.data_ptr()
+    for field, value in kept.items():
+        assert (getattr(first, field) == value).all(), field
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import memory
+from conftest import random_steps, replay_args
+
+CAPACITY, AGENTS, N, DISCOUNT = 32, 2, 3, 0.9
+
+
+def _brute_force(store):
+    """:return rows and their n-step return, bootstrap mask and episode end computed per row as at sample time"""
+    count = store.capacity if store.full else store.index
+    rows = (store.index - count + np.arange(count - N)) % store.capacity  # rows with n steps stored after them
+    first = store.columns['timestep'] == 0
+    returns = np.zeros((len(rows), store.agent_number))
+    bootstrap, episode_end = np.zeros(len(rows), dtype=bool), np.full(len(rows), N + 1)
+    for i, row in enumerate(rows):
+        blank = False  # once a later step starts an episode, all steps from it on are blank
+        for k in range(N + 1):
+            step = (row + k) % store.capacity
+            if k > 0 and first[step] and not blank:
+                blank, episode_end[i] = True, k
+            if k < N and not blank:
+                returns[i] += DISCOUNT ** k * store.columns['reward'][step]
+        bootstrap[i] = store.columns['nonterminal'][(row + N) % store.capacity] and not blank
+    return rows, returns, bootstrap, episode_end
+
+
+def test_nstep_returns_match_brute_force():
+    rng = np.random.RandomState(0)
+    replay = memory.MultiAgentReplayMemory(replay_args(memory_capacity=CAPACITY, multi_step=N, discount=DISCOUNT),
+                                           CAPACITY, AGENTS, remove_function=lambda x: x)
+    store = replay.store
+    # single steps, short runs and full-capacity runs, wrapping around the ring several times
+    for steps in (1, 1, 5, 29, 1, 32, 3, 17, 1, 1, 30, 32, 9):
+        batch = random_steps(rng, steps, AGENTS, terminal_probability=0.2)
+        if steps == 1:
+            replay.append(*[value[0] for value in batch])
+        else:
+            replay.append_batch(*batch)
+        rows, returns, bootstrap, episode_end = _brute_force(store)
+        assert np.allclose(store.columns['nstep_return'][rows], returns, atol=1e-5)
+        assert np.array_equal(store.columns['bootstrap'][rows], bootstrap)
+        assert np.array_equal(store.columns['episode_end'][rows], episode_end)
+    assert store.steps > 3 * CAPACITY
+
+
+def test_rebuild_returns_matches_appends():
+    rng = np.random.RandomState(1)
+    replay = memory.MultiAgentReplayMemory(replay_args(memory_capacity=CAPACITY, multi_step=N, discount=DISCOUNT),
+                                           CAPACITY, AGENTS, remove_function=lambda x: x)
+    for steps in (20, 30, 7):
+        replay.append_batch(*random_steps(rng, steps, AGENTS, terminal_probability=0.2))
+    appended = {name: replay.store.columns[name].copy() for name, _ in memory.return_fields}
+    replay.store.rebuild_returns(N, DISCOUNT)
+    for name, column in appended.items():
+        assert np.array_equal(replay.store.columns[name], column), name
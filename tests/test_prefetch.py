@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import memory
+from conftest import random_steps, replay_args
+
+CAPACITY = 16
+TARGET = 10  # a row away from the write head at index 5
+
+
+def _replay(seed=0):
+    rng = np.random.RandomState(seed)
+    replay = memory.ReplayMemory(replay_args(memory_capacity=CAPACITY), CAPACITY, remove_function=lambda x: x)
+    for run in (CAPACITY, 5):
+        state, action, action_logp, nei_action, glob_action, avail, reward, terminal = random_steps(rng, run, 1, 0.)
+        replay.append_batch(state[:, 0], action[:, 0], action_logp[:, 0], nei_action[:, 0], glob_action,
+                            avail[:, 0], reward[:, 0], terminal)
+    return replay
+
+
+def _favour_target(sampler):
+    # two queued updates, only the second one leaves TARGET as the row every draw lands on
+    tree = sampler.memory.transitions
+    sampler.update_priorities(np.arange(CAPACITY) + tree.tree_start, np.full(CAPACITY, 1e-6))
+    sampler.update_priorities(np.array([TARGET + tree.tree_start]), np.array([1e6]))
+
+
+def test_priority_updates_apply_before_the_next_draw():
+    np.random.seed(0)
+    sampler = memory.PrefetchSampler(_replay(), 8, depth=1)
+    try:
+        sampler.sample(8)
+        _favour_target(sampler)
+        sampler.sample(8)  # drawn ahead of the updates, may still be stale
+        idxs = sampler.sample(8)[0][1]
+        assert np.all(idxs == TARGET)
+    finally:
+        sampler.close()
+
+
+def test_close_joins_the_worker_and_drains_updates():
+    np.random.seed(1)
+    for started in (False, True):
+        replay = _replay()
+        sampler = memory.PrefetchSampler(replay, 8, depth=2)
+        if started:
+            sampler.sample(8)
+        thread = sampler.thread
+        _favour_target(sampler)
+        sampler.close()
+        assert sampler.thread is None and sampler.updates.empty()
+        assert thread is None or not thread.is_alive()
+        leaves = replay.transitions.priorities(CAPACITY)
+        exponent = replay.priority_exponent
+        assert np.isclose(leaves[TARGET], 1e6 ** exponent)
+        assert np.allclose(np.delete(leaves, TARGET), 1e-6 ** exponent)
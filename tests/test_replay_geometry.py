@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+import torch
+
+import memory
+from conftest import replay_args
+
+CAPACITY, AGENTS = 32, 2
+GEOMETRY = memory.ReplayGeometry((2, 15, 15), 4, 5)  # a smaller observation and topology than the stock one
+LAYOUTS = (dict(), dict(sparse_observation=True, sparse_nnz=2 * 15 * 15), dict(compact_transition=True))
+
+
+def _steps(rng):
+    state_shape, neighbor_number, ap_number = GEOMETRY
+    state = np.zeros((CAPACITY, AGENTS) + state_shape, dtype=np.float32)
+    state[:, :, 0] = rng.choice([-1, 0, 1], size=state[:, :, 0].shape)
+    state[:, :, 1] = rng.randint(0, 16, size=state[:, :, 1].shape) / 15  # on the qos grid of the compact layout
+    action_number = memory.gp.ACTION_NUM
+    return (torch.from_numpy(state), rng.randint(0, action_number, size=(CAPACITY, AGENTS)),
+            rng.rand(CAPACITY, AGENTS, action_number),
+            rng.randint(0, action_number, size=(CAPACITY, AGENTS, neighbor_number)),
+            rng.randint(0, action_number, size=(CAPACITY, ap_number)), rng.rand(CAPACITY, AGENTS, action_number) < 0.8,
+            rng.randn(CAPACITY, AGENTS).astype(np.float32), rng.rand(CAPACITY) < 0.1)
+
+
+def test_layouts_follow_the_geometry():
+    np.random.seed(0)
+    steps = _steps(np.random.RandomState(0))
+    for overrides in LAYOUTS:
+        replay = memory.MultiAgentReplayMemory(replay_args(memory_capacity=CAPACITY, **overrides), CAPACITY, AGENTS,
+                                               remove_function=lambda x: x, geometry=GEOMETRY)
+        columns = replay.store.columns
+        assert columns['neighbor_action'].shape == (CAPACITY, AGENTS, 4), overrides
+        assert columns['global_action'].shape == (CAPACITY, 5), overrides
+        replay.append_batch(*steps)
+        for agent in range(AGENTS):
+            # every row is written once, so the states come back in append order, the dense layout truncates to 8 bits
+            assert torch.allclose(replay[agent].states(), steps[0][:, agent], atol=1.01 / 255), overrides
+        sample = replay[0].sample(4)
+        assert sample[1].shape == (4,) + GEOMETRY.state_shape and sample[8].shape == (4,) + GEOMETRY.state_shape
+        assert sample[4].shape == (4, 4) and sample[5].shape == (4, 5)
+
+
+def test_compact_layout_rejects_other_channel_counts():
+    geometry = memory.ReplayGeometry((3, 15, 15), 4, 5)
+    with pytest.raises(ValueError):
+        memory.transition_layout(replay_args(compact_transition=True), AGENTS, geometry=geometry)
+    dtype, _ = memory.transition_layout(replay_args(), AGENTS, geometry=geometry)
+    assert dtype['state'].shape == (3, 15, 15)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import numpy as np
+
+import memory
+from conftest import random_steps, replay_args
+from replay_snapshot import ReplaySnapshot, load_snapshot
+
+CAPACITY, AGENTS = 32, 2
+
+
+def _replay():
+    return memory.MultiAgentReplayMemory(replay_args(memory_capacity=CAPACITY), CAPACITY, AGENTS,
+                                         remove_function=lambda x: x)
+
+
+def _leaves(replay):
+    tree = replay.agents[0].transitions
+    return np.stack([agent.transitions.sum_tree[tree.tree_start:tree.tree_start + CAPACITY]
+                     for agent in replay.agents])
+
+
+def test_snapshot_round_trip(tmp_path):
+    rng = np.random.RandomState(0)
+    replay = _replay()
+    snapshot = ReplaySnapshot(replay, str(tmp_path), priority_interval=1)
+    for steps in (5, 20, 13, 30, 7):  # wraps around the ring and compacts fully overwritten chunks
+        replay.append_batch(*random_steps(rng, steps, AGENTS))
+        for agent in replay.agents:
+            tree_idxs = rng.randint(0, CAPACITY, size=8) + agent.transitions.tree_start
+            agent.update_priorities(tree_idxs, rng.rand(8) + 0.1)
+        snapshot.snapshot()
+    snapshot.close()
+
+    with open(os.path.join(str(tmp_path), 'manifest.json')) as manifest_file:
+        manifest = json.load(manifest_file)
+    listed = [chunk['file'] for chunk in manifest['chunks']] + [manifest['priorities']['file'], 'manifest.json']
+    assert sorted(os.listdir(str(tmp_path))) == sorted(listed)
+
+    loaded = load_snapshot(_replay(), str(tmp_path))
+    for name, column in replay.store.columns.items():
+        assert np.array_equal(loaded.store.columns[name], column), name
+    for name in ('index', 'full', 't', 'steps'):
+        assert getattr(loaded.store, name) == getattr(replay.store, name), name
+    assert np.allclose(_leaves(loaded), _leaves(replay))
+    assert [agent.transitions.max for agent in loaded.agents] == [agent.transitions.max for agent in replay.agents]
+
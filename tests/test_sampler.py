@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import memory
+from conftest import random_steps, replay_args
+
+CAPACITY = 16
+
+
+def _replay(steps, seed=0):
+    rng = np.random.RandomState(seed)
+    replay = memory.ReplayMemory(replay_args(memory_capacity=CAPACITY, multi_step=3, history_length=1), CAPACITY,
+                                 remove_function=lambda x: x)
+    while steps > 0:
+        run = min(steps, CAPACITY)
+        state, action, action_logp, nei_action, glob_action, avail, reward, terminal = random_steps(rng, run, 1, 0.)
+        replay.append_batch(state[:, 0], action[:, 0], action_logp[:, 0], nei_action[:, 0], glob_action,
+                            avail[:, 0], reward[:, 0], terminal)
+        steps -= run
+    return replay
+
+
+def _rounds(replay):
+    return replay.stats.summary()['histograms']['sample_rounds']['max']
+
+
+def test_sampling_ends_when_the_forbidden_region_holds_most_priority():
+    np.random.seed(0)
+    replay = _replay(CAPACITY + 5)
+    tree = replay.transitions
+    forbidden = (replay.store.index + np.arange(-replay.n, replay.history)) % CAPACITY
+    tree.update(np.arange(CAPACITY) + tree.tree_start, 1e-3)
+    tree.update(forbidden + tree.tree_start, 1e6)  # almost every stratum lands in the write head region
+    before = tree.sum_tree.copy()
+    for _ in range(20):
+        probs, idxs, _, _ = replay._sample_idxs(32)
+        assert np.all(replay._valid(idxs, probs))
+        assert not np.isin(idxs, forbidden).any()
+    assert np.array_equal(tree.sum_tree, before)  # excluded leaves are put back
+    assert _rounds(replay) <= memory.sample_retries
+
+
+def test_sampling_rounds_are_bounded(monkeypatch):
+    np.random.seed(1)
+    replay = _replay(CAPACITY + 5)
+    valid = replay._valid
+    calls = []
+
+    def reject_first_half(idxs, probs):
+        calls.append(len(idxs))
+        result = valid(idxs, probs)
+        result[:len(idxs) // 2] = False  # some strata never get a valid draw
+        return result
+    monkeypatch.setattr(replay, '_valid', reject_first_half)
+    before = replay.transitions.sum_tree.copy()
+    probs, idxs, _, _ = replay._sample_idxs(8)
+    assert len(calls) == memory.sample_retries
+    assert np.all(valid(idxs, probs))  # strata left invalid reuse valid draws of the batch
+    assert replay.stats.summary()['counters']['sample_fallbacks'] > 0
+    assert np.array_equal(replay.transitions.sum_tree, before)
+
+
+def test_sampling_raises_when_every_candidate_is_invalid():
+    np.random.seed(2)
+    replay = _replay(3)  # every stored row is within n steps of the write head
+    before = replay.transitions.sum_tree.copy()
+    with pytest.raises(ValueError):
+        replay.sample(4)
+    assert np.array_equal(replay.transitions.sum_tree, before)
+    assert _rounds(replay) == memory.sample_retries
+
+
+def test_sampling_raises_when_validity_never_holds(monkeypatch):
+    np.random.seed(3)
+    replay = _replay(CAPACITY)
+    monkeypatch.setattr(replay, '_valid', lambda idxs, probs: np.zeros(len(idxs), dtype=bool))
+    before = replay.transitions.sum_tree.copy()
+    with pytest.raises(ValueError):
+        replay.sample(4)
+    assert np.array_equal(replay.transitions.sum_tree, before)
+    assert _rounds(replay) == memory.sample_retries
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from memory import SegmentTree
+
+
+def _check(tree, leaves, rng):
+    """Compares total, min and find of the tree with a cumulative sum over the naive leaves"""
+    cumsum = np.cumsum(np.where(np.isinf(leaves), 0, leaves))
+    assert tree.total() == cumsum[-1]
+    assert tree.min() == leaves.min()
+    # boundaries of every leaf, both ends of the range and random points inside it
+    values = np.concatenate([[0, cumsum[-1]], cumsum, cumsum - 0.5, rng.uniform(0, cumsum[-1], 64)])
+    values = values[(values >= 0) & (values <= cumsum[-1])].astype(np.float32)  # the precision the tree searches in
+    found, data_index, tree_index = tree.find(values)
+    expected = np.minimum(np.searchsorted(cumsum, values, side='left'), tree.size - 1)
+    np.testing.assert_array_equal(data_index, expected)
+    np.testing.assert_array_equal(tree_index, expected + tree.tree_start)
+    np.testing.assert_array_equal(found, np.where(np.isinf(leaves), 0, leaves)[expected])
+
+
+def test_segment_tree_matches_naive_search():
+    rng = np.random.RandomState(0)
+    for size in (1, 2, 3, 7, 8, 13, 64, 100):
+        tree = SegmentTree(size)
+        leaves = np.full(size, np.inf)  # never written leaves count 0 in the sum and never win the min
+        for _ in range(20):
+            # integer priorities keep the float32 sums exact, duplicated indices take their last value
+            indices = rng.randint(0, size, rng.randint(1, 2 * size + 1))
+            values = rng.randint(0, 10, len(indices)).astype(np.float32)
+            tree.update(indices + tree.tree_start, values)
+            for index, value in zip(indices, values):
+                leaves[index] = value
+            if np.all(np.isinf(leaves) | (leaves == 0)):
+                continue
+            _check(tree, leaves, rng)
+            assert tree.max >= leaves[~np.isinf(leaves)].max()
+
+
+def test_segment_tree_append_batch_and_overshoot():
+    tree = SegmentTree(13)
+    tree.update(np.array([0]) + tree.tree_start, 3.)
+    tree.append_batch(np.arange(1, 13))  # new leaves get the maximum priority
+    np.testing.assert_array_equal(tree.priorities(13), np.full(13, 3.))
+    # values past the total stay on the stored leaves
+    _, data_index, _ = tree.find(np.array([tree.total() + 1, tree.total() * 2]))
+    np.testing.assert_array_equal(data_index, [12, 12])
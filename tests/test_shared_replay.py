@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import pickle
+
+import numpy as np
+
+import memory
+from conftest import random_steps, replay_args
+
+CAPACITY, AGENTS = 32, 2
+COUNTS = (7, 9, 5)
+
+
+def _write(store, indices, steps):
+    store.write(indices, *steps)
+
+
+def _runs(rng):
+    runs = []
+    for count in COUNTS:
+        steps = random_steps(rng, count, AGENTS)
+        steps[7][-1] = True  # a written run starts an episode, so the one before it ends there
+        runs.append(steps)
+    return runs
+
+
+def _replay(shared):
+    return memory.MultiAgentReplayMemory(replay_args(memory_capacity=CAPACITY), CAPACITY, AGENTS,
+                                         remove_function=lambda x: x, shared=shared)
+
+
+def _assert_same(replay, reference):
+    for name, column in reference.store.columns.items():
+        assert np.array_equal(replay.store.columns[name], column), name
+    for name in ('index', 'full', 't', 'steps'):
+        assert getattr(replay.store, name) == getattr(reference.store, name), name
+    for agent, reference_agent in zip(replay.agents, reference.agents):
+        assert np.array_equal(agent.transitions.sum_tree, reference_agent.transitions.sum_tree)
+
+
+def test_worker_processes_write_reserved_runs():
+    steps = _runs(np.random.RandomState(0))
+    reference = _replay(False)
+    reference.append_batch(*random_steps(np.random.RandomState(1), 20, AGENTS, 1.))  # the head is not at row 0
+    replay = _replay(True)
+    try:
+        replay.append_batch(*random_steps(np.random.RandomState(1), 20, AGENTS, 1.))
+        runs = replay.reserve(list(COUNTS))
+        assert np.array_equal(np.concatenate(runs), (20 + np.arange(sum(COUNTS))) % CAPACITY)
+        context = multiprocessing.get_context('spawn')  # the store travels pickled and attaches by segment name
+        workers = [context.Process(target=_write, args=(replay.store, indices, run))
+                   for indices, run in zip(runs, steps)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert all(worker.exitcode == 0 for worker in workers)
+        assert replay.store.index == 20  # nothing moves until the runs are committed
+        replay.commit(runs)
+        for run in steps:
+            reference.append_batch(*run)
+        _assert_same(replay, reference)
+    finally:
+        replay.close()
+
+
+def test_pickled_store_writes_into_the_same_segments():
+    steps = _runs(np.random.RandomState(2))[0]
+    replay = _replay(True)
+    try:
+        copy = pickle.loads(pickle.dumps(replay.store))
+        assert not copy.owner
+        runs = replay.reserve([COUNTS[0]])
+        copy.write(runs[0], *steps)
+        copy.close()  # detaching a copy leaves the segments to their owner
+        replay.commit(runs)
+        reference = _replay(False)
+        reference.append_batch(*steps)
+        _assert_same(replay, reference)
+    finally:
+        replay.close()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import torch
+
+import memory
+import sparse_obs
+from conftest import replay_args
+
+
+def _observation(seed=0):
+    rng = np.random.RandomState(seed)
+    state = np.zeros(memory.state_shape, dtype=np.float32)
+    state[0] = rng.choice([-1, 0, 0, 0, 1], size=state.shape[1:])
+    state[1] = rng.randint(0, 256, size=state.shape[1:]) * (rng.rand(*state.shape[1:]) < 0.1) / 255
+    return torch.from_numpy(state)
+
+
+def _decode(sparse, state=None):
+    """:return the decoded blank frame and, if given, the decoded stored state of a sparse or dense replay"""
+    size = int(np.prod(memory.state_shape))
+    replay = memory.ReplayMemory(replay_args(sparse_observation=sparse, sparse_nnz=size), 16,
+                                 remove_function=lambda x: x)
+    store = replay.store
+    blank = {name: store.blank_tensors[name].clone().view(1, 1, *store.field_shape[name])
+             for name in store.state_fields}
+    decoded = [replay._decode_frames(blank, slice(0, 1))[0, 0]]
+    if state is not None:
+        replay.append(state, 0, np.zeros(memory.gp.ACTION_NUM), np.zeros(7), np.zeros(memory.gp.NUM_OF_ACCESSPOINT),
+                      np.ones(memory.gp.ACTION_NUM, dtype=bool), 0., False)
+        frames = store.gather(np.zeros((1, 1), dtype=np.int64), 0, store.state_fields)
+        decoded.append(replay._decode_frames(frames, slice(0, 1))[0, 0])
+    return decoded
+
+
+def test_blank_sparse_frame_decodes_like_dense():
+    sparse_blank, = _decode(True)
+    dense_blank, = _decode(False)
+    assert torch.equal(sparse_blank, dense_blank)
+    assert (sparse_blank[0] == -1).all() and (sparse_blank[1] == 0).all()
+
+
+def test_sparse_observation_decodes_like_dense():
+    state = _observation()
+    sparse_blank, sparse_state = _decode(True, state)
+    dense_blank, dense_state = _decode(False, state)
+    assert torch.equal(sparse_state[0], dense_state[0])
+    assert torch.allclose(sparse_state[1], dense_state[1], atol=1 / 255)
+    assert torch.allclose(sparse_state, state, atol=1e-3)
+
+
+def test_densify_batches_blank_and_real_rows():
+    size = int(np.prod(memory.state_shape))
+    state = _observation(1)
+    rows = [sparse_obs.pad_sparse(*sparse_obs.to_sparse(state), size, size), sparse_obs.blank_sparse(size, size)]
+    dense = sparse_obs.densify(np.stack([row[0] for row in rows]), np.stack([row[1] for row in rows]),
+                               memory.state_shape)
+    assert torch.allclose(dense[0], state, atol=1e-3)
+    assert (dense[1, 0] == -1).all() and (dense[1, 1] == 0).all()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import argparse
+
+import numpy as np
+import torch
+
+import memory
+from acer_fedstep.agent import Agent
+from conftest import random_steps, replay_args
+
+CAPACITY = 24
+
+
+class _Env:
+    def get_action_size(self):
+        return 13
+
+
+def _replay(history_length, current_action_observable, steps=30):
+    rng = np.random.RandomState(history_length)
+    replay = memory.ReplayMemory(replay_args(history_length=history_length,
+                                             current_action_observable=current_action_observable),
+                                 CAPACITY, remove_function=lambda frame: -frame)
+    for run in (CAPACITY, steps - CAPACITY):  # wraps the ring, so the oldest row is not at index 0
+        state, action, action_logp, nei_action, glob_action, avail, reward, terminal = random_steps(rng, run, 1, 0.2)
+        replay.append_batch(state[:, 0], action[:, 0], action_logp[:, 0], nei_action[:, 0], glob_action,
+                            avail[:, 0], reward[:, 0], terminal)
+    return replay
+
+
+def test_states_match_iteration():
+    for history_length, current_action_observable in ((1, True), (3, True), (3, False)):
+        replay = _replay(history_length, current_action_observable)
+        iterated = torch.stack([state.clone() for state in replay])
+        states = replay.states()
+        assert states.shape == (CAPACITY, 2 * history_length, 47, 47)
+        assert torch.equal(states, iterated), (history_length, current_action_observable)
+
+
+def test_evaluate_q_batch_matches_evaluate_q():
+    torch.manual_seed(0)
+    args = argparse.Namespace(atoms=5, action_selection='boltzmann', V_min=-1., V_max=1., batch_size=8,
+                              multi_step=3, discount=0.9, device='cpu', architecture='canonical_pooling_20ap',
+                              reward_update_rate=0.01, model=None, history_length=1, hidden_size=16, noisy_std=0.3,
+                              learning_rate=1e-3, adam_eps=1.5e-4)
+    agent = Agent(args, _Env(), 0)
+    agent.eval()
+    states = _replay(1, True).states()
+    batched = agent.evaluate_q_batch(states)
+    assert batched.shape == (CAPACITY,)
+    assert torch.allclose(batched, torch.tensor([agent.evaluate_q(state) for state in states]), atol=1e-5)
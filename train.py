@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 #from __future__ import division
 import argparse
-import bz2
 from datetime import datetime
 import os
 import sys
@@ -9,7 +8,6 @@ import sys
 sys.path.append('../..')
 sys.path.append('./')
 
-import pickle
 import GLOBAL_PRARM as gp
 
 import numpy as np
@@ -26,8 +24,11 @@ import torch.multiprocessing
 import copy as cp
 
 from acer_fedstep.agent import Agent
+from acer_fedstep.fused_learner import FusedLearner
 from game import Decentralized_Game as Env
-from memory import ReplayMemory
+from memory import MultiAgentReplayMemory, PrefetchSampler
+from replay_snapshot import ReplaySnapshot, load_snapshot
+from checkpoint_io import CODECS, save_checkpoint, load_checkpoint, replay_items, restore_replay
 from test import test, test_p
 
 # from pympler.tracker import SummaryTracker
@@ -82,13 +83,18 @@ parser.add_argument('--reward-update-rate', type=float, default=0.01, metavar='
                     help='Average value step rate (for non-episodic task)')
 parser.add_argument('--adam-eps', type=float, default=1.5e-4, metavar='ε', help='Adam epsilon')
 parser.add_argument('--batch-size', type=int, default=32, metavar='SIZE', help='Batch size')
+parser.add_argument('--prefetch', type=int, default=0, metavar='K',
+                    help='Batches drawn ahead per ap on a background thread (0 samples in the learn step)')
+parser.add_argument('--fused-learner', action='store_true',
+                    help='Learn all aps in one vectorized step over their stacked parameters')
 parser.add_argument('--better-indicator', type=float, default=1.05, metavar='b',
                     help='The new model should be b times of old performance to be recorded')
 # TODO: Switch interval should not be large
 parser.add_argument('--learn-start', type=int, default=int(400), metavar='STEPS',
                     help='Number of steps before starting training')
 parser.add_argument('--evaluate', action='store_true', help='Evaluate only')
-parser.add_argument('--data-reinforce', action='store_true', help='DataReinforcement')
+parser.add_argument('--data-reinforce', action='store_true',
+                    help='DataReinforcement, sampled batches get a random rotation/flip of the field')
 # TODO: Change this after debug
 parser.add_argument('--evaluation-interval', type=int, default=400, metavar='STEPS',
                     help='Number of training steps between evaluations')
@@ -104,7 +110,37 @@ parser.add_argument('--enable-cudnn', action='store_true', help='Enable cuDNN (f
 parser.add_argument('--checkpoint-interval', default=0,
                     help='How often to checkpoint the model, defaults to 0 (never checkpoint)')
 parser.add_argument('--memory', type=str,
-                    help='Path to save/load the memory from')
+                    help='Directory of the incremental replay snapshot to save/load')
+parser.add_argument('--snapshot-interval', type=int, default=1000, metavar='STEPS',
+                    help='Training steps between incremental replay snapshots (--memory) or flushes of the '
+                         'memory-mapped replay (--memory-dir)')
+parser.add_argument('--replay-stats', type=str, metavar='FILE',
+                    help='Append replay counters and histograms of every ap to this JSONL file')
+parser.add_argument('--replay-stats-interval', type=int, default=10000, metavar='STEPS',
+                    help='Steps between replay stats records, each record covers one interval')
+parser.add_argument('--inference-batch', type=int, default=0, metavar='N',
+                    help='Parallel evaluation answers at most N pending action requests per round (0 for all pipes)')
+parser.add_argument('--inference-wait', type=float, default=2., metavar='MS',
+                    help='Milliseconds the parallel evaluation waits for more action requests before a forward')
+parser.add_argument('--inference-stats', type=str, metavar='FILE',
+                    help='Append the throughput and latency of every parallel evaluation to this JSONL file')
+parser.add_argument('--priority-snapshot-interval', type=int, default=10, metavar='SNAPSHOTS',
+                    help='Replay snapshots between checkpoints of the priorities')
+parser.add_argument('--memory-dir', type=str, default=None, metavar='DIR',
+                    help='Keep the replay in memory-mapped files in DIR instead of RAM, reopened if DIR holds one')
+parser.add_argument('--compact-transition', action='store_true',
+                    help='Bit-pack stored transitions: 2-bit action marks, 4-bit qos, float16 log-probs, bitmask masks')
+parser.add_argument('--global-frame', action='store_true',
+                    help='Store the global field once per step plus a per-ap action overlay instead of per-ap crops')
+parser.add_argument('--sparse-observation', action='store_true',
+                    help='Store observations in the replay as non-zero (index, value) pairs, a storage format '
+                         'only: the game and the nets keep dense states, sampled batches are densified')
+parser.add_argument('--sparse-nnz', type=int, default=128, metavar='K',
+                    help='Maximum non-zero pixels of one stored sparse observation')
+parser.add_argument('--checkpoint-codec', type=str, default='zlib', choices=sorted(CODECS),
+                    help='Compression of the files of a checkpoint')
+parser.add_argument('--resume', type=str, default=None, metavar='DIR',
+                    help='Checkpoint directory to restore the models and the replay from')
 parser.add_argument('--disable-bzip-memory', action='store_false',
                     help='Don\'t zip the memory file. Not recommended (zipping is a bit slower and much, much smaller)')
 # TODO: Change federated round each time
@@ -149,43 +185,26 @@ def average_weights(list_of_weight):
     return averga_w
 
 
-def load_memory(memory_path, disable_bzip):
-    if disable_bzip:
-        with open(memory_path, 'rb') as pickle_file:
-            return pickle.load(pickle_file)
-    else:
-        with bz2.open(memory_path, 'rb') as zipped_pickle_file:
-            return pickle.load(zipped_pickle_file)
-
-
-def save_memory(memory, memory_path, disable_bzip, index=-1):
-    # save ap mem
-    memory_path = memory_path[0:-4] + str(index) + memory_path[-4:]
-    if disable_bzip:
-        with open(memory_path, 'wb') as pickle_file:
-            pickle.dump(memory, pickle_file)
-    else:
-        with bz2.open(memory_path, 'wb') as zipped_pickle_file:
-            pickle.dump(memory, zipped_pickle_file)
-
-
-def run_game_once_parallel_random(new_game, train_history_aps_parallel, episode):
+def run_game_once_parallel_random(new_game, store, indices):
     train_examples_aps = []
-    for _ in range(new_game.environment.ap_number):
-        train_examples_aps.append([])
     eps, done = 0, True
-    while eps < episode:
+    while eps < len(indices):
         if done:
             done = new_game.reset()
-        state, action, action_logp, avail, reward, done, _ = new_game.step()  # Step
-        for index_p, ele_p in enumerate(state):
-            neighbor_indice = new_game.environment.coop_graph.neighbor_indices(index_p, True)
-            action_patch = np.append(action, [-1])
-            train_examples_aps[index_p].append((ele_p, action[index_p], action_logp[index_p],
-                                                action_patch[neighbor_indice],
-                                                action, avail[index_p], reward[index_p], done))
+        step = new_game.step()  # Step
+        done = step.done
+        state = new_game.replay_state(step.state)
+        train_examples_aps.append((state, step.action, step.action_logp, step.neighbor_action, step.action,
+                                   step.avail, step.reward, done))  # one entry per step, batched over aps
         eps += 1
-    train_history_aps_parallel.append(train_examples_aps)
+    state, a, alog, na, ga, av, rw, done = zip(*train_examples_aps)
+    if type(state[0]) is tuple:
+        state = tuple(torch.stack(field) for field in zip(*state))
+    else:
+        state = list(state) if type(state[0]) is list else torch.stack(state)
+    # written straight into the reserved rows of the shared replay
+    store.write(indices, state, np.stack(a), np.stack(alog), np.stack(na), np.stack(ga), np.stack(av),
+                torch.stack(rw), np.array(done))
 
 
 # Environment
@@ -202,21 +221,43 @@ for _ in range(env.environment.ap_number):
 
 global_model = Agent(args, env, "Global_")
 
+# --memory is read and written as a snapshot directory, the per ap memory pickles of earlier versions are not loaded
+if args.memory is not None and args.memory_dir is None and not args.evaluate and os.path.exists(args.memory) and \
+        not os.path.isfile(os.path.join(args.memory, 'manifest.json')) and \
+        not (os.path.isdir(args.memory) and not os.listdir(args.memory) and args.model is None):
+    raise ValueError('{path} is not a replay snapshot directory (no manifest.json), memory pickles of earlier versions '
+                     'cannot be loaded. Aborting...'.format(path=args.memory))
+
 # If a model is provided, and evaluate is fale, presumably we want to resume, so try to load memory
-if args.model is not None and not args.evaluate:
+if args.memory_dir is not None:
+    replay = MultiAgentReplayMemory(args, args.memory_capacity, env.environment.ap_number, env.remove_previous_action,
+                                    args.memory_dir, env.get_crop_geometry(), geometry=env.get_replay_geometry())
+elif args.model is not None and not args.evaluate:
     if not args.memory:
         raise ValueError('Cannot resume training without memory save path. Aborting...')
     elif not os.path.exists(args.memory):
-        raise ValueError('Could not find memory file at {path}. Aborting...'.format(path=args.memory))
+        raise ValueError('Could not find memory snapshot at {path}. Aborting...'.format(path=args.memory))
 
-    mem_aps = []
-    for index in range(env.environment.ap_number):
-        path = os.path.join(args.memory, ('metrics_aps' + str(index) + '.pth'))
-        mem_aps.append(load_memory(path, args.disable_bzip_memory))
+    replay = MultiAgentReplayMemory(args, args.memory_capacity, env.environment.ap_number, env.remove_previous_action,
+                                    crop_geometry=env.get_crop_geometry(), geometry=env.get_replay_geometry())
+    load_snapshot(replay, args.memory)
 else:
-    mem_aps = []
-    for _ in range(env.environment.ap_number):
-        mem_aps.append(ReplayMemory(args, args.memory_capacity, env.remove_previous_action))
+    replay = MultiAgentReplayMemory(args, args.memory_capacity, env.environment.ap_number, env.remove_previous_action,
+                                    crop_geometry=env.get_crop_geometry(), geometry=env.get_replay_geometry())
+if args.resume is not None:
+    items = load_checkpoint(args.resume)  # every file decompressed in parallel
+    for index in range(env.environment.ap_number):
+        dqn[index].online_net.load_state_dict(items['model' + str(index)])
+        dqn[index].set_target_dict(items['target' + str(index)])
+    if 'replay_meta' in items and args.memory_dir is None:
+        restore_replay(replay, items)
+    del items
+mem_aps = replay.agents  # per ap views over the shared store
+snapshot = ReplaySnapshot(replay, args.memory, args.priority_snapshot_interval) \
+    if args.memory is not None and args.memory_dir is None and not args.evaluate else None
+learn_mem_aps = [PrefetchSampler(mem, args.batch_size, args.prefetch) for mem in mem_aps] if args.prefetch > 0 \
+    else mem_aps
+learner = FusedLearner(args, dqn) if args.fused_learner and not args.evaluate else None
 
 try:
     sis_list = dqn[0].assign_sister_nodes
@@ -230,175 +271,164 @@ else:
 priority_weight_increase = (1 - args.priority_weight) / (args.T_max - args.learn_start)
 
 # Construct validation memory
-val_mem_aps = []
-for _ in range(env.environment.ap_number):
-    val_mem_aps.append(ReplayMemory(args, args.evaluation_size, env.remove_previous_action))
+val_replay = MultiAgentReplayMemory(args, args.evaluation_size, env.environment.ap_number, env.remove_previous_action,
+                                    crop_geometry=env.get_crop_geometry(), geometry=env.get_replay_geometry(),
+                                    shared=gp.PARALLEL_EXICUSION)
+val_mem_aps = val_replay.agents
 if not gp.PARALLEL_EXICUSION:
     T, done = 0, True
     while T < args.evaluation_size:
         if done:
             done = env.reset()
-        state, action, action_logp, avail, reward, done, _ = env.step()
-        for index, ele in enumerate(state):
-            neighbor_indice = env.environment.coop_graph.neighbor_indices(index, True)
-            action_patch = np.append(action, [-1])
-            val_mem_aps[index].append(ele, action[index], action_logp[index], action_patch[neighbor_indice],
-                                      action, avail[index], reward[index], done)
+        step = env.step()
+        done = step.done
+        val_replay.append(env.replay_state(step.state), step.action, step.action_logp, step.neighbor_action,
+                          step.action, step.avail, step.reward, done)
         T += 1
 else:
     num_cores = min(multiprocessing.cpu_count(), gp.ALLOCATED_CORES) - 1
-    num_eps = math.ceil(args.evaluation_size / num_cores)
-    # make sure each subprocess can finish all the game (end with done)
-    with multiprocessing.Manager() as manager:
-        train_history_aps = manager.list()
-
-        process_list = []
-        for _ in range(num_cores):
-            process = multiprocessing.Process(target=run_game_once_parallel_random,
-                                              args=(cp.deepcopy(env), train_history_aps, num_eps))
-            process_list.append(process)
-
-        for pro in process_list:
-            pro.start()
-        for pro in process_list:
-            pro.join()
-            pro.terminate()
-
-        for res in train_history_aps:
-            for index, memerys in enumerate(res):
-                for state, a, alog, na, ga, av, rw, done in memerys:
-                    val_mem_aps[index].append(state, a, alog, na, ga, av, rw, done)
-
-if args.evaluate:
-    for index in range(env.environment.ap_number):
-        dqn[index].eval()  # Set DQN (online network) to evaluation mode
-    (avg_pack) = test(args, 0, dqn, val_mem_aps, matric, results_dir, evaluate=True)  # Test
-    for index in range(env.environment.ap_number):
-        print('Avg. reward for ap' + str(index) + ': ' + str(avg_pack[0][index]) + ' | Avg. Q: ' + str(avg_pack[1][index]))
-else:
-    # Training loop
-    T, aps_state, epsilon, done = 0, None, args.epsilon_max, env.reset()
-    reinforce_ap = []
-    for i in range(env.environment.ap_number):
-        temp = []
-        for j in range(3):
-            temp.append([])
-        reinforce_ap.append(temp)
-
-    for T in trange(1, args.T_max + 1):
-        if done and T > 2:
-            done = env.reset()
-            if T > 1 and args.data_reinforce:
-                for index, ap_rein in enumerate(reinforce_ap):
-                    for ap_pair in ap_rein:
-                        for ap_ele in ap_pair:
-                            mem_aps[index].append(ap_ele[0], ap_ele[1], ap_ele[2], ap_ele[3],
-                                                  ap_ele[4], ap_ele[5], ap_ele[6], ap_ele[7])
-            reinforce_ap = []
-            for i in range(env.environment.ap_number):
-                temp = []
-                for j in range(3):
-                    temp.append([])
-                reinforce_ap.append(temp)
-
-        # training loop
-        if T % args.replay_frequency == 0:
-            for _ in range(env.environment.ap_number):
-                dqn[_].reset_noise()
+    # each worker gets its own run of rows of the shared replay and fills them in place
+    counts = [args.evaluation_size // num_cores + (_ < args.evaluation_size % num_cores) for _ in range(num_cores)]
+    runs = val_replay.reserve([count for count in counts if count > 0])
+    process_list = []
+    for indices in runs:
+        process = multiprocessing.Process(target=run_game_once_parallel_random,
+                                          args=(cp.deepcopy(env), val_replay.store, indices))
+        process_list.append(process)
+
+    for pro in process_list:
+        pro.start()
+    for pro in process_list:
+        pro.join()
+        pro.terminate()
+    if any(pro.exitcode != 0 for pro in process_list):
+        raise RuntimeError("A rollout worker failed to fill the validation memory")
+    val_replay.commit(runs)  # only the write head, returns and priorities are updated here
 
-        state, action, action_logp, avail, reward, done, _ = env.step(dqn)
-        epsilon = epsilon - args.epsilon_delta
-        epsilon = np.clip(epsilon, a_min=args.epsilon_min, a_max=args.epsilon_max)
+try:
+    if args.evaluate:
+        for index in range(env.environment.ap_number):
+            dqn[index].eval()  # Set DQN (online network) to evaluation mode
+        (avg_pack) = test(args, 0, dqn, val_mem_aps, matric, results_dir, evaluate=True)  # Test
+        for index in range(env.environment.ap_number):
+            print('Avg. reward for ap' + str(index) + ': ' + str(avg_pack[0][index]) + ' | Avg. Q: ' +
+                  str(avg_pack[1][index]))
+    else:
+        # Training loop
+        T, aps_state, epsilon, done = 0, None, args.epsilon_max, env.reset()
 
-        for _ in range(env.environment.ap_number):
-            if args.reward_clip > 0:
-                reward[_] = torch.clamp(reward[_], max=args.reward_clip, min=-args.reward_clip) # Clip rewards
-            neighbor_indice = env.environment.coop_graph.neighbor_indices(_, True)
-            action_patch = np.append(action, [-1])
-            mem_aps[_].append(state[_], action[_], action_logp[_], action_patch[neighbor_indice],
-                              action, avail[_], reward[_], done)
-            dqn[_].update_neighbor_indice(neighbor_indice)
-            # Append transition to memory
-            if args.data_reinforce:
-                # data reinforcement, not applicapable with infinite environment
-                obs = state[_]
-                obs = torch.rot90(obs, 2, [1, 2])
-                if action[_] != 12 and not reward[_] == 0:
-                    reinforce_ap[_][0].append((obs, env.rot_action(action[_]), action_logp[_],
-                                               env.rot_action(action_patch[neighbor_indice]),
-                                               env.rot_action(action), env.rot_avail(avail[_]), reward[_], done))
-                    reinforce_ap[_][1].append((torch.flip(obs, [1]), env.flip_action(env.rot_action(action))[_],
-                                               action_logp[_],
-                                               env.flip_action(env.rot_action(action_patch[neighbor_indice])),
-                                               env.flip_action(env.rot_action(action)),
-                                               env.flip_avail(env.rot_avail(avail[_])), reward[_], done))
-                    reinforce_ap[_][2].append((torch.flip(state[_], [1]), env.flip_action(action)[_], action_logp[_],
-                                               env.flip_action(action_patch[neighbor_indice]),
-                                               env.flip_action(action), env.flip_avail(avail[_]), reward[_], done))
-                    # append rotated observation for data reinforcement
-
-        if T >= args.learn_start:
-            # tracker.print_diff()
-            for index in range(env.environment.ap_number):
-                mem_aps[index].priority_weight = min(mem_aps[index].priority_weight + priority_weight_increase, 1)
-                # Anneal importance sampling weight β to 1
+        for T in trange(1, args.T_max + 1):
+            if done and T > 2:
+                done = env.reset()
 
+            # training loop
             if T % args.replay_frequency == 0:
+                for _ in range(env.environment.ap_number):
+                    dqn[_].reset_noise()
+
+            step = env.step(dqn)
+            done = step.done
+            epsilon = epsilon - args.epsilon_delta
+            epsilon = np.clip(epsilon, a_min=args.epsilon_min, a_max=args.epsilon_max)
+            mem_state = env.replay_state(step.state)
+            reward = step.reward
+            if args.reward_clip > 0:
+                reward = torch.clamp(reward, max=args.reward_clip, min=-args.reward_clip)  # Clip rewards
+            neighbor_indices = env.get_neighbor_indices()
+
+            replay.append(mem_state, step.action, step.action_logp, step.neighbor_action, step.action, step.avail,
+                          reward, done)
+            # Append transition of every ap in one write,
+            # data reinforcement (--data-reinforce) is applied at sample time
+            for _ in range(env.environment.ap_number):
+                dqn[_].update_neighbor_indice(neighbor_indices[_])
+
+            if T >= args.learn_start:
+                # tracker.print_diff()
+                for index in range(env.environment.ap_number):
+                    mem_aps[index].priority_weight = min(mem_aps[index].priority_weight + priority_weight_increase, 1)
+                    # Anneal importance sampling weight β to 1
+
+                if T % args.replay_frequency == 0:
+                    if learner is not None:
+                        learner.learn(learn_mem_aps)  # every ap in one vectorized step
+                    else:
+                        for index in range(env.environment.ap_number):
+                            dqn[index].learn(learn_mem_aps[index])  # Train with n-step distributional double-Q learning
+
+                if 0 < args.federated_round and T % args.federated_round == 0:
+                    global_weight = average_weights([model.get_state_dict() for model in dqn])
+                    global_target = average_weights([model.get_target_dict() for model in dqn])
+                    global_model.set_state_dict(global_weight)
+                    # global_model.set_target_dict(global_target)
+                    log('T = ' + str(T) + ' / ' + str(args.T_max) + ' Global averaging starts')
+                    average_reward = np.array([model.average_reward for model in dqn])
+                    average_reward = np.mean(average_reward)
+                    log('T = ' + str(T) + ' / ' + str(args.T_max) + ' Averaged reward is: ' +
+                        str(float(average_reward)))
+                    for models in dqn:
+                        models.set_state_dict(global_weight)
+                        # models.set_target_dict(global_target)
+                        models.average_reward = average_reward
+
+                # If memory path provided, save it, the os writes the memory-mapped pages back in between
+                if args.memory_dir is not None and T % args.snapshot_interval == 0:
+                    with replay.store.lock:
+                        replay.flush()
+                elif snapshot is not None and T % args.snapshot_interval == 0:
+                    snapshot.snapshot()  # only the steps added since the last snapshot, written in the background
+                if args.replay_stats is not None and T % args.replay_stats_interval == 0:
+                    replay.dump_stats(args.replay_stats, T)
+
+                # Update target network
+                # if T % args.target_update == 0:  # uncomment for hard update
                 for index in range(env.environment.ap_number):
-                    dqn[index].learn(mem_aps[index])  # Train with n-step distributional double-Q learning
-
-            if 0 < args.federated_round and T % args.federated_round == 0:
-                global_weight = average_weights([model.get_state_dict() for model in dqn])
-                global_target = average_weights([model.get_target_dict() for model in dqn])
-                global_model.set_state_dict(global_weight)
-                # global_model.set_target_dict(global_target)
-                log('T = ' + str(T) + ' / ' + str(args.T_max) + ' Global averaging starts')
-                average_reward = np.array([model.average_reward for model in dqn])
-                average_reward = np.mean(average_reward)
-                log('T = ' + str(T) + ' / ' + str(args.T_max) + ' Averaged reward is: ' + str(float(average_reward)))
-                for models in dqn:
-                    models.set_state_dict(global_weight)
-                    # models.set_target_dict(global_target)
-                    models.average_reward = average_reward
-
-            # If memory path provided, save it
-            for index in range(env.environment.ap_number):
-                if args.memory is not None:
-                    save_memory(mem_aps[index], args.memory, args.disable_bzip_memory, index)
-
-            # Update target network
-            # if T % args.target_update == 0:  # uncomment for hard update
-            for index in range(env.environment.ap_number):
-                dqn[index].soft_update_target_net(1/args.target_update)
-
-            # Checkpoint the network
-            if (args.checkpoint_interval != 0) and (T % args.checkpoint_interval == 0):
+                    dqn[index].soft_update_target_net(1/args.target_update)
+
+                # Checkpoint the network
+                if (args.checkpoint_interval != 0) and (T % args.checkpoint_interval == 0):
+                    # models, target models and replay of every ap written concurrently
+                    items = replay_items(replay) if args.memory_dir is None else {}
+                    if args.memory_dir is not None:
+                        with replay.store.lock:
+                            replay.flush()  # the checkpoint goes with the replay on disk as of now
+                    for index in range(env.environment.ap_number):
+                        items['model' + str(index)] = dqn[index].get_state_dict()
+                        items['target' + str(index)] = dqn[index].get_target_dict()
+                    save_checkpoint(os.path.join(results_dir, 'checkpoint'), items, args.checkpoint_codec)
+
+            if T % args.evaluation_interval == 0 and T >= args.learn_start:
+                for index in range(env.environment.ap_number):
+                    dqn[index].eval()  # Set DQN (online network) to evaluation mode
+
+                if gp.PARALLEL_EXICUSION:
+                    aps_pack = test_p(args, T, dqn, val_mem_aps, metrics_all, matric, results_dir)  # Test
+                else:
+                    aps_pack = test(args, T, dqn, val_mem_aps, metrics_all, matric, results_dir)  # Test
+
+                log('T = ' + str(T) + ' / ' + str(aps_pack[3]) + '   Shapped Summed Reward.')
+                if aps_pack[2]:
+                    log('T = ' + str(T) + ' / ' + str(args.T_max) + '   Better model, accepted.')
+                    global_model.save(results_dir, 'Global_')
+                    # for ind, mod in enumerate(dqn):
+                    #     mod.save(results_dir, ind)
+                else:
+                    log('T = ' + str(T) + ' / ' + str(args.T_max) + '   Worse model, reject.')
+                for index in range(env.environment.ap_number):
+                    log('T = ' + str(T) + ' / ' + str(args.T_max) + '  For ap' + str(index) +
+                        ' | Avg. reward: ' + str(aps_pack[0][index]) + ' | Avg. Q: ' + str(aps_pack[1][index])
+                        + ' | Avg. R: ' + str(float(dqn[index].average_reward)))
+
                 for index in range(env.environment.ap_number):
-                    dqn[index].save(results_dir, 'checkpoint' + str(index) + '.pth')
-
-        if T % args.evaluation_interval == 0 and T >= args.learn_start:
-            for index in range(env.environment.ap_number):
-                dqn[index].eval()  # Set DQN (online network) to evaluation mode
-
-            if gp.PARALLEL_EXICUSION:
-                aps_pack = test_p(args, T, dqn, val_mem_aps, metrics_all, matric, results_dir)  # Test
-            else:
-                aps_pack = test(args, T, dqn, val_mem_aps, metrics_all, matric, results_dir)  # Test
-
-            log('T = ' + str(T) + ' / ' + str(aps_pack[3]) + '   Shapped Summed Reward.')
-            if aps_pack[2]:
-                log('T = ' + str(T) + ' / ' + str(args.T_max) + '   Better model, accepted.')
-                global_model.save(results_dir, 'Global_')
-                # for ind, mod in enumerate(dqn):
-                #     mod.save(results_dir, ind)
-            else:
-                log('T = ' + str(T) + ' / ' + str(args.T_max) + '   Worse model, reject.')
-            for index in range(env.environment.ap_number):
-                log('T = ' + str(T) + ' / ' + str(args.T_max) + '  For ap' + str(index) +
-                    ' | Avg. reward: ' + str(aps_pack[0][index]) + ' | Avg. Q: ' + str(aps_pack[1][index])
-                    + ' | Avg. R: ' + str(float(dqn[index].average_reward)))
-
-            for index in range(env.environment.ap_number):
-                dqn[index].train()  # Set DQN (online network) back to training mode
-
-env.close()
+                    dqn[index].train()  # Set DQN (online network) back to training mode
+finally:
+    # queued priority updates are applied and the sampler threads joined before the replay is closed
+    for mem in learn_mem_aps:
+        if isinstance(mem, PrefetchSampler):
+            mem.close()
+    env.close()
+    val_replay.close()
+    if snapshot is not None:
+        snapshot.close()
+    if args.memory_dir is not None:
+        replay.flush()
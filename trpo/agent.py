@@ -4,9 +4,9 @@ import os
 import numpy as np
 import torch
 from torch import optim
-from scipy.special import softmax as softmax_sci
 from torch.nn.utils import clip_grad_norm_
 import GLOBAL_PRARM as gp
+import action_sampler
 import torch.nn.functional as F
 
 from trpo.basic_block import DQN
@@ -106,62 +106,20 @@ class Agent:
 
     # Acts with an ε-greedy policy (used for evaluation only)
     def act_boltzmann(self, state, avail):  # High ε can reduce evaluation scores drastically
+        return self.act_boltzmann_batch(state.unsqueeze(0), [avail])[0]
+
+    # act_boltzmann for a batch of states, one result per state (batched inference server)
+    def act_boltzmann_batch(self, states, avails):
         with torch.no_grad():
-            res_policy, res_policy_log = self.online_net(state.unsqueeze(0))
-            res_action = self.boltzmann(res_policy, [avail])
-            return (res_action, (res_policy_log[:, res_action]).numpy())
+            res_policy, res_policy_log = self.online_net(states)
+            actions = action_sampler.categorical(res_policy, avails)
+            return list(zip(actions.tolist(), res_policy_log.gather(1, actions.unsqueeze(1)).numpy()))
 
     def boltzmann(self, res_policy, mask):
-        sizeofres = res_policy.shape
-        res = []
-        res_policy = res_policy.numpy()
-        for i in range(sizeofres[0]):
-            action_probs = [res_policy[i][ind] * mask[i][ind] for ind in range(res_policy[i].shape[0])]
-            count = np.sum(action_probs)
-            if count == 0:
-                action_probs = np.array([1.0 / np.sum(mask[i]) if _ != 0 else 0 for _ in mask[i]])
-                print('Zero probs, random action')
-            else:
-                action_probs = np.array([x / count for x in action_probs])
-            res.append(np.random.choice(self.action_space, p=action_probs))
-        if sizeofres[0] == 1:
-            return res[0]
-        return np.array(res)
-
-    def lookup_server(self, list_of_pipe):
-        num_pro = len(list_of_pipe)
-        list_pro = np.ones(num_pro, dtype=bool)
-        with torch.no_grad():
-            while list_pro.any():
-                for key, pipes in enumerate(list_of_pipe):
-                    if not pipes.closed and pipes.readable:
-                        obs, avial = pipes.recv()
-                        if len(obs) == 1:
-                            if not obs[0]:
-                                pipes.close()
-                                list_pro[key] = False
-                                continue
-                        pipes.send(self.act_boltzmann(obs, avial))
-                        # convert back to numpy or cpu-tensor, or it will cause error since cuda try to run in
-                        # another thread. Keep the gpu resource inside main thread
-
-    def lookup_server_loop(self, list_of_pipe):
-        num_pro = len(list_of_pipe)
-        list_pro = np.ones(num_pro, dtype=bool)
-        for key, pipes in enumerate(list_of_pipe):
-            if not pipes.closed and pipes.readable:
-                if pipes.poll():
-                    obs, avial = pipes.recv()
-                    if type(obs) is np.ndarray:
-                        pipes.close()
-                        list_pro[key] = False
-                        continue
-                    pipes.send(self.act_boltzmann(obs, avial))
-            else:
-                list_pro[key] = False
-            # convert back to numpy or cpu-tensor, or it will cause error since cuda try to run in
-            # another thread. Keep the gpu resource inside main thread
-        return list_pro.any()
+        actions = action_sampler.categorical(res_policy, mask)
+        if len(actions) == 1:
+            return actions[0].item()
+        return actions.numpy()
 
     @staticmethod
     def _to_one_hot(y, num_classes):
@@ -215,9 +173,9 @@ class Agent:
             param.data.copy_(flat_params[prev_indx:prev_indx + flat_size].view(param.size()))
             prev_indx += flat_size
 
-    # get the surrogate loss
+    # get the surrogate loss, obs are conv trunk features (only the actor end moves in the trpo step)
     def _get_surrogate_loss(self, obs, adv, actions, pi_old):
-        _, logp = self.online_net(obs)
+        _, logp = self.online_net.head(obs)
         surr_loss = -torch.exp(logp.gather(-1, actions.unsqueeze(1)) - pi_old.gather(-1, actions.unsqueeze(1))) * adv
         return surr_loss.mean()
 
@@ -236,7 +194,7 @@ class Agent:
 
     # get the kl divergence between two distributions
     def _get_kl(self, obs, pi_old):
-        _, logp = self.online_net(obs)
+        _, logp = self.online_net.head(obs)
         kl = torch.exp(pi_old) * (pi_old - logp)
         return kl.sum(1, keepdim=True)
 
@@ -248,20 +206,22 @@ class Agent:
             mem.sample(self.batch_size, self.average_reward)
 
         self.online_net.zero_grad()
+        # conv trunk once, the trpo step only changes the actor end so the critic update reuses it too
+        feats = self.online_net.features(states)
         with torch.no_grad():
-            state_value_current, _ = self.online_net(states, False)
+            state_value_current, _ = self.online_net.head(feats, False)
             advantage = returns - torch.sum(state_value_current.detach() * self.support, dim=-1)
             advantage = (advantage - advantage.mean()) / (advantage.std() + 1e-7)
 
         # get the surr loss
-        surr_loss = self._get_surrogate_loss(states, advantage, actions, actions_logp)
+        surr_loss = self._get_surrogate_loss(feats.detach(), advantage, actions, actions_logp)
         # comupte the surrogate gardient -> g, Ax = g, where A is the fisher information matrix
         surr_loss.backward(retain_graph=True)
         flat_surr_grad = torch.cat([param.grad.view(-1) for param in self.online_net.actor_parameters()]).data
         # use the conjugated gradient to calculate the scaled direction vector (natural gradient)
-        nature_grad = self._conjugated_gradient(-flat_surr_grad, 10, states, actions_logp)
+        nature_grad = self._conjugated_gradient(-flat_surr_grad, 10, feats.detach(), actions_logp)
         # calculate the scaleing ratio
-        non_scale_kl = 0.5 * (nature_grad * self._fisher_vector_product(nature_grad, states, actions_logp)).sum(0, keepdim=True)
+        non_scale_kl = 0.5 * (nature_grad * self._fisher_vector_product(nature_grad, feats.detach(), actions_logp)).sum(0, keepdim=True)
         scale_ratio = torch.sqrt(non_scale_kl / self.max_kl)
         final_nature_grad = nature_grad / scale_ratio[0]
         # calculate the expected improvement rate...
@@ -270,7 +230,7 @@ class Agent:
         prev_params = torch.cat([param.data.view(-1) for param in self.online_net.actor_parameters()])
         # start to do the line search
         success, new_params = self._line_search(prev_params, final_nature_grad,
-                                                expected_improve, states, advantage, actions, actions_logp)
+                                                expected_improve, feats.detach(), advantage, actions, actions_logp)
         self._set_flat_params_to(new_params)
 
         # critic update
@@ -278,7 +238,7 @@ class Agent:
         self.optimiser.zero_grad()
 
         # Calculate current state probabilities (online network noise already sampled)
-        ps_a, log_ps_a = self.online_net(states, False, log=True)
+        ps_a, log_ps_a = self.online_net.head(feats, False, log=True)
         # Log probabilities log p(s_t, ·; θonline)
 
         with torch.no_grad():
@@ -346,6 +306,11 @@ class Agent:
             temp, _ = self.online_net(state.unsqueeze(0), False)
             return (temp * self.support).sum(-1).item()
 
+    def evaluate_q_batch(self, states):
+        with torch.no_grad():
+            temp, _ = self.online_net(states, False)
+            return (temp * self.support).sum(-1).view(-1)
+
     def train(self):
         self.online_net.train()
 
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import GLOBAL_PRARM as gp
+from game import Decentralized_Game
+
+"""
+    N Decentralized_Game stepped in lockstep, every result is a batched tensor with the game on the first dimension.
+    1) vec_game.observe():
+        return states (env x ap x c x h x w), action masks (env x ap x action)
+    2) vec_game.step(actions):
+        take (env x ap) actions for the last observation
+        return states, executed actions, action masks, rewards, dones, centralized rewards
+        finished games are reset automatically, their done flag is still reported for this step
+    mode 'sync' runs the games inside this process, mode 'subprocess' runs one game per process, results are written
+    into shared memory tensors and only short commands go through the pipes.
+"""
+
+
+def _observe(game, buffers, index):
+    state, avail = game.observe()
+    buffers['obs_state'][index].copy_(state)
+    buffers['avail'][index].copy_(torch.from_numpy(avail))
+
+
+def _step(game, buffers, index):
+    state, action, _, reward, done, overall_reward = game.execute(buffers['action'][index].numpy())
+    buffers['state'][index].copy_(state)
+    buffers['exec_action'][index].copy_(torch.from_numpy(np.asarray(action, dtype=np.int64)))
+    buffers['reward'][index].copy_(torch.from_numpy(np.asarray(reward, dtype=np.float32)))
+    buffers['done'][index] = bool(done)
+    buffers['overall'][index] = float(overall_reward)
+    if done:
+        game.reset()
+
+
+def _reset(game, buffers, index):
+    game.reset()
+
+
+_COMMANDS = {'observe': _observe, 'step': _step, 'reset': _reset}
+
+
+def _worker(remote, parent_remote, game, buffers, index):
+    parent_remote.close()
+    np.random.seed((int(time.time() % 1 * 10e8) + index) % (2 ** 32))
+    # forked games share the parent random state, shift each of them
+    try:
+        while True:
+            command = remote.recv()
+            if command == 'close':
+                break
+            _COMMANDS[command](game, buffers, index)
+            remote.send(True)
+    finally:
+        remote.close()
+        game.close()
+
+
+class VecDecentralizedGame:
+    def __init__(self, args, num_envs, mode='sync'):
+        if mode not in ['sync', 'subprocess']:
+            raise ValueError("Unknown vectorized game mode")
+        self.num_envs = num_envs
+        self.mode = mode
+        self.closed = False
+        self.games = [Decentralized_Game(args) for _ in range(num_envs)]
+        self.ap_number = self.games[0].environment.ap_number
+        side = self.games[0].observation_side
+        self.buffers = {
+            'obs_state': torch.zeros(num_envs, self.ap_number, gp.OBSERVATION_DIMS * args.history_length, side, side),
+            'avail': torch.zeros(num_envs, self.ap_number, gp.ACTION_NUM, dtype=torch.bool),
+            'action': torch.zeros(num_envs, self.ap_number, dtype=torch.int64),
+            'state': torch.zeros(num_envs, self.ap_number, self.games[0].state_channels, side, side),
+            'exec_action': torch.zeros(num_envs, self.ap_number, dtype=torch.int64),
+            'reward': torch.zeros(num_envs, self.ap_number),
+            'done': torch.zeros(num_envs, dtype=torch.bool),
+            'overall': torch.zeros(num_envs)}
+
+        self.remotes, self.processes = [], []
+        if mode == 'subprocess':
+            for buffer in self.buffers.values():
+                buffer.share_memory_()
+            for index, game in enumerate(self.games):
+                remote, work_remote = mp.Pipe()
+                process = mp.Process(target=_worker, args=(work_remote, remote, game, self.buffers, index),
+                                     daemon=True)
+                process.start()
+                work_remote.close()
+                self.remotes.append(remote)
+                self.processes.append(process)
+
+    def _run(self, command):
+        if self.mode == 'sync':
+            for index, game in enumerate(self.games):
+                _COMMANDS[command](game, self.buffers, index)
+        else:
+            for remote in self.remotes:
+                remote.send(command)
+            for remote in self.remotes:
+                remote.recv()
+
+    def reset(self):
+        self._run('reset')
+        self.buffers['done'].zero_()
+
+    def observe(self):
+        """:return states (env x ap x c x h x w) and action masks (env x ap x action)"""
+        self._run('observe')
+        return self.buffers['obs_state'].clone(), self.buffers['avail'].clone()
+
+    def step(self, actions):
+        """
+            :parameter actions: (env x ap) actions for the last observed states
+            :return states, executed actions, action masks, rewards, dones and centralized rewards of all games
+        """
+        self.buffers['action'].copy_(torch.as_tensor(actions, dtype=torch.int64))
+        self._run('step')
+        return self.buffers['state'].clone(), self.buffers['exec_action'].clone(), self.buffers['avail'].clone(), \
+               self.buffers['reward'].clone(), self.buffers['done'].clone(), self.buffers['overall'].clone()
+
+    def random_action(self, avails):
+        """:return (env x ap) random valid actions for the given action masks"""
+        return torch.as_tensor(self.games[0].environment.random_action('randomnon12', avails.numpy()),
+                               dtype=torch.int64)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.mode == 'subprocess':
+            for remote in self.remotes:
+                remote.send('close')
+                remote.close()
+            for process in self.processes:
+                process.join()
+        for game in self.games:
+            game.close()
+        self.closed = True